@@ -0,0 +1,189 @@
+# Benchmarks the scraper end to end without touching Reddit or the internet.  A stand-in Reddit API
+# and image server are started on localhost, then each mode of the scraper is run against them in
+# its own process and timed.  Reports images/sec, MB/s, p50/p99 per-file latency and peak RSS, and
+# keeps the scraper's own metrics (see modules/metrics.py) for each mode in the JSON results.
+#
+#   python benchmarks/bench.py --days 3 --per-day 200 --latency 0.02 --modes sync,threads,async
+#
+# Pass --json to keep the results around for comparing one run with the next.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fakeservers import ImageServer, RedditServer
+
+# The arguments each mode adds to the scraper's command line.
+MODES = OrderedDict([
+    ('sync', []),
+    ('threads', ['-w', '8']),
+    ('listing', ['-w', '8', '--listing-workers', '4']),
+    ('async', ['-as']),
+    ('auto', ['-as', '--auto-concurrency']),
+    ('resolve', ['-w', '8', '-i']),
+])
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Marks the line a scraper process reports its results on.
+RESULT_PREFIX = 'BENCHMARK '
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmarks the scraper against local stand-in Reddit and "
+                                                 "image servers.")
+
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Comma separated modes to run, out of {} (default all).'.format(', '.join(MODES)))
+    parser.add_argument('--days', type=int, default=2, help='Days of submissions to scrape (default 2).')
+    parser.add_argument('--per-day', type=int, default=100, help='Submissions per day (default 100).')
+    parser.add_argument('--sizes', default='65536,262144,1048576',
+                        help='Comma separated image sizes in bytes, picked between per image.')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds the image server waits before answering (default 0.01).')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='Seconds the Reddit server waits before answering (default 0.05).')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Bytes per second per image connection, 0 for unlimited (default 0).')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of image requests answered with a 503 (default 0).')
+    parser.add_argument('--json', help='Also write the results to this file as JSON.')
+    parser.add_argument('--child', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+    return parser.parse_args(args)
+
+
+# Runs the scraper with scrape_args in this process, in the current directory, and prints what it
+# took.  Stands in the credentials Reddit would want, which the fake Reddit ignores.
+def run_scraper(scrape_args):
+    config = types.ModuleType('redditimagescraper.modules.config')
+    config.username = config.password = config.client_id = config.client_secret = 'benchmark'
+    config.extensions = EXTENSIONS
+    sys.modules[config.__name__] = config
+
+    import redditimagescraper.modules
+    redditimagescraper.modules.config = config
+    from redditimagescraper import scrape
+
+    started = time.monotonic()
+    scrape.main(scrape_args)
+    elapsed = time.monotonic() - started
+
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    peak_rss = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+    print(RESULT_PREFIX + json.dumps({'elapsed': elapsed, 'peak_rss': peak_rss}))
+
+
+# The value at fraction (0 to 1) of the way through values.
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Environment for a scraper process pointed at the fake reddit through a praw.ini kept in work, and
+# able to import the scraper from this checkout.
+def scraper_env(work, reddit):
+    praw_config = os.path.join(work, 'config')
+    os.makedirs(praw_config, exist_ok=True)
+
+    with open(os.path.join(praw_config, 'praw.ini'), 'w') as f:
+        f.write('[DEFAULT]\ncheck_for_updates=False\noauth_url={0}\nreddit_url={0}\n'.format(reddit.url))
+
+    env = dict(os.environ, XDG_CONFIG_HOME=praw_config,
+               PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(
+                   os.path.abspath(__file__))), os.environ.get('PYTHONPATH')])))
+    env.pop('APPDATA', None)
+    return env
+
+
+# Runs one mode in a fresh process and download directory, pointed at the fake Reddit through a
+# praw.ini of its own.  Returns its results.
+def run_mode(mode, scrape_args, reddit, images):
+    images.reset()
+    requests_before = reddit.requests
+
+    with tempfile.TemporaryDirectory() as work:
+        downloads = os.path.join(work, 'downloads')
+        os.makedirs(downloads)
+        env = scraper_env(work, reddit)
+
+        metrics_path = os.path.join(work, 'metrics.json')
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'] + scrape_args + MODES[mode] +
+                                ['--metrics-json', metrics_path],
+                                cwd=downloads, env=env, stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        result = json.loads(next(line for line in reversed(output.splitlines())
+                                 if line.startswith(RESULT_PREFIX))[len(RESULT_PREFIX):])
+
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+
+        files = [name for name in os.listdir(downloads) if not name.endswith('.part')]
+        size = sum(os.path.getsize(os.path.join(downloads, name)) for name in files)
+
+    elapsed = result['elapsed']
+    return OrderedDict([
+        ('mode', mode),
+        ('images', len(files)),
+        ('seconds', round(elapsed, 3)),
+        ('images_per_sec', round(len(files) / elapsed, 2)),
+        ('mb_per_sec', round(size / elapsed / 2 ** 20, 2)),
+        ('p50_latency', round(percentile(images.latencies, 0.5), 4)),
+        ('p99_latency', round(percentile(images.latencies, 0.99), 4)),
+        ('peak_rss_mb', round(result['peak_rss'] / 2 ** 20, 1)),
+        ('api_requests', reddit.requests - requests_before),
+        ('retries', metrics['counters'].get('retries', 0)),
+        ('metrics', metrics),
+    ])
+
+
+def main(args):
+    parser = parse_args(args)
+
+    if parser.child is not None:
+        run_scraper(parser.child)
+        return
+
+    modes = parser.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            sys.exit('Unknown mode {}, pick from {}.'.format(mode, ', '.join(MODES)))
+
+    # A range well in the past, so none of it is too new to be searched.
+    begin = datetime(2017, 1, 1)
+    end = begin + timedelta(days=parser.days)
+    last_day = end - timedelta(days=1)
+    scrape_args = ['-bd', '{}.{}.{}'.format(begin.month, begin.day, begin.year),
+                   '-ed', '{}.{}.{}'.format(last_day.month, last_day.day, last_day.year),
+                   '-sr', 'benchmark']
+
+    sizes = tuple(int(size) for size in parser.sizes.split(','))
+    with ImageServer(sizes, parser.latency, parser.bandwidth, parser.error_rate) as images, \
+            RedditServer(images.url, 'benchmark', begin, end, parser.per_day, parser.api_latency) as reddit:
+        print('{} submissions, {} of them images.'.format(len(reddit.submissions), reddit.matching(EXTENSIONS)))
+
+        results = list()
+        for mode in modes:
+            result = run_mode(mode, scrape_args, reddit, images)
+            results.append(result)
+            print('  '.join('{}={}'.format(key, value) for key, value in result.items() if key != 'metrics'))
+
+    if parser.json is not None:
+        with open(parser.json, 'w') as f:
+            json.dump({'args': vars(parser), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,245 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytz
+
+
+# Reddit's cloudsearch timestamps, and the created field on submissions, are eight hours ahead of UTC.
+CLOUDSEARCH_UTC_OFFSET = 28800
+
+# Most submissions Reddit hands back in one page of a listing.
+PAGE_SIZE = 100
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Quiet, keep-alive request handler.  Subclasses get the FakeServer they belong to as self.fake.
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode(), 'application/json; charset=UTF-8')
+
+
+# An HTTP server on a free local port, served from a daemon thread.  Use as a context manager, or
+# call start() and stop().  latency is seconds added to every response.
+class FakeServer:
+    handler = Handler
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        handler = type(self.handler.__name__, (self.handler,), {'fake': self})
+        self.server = ThreadingServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class ImageHandler(Handler):
+    def do_GET(self):
+        fake = self.fake
+        started = time.monotonic()
+        time.sleep(fake.latency)
+
+        if fake.fail():
+            self.send_body(503, b'', 'text/plain')
+            return
+
+        name = self.path.rsplit('/', 1)[-1]
+        image = fake.image(name)
+        offset = 0
+        status = 200
+        if 'Range' in self.headers:
+            offset = int(re.match(r'bytes=(\d+)-', self.headers['Range']).group(1))
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(image) - offset))
+        self.end_headers()
+
+        # Sent a chunk at a time so bandwidth can be held to the rate asked for.
+        chunk_size = 16 * 1024
+        for start in range(offset, len(image), chunk_size):
+            chunk = image[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if fake.bandwidth:
+                time.sleep(len(chunk) / fake.bandwidth)
+
+        fake.record(time.monotonic() - started, len(image) - offset)
+
+
+# Serves an image for any path ending in a file name.  Each name always gets the same bytes, and no
+# two names get the same bytes, with a size picked from sizes.  bandwidth is bytes per second per
+# connection (0 for as fast as possible) and error_rate the fraction of requests answered with a 503.
+# Keeps the time taken and bytes sent for every image served, in latencies and sent.
+class ImageServer(FakeServer):
+    handler = ImageHandler
+
+    def __init__(self, sizes=(256 * 1024,), latency=0, bandwidth=0, error_rate=0, seed=0):
+        super().__init__(latency)
+        self.sizes = sizes
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.body = bytes(self.random.getrandbits(8) for _ in range(max(sizes)))
+        self.latencies = list()
+        self.sent = 0
+
+    def image(self, name):
+        size = self.sizes[sum(name.encode()) % len(self.sizes)]
+        return (name.encode() + self.body)[:size]
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def record(self, latency, sent):
+        with self.lock:
+            self.latencies.append(latency)
+            self.sent += sent
+
+    # Forgets what has been served so far.
+    def reset(self):
+        with self.lock:
+            self.latencies = list()
+            self.sent = 0
+
+
+class RedditHandler(Handler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.fake.latency)
+
+        if urlparse(self.path).path != '/api/v1/access_token':
+            self.send_body(404, b'', 'text/plain')
+            return
+
+        with self.fake.lock:
+            self.fake.logins += 1
+        self.send_json({'access_token': 'benchmark', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*'})
+
+    def do_GET(self):
+        fake = self.fake
+        time.sleep(fake.latency)
+        with fake.lock:
+            fake.requests += 1
+
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        limit = min(int(params.get('limit', [PAGE_SIZE])[0]), PAGE_SIZE)
+        after = params.get('after', [None])[0]
+
+        if url.path.rstrip('/') == '/r/{}/new'.format(fake.subreddit):
+            etag = fake.etag()
+            if after is None and self.headers.get('If-None-Match') == etag:
+                self.send_body(304, b'', 'application/json; charset=UTF-8', [('ETag', etag)])
+                return
+            body = json.dumps(fake.listing(0, float('inf'), after, limit)).encode()
+            self.send_body(200, body, 'application/json; charset=UTF-8', [('ETag', etag)] if after is None else ())
+            return
+
+        if url.path.rstrip('/') != '/r/{}/search'.format(fake.subreddit):
+            self.send_body(404, b'', 'text/plain')
+            return
+
+        start, end = map(int, re.search(r'timestamp:(\d+)\.\.(\d+)', params['q'][0]).groups())
+        self.send_json(fake.listing(start, end, after, limit))
+
+
+# Stands in for the parts of Reddit's API the scraper uses: logging in, and cloudsearch and the new
+# listing over one subreddit.  The subreddit holds per_day submissions a day, evenly spread, from
+# begin to end (datetimes), and every fourth one links to a .gif so the extension filter has
+# something to drop.  Their urls point at image_url.  post() adds newer ones.  The new listing sends
+# an ETag for its first page and answers a matching If-None-Match with a 304.  Counts the listing
+# requests made in requests, and the tokens handed out in logins.
+class RedditServer(FakeServer):
+    handler = RedditHandler
+
+    def __init__(self, image_url, subreddit, begin, end, per_day=100, latency=0):
+        super().__init__(latency)
+        self.image_url = image_url
+        self.subreddit = subreddit
+        self.requests = 0
+        self.logins = 0
+
+        begin = int(pytz.utc.localize(begin).timestamp())
+        end = int(pytz.utc.localize(end).timestamp())
+        count = max(1, (end - begin) * per_day // 86400)
+
+        # Newest first, like Reddit.
+        self.submissions = [self.submission(n, begin + (end - begin) * n // count) for n in reversed(range(count))]
+
+    # The nth submission, counting from 0, posted at created_utc.
+    def submission(self, n, created_utc):
+        submission_id = '{:x}'.format(n + 1)
+        extension = '.gif' if n % 4 == 3 else '.jpg'
+        return {'id': submission_id, 'name': 't3_' + submission_id, 'title': submission_id,
+                'subreddit': self.subreddit, 'created_utc': float(created_utc),
+                'created': float(created_utc + CLOUDSEARCH_UTC_OFFSET),
+                'url': '{}/i/{}{}'.format(self.image_url, submission_id, extension)}
+
+    # Posts count more submissions, a second apart and newer than any already there.
+    def post(self, count):
+        with self.lock:
+            newest = int(self.submissions[0]['created_utc']) if self.submissions else 0
+            posted = len(self.submissions)
+            for n in range(count):
+                self.submissions.insert(0, self.submission(posted + n, newest + n + 1))
+
+    # ETag of the first page of the new listing, which changes whenever something is posted.
+    def etag(self):
+        with self.lock:
+            return '"{}"'.format(self.submissions[0]['name'] if self.submissions else 'empty')
+
+    # The submissions dated start to end, in Reddit's eight hours ahead time, as a Reddit listing page.
+    def listing(self, start, end, after, limit):
+        found = [submission for submission in self.submissions if start <= submission['created'] <= end]
+
+        names = [submission['name'] for submission in found]
+        if after in names:
+            found = found[names.index(after) + 1:]
+
+        page = found[:limit]
+        return {'kind': 'Listing',
+                'data': {'children': [{'kind': 't3', 'data': submission} for submission in page],
+                         'after': page[-1]['name'] if len(found) > limit else None,
+                         'before': None}}
+
+    # How many submissions in the subreddit have a url ending in one of exts.
+    def matching(self, exts):
+        return len([submission for submission in self.submissions if submission['url'].endswith(exts)])
+
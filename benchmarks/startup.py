@@ -0,0 +1,113 @@
+# Benchmarks how long the scraper takes to get going: the interpreter on its own, --help, importing
+# each of the scraper's modules, and a one day scrape against the stand-in Reddit (see bench.py)
+# started without and then with a cached access token.  Every measurement is taken in a fresh
+# process, repeat times, and the median kept.
+#
+#   python benchmarks/startup.py --repeat 10
+#
+# Pass --json to keep the results around for comparing one run with the next.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import bench
+from fakeservers import ImageServer, RedditServer
+
+# Modules timed importing on their own, cheapest first.
+MODULES = ['redditimagescraper.scrape', 'redditimagescraper.modules.resolve',
+           'redditimagescraper.modules.accessreddit', 'redditimagescraper.modules.async']
+
+# Stands in for config.py, which a fresh checkout doesn't have, ahead of the code being timed.
+STAND_IN_CONFIG = 'import sys, types; config = types.ModuleType("redditimagescraper.modules.config"); ' \
+                  'config.extensions = (".jpg", ".jpeg", ".png"); sys.modules[config.__name__] = config; '
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmarks the scraper's startup time.")
+
+    parser.add_argument('--repeat', type=int, default=5, help='Times to run each measurement (default 5).')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='Seconds the Reddit server waits before answering (default 0.05).')
+    parser.add_argument('--json', help='Also write the results to this file as JSON.')
+
+    return parser.parse_args(args)
+
+
+# Median seconds taken by running command to completion, over repeat fresh processes.
+def time_command(command, repeat, env=None, cwd=None):
+    times = list()
+    for _ in range(repeat):
+        started = time.monotonic()
+        subprocess.run(command, env=env, cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.monotonic() - started)
+
+    return statistics.median(times)
+
+
+# Times a one day scrape with an empty token cache and then with the token the first one saved.
+# Returns the results for both.
+def time_logins(repeat, api_latency):
+    begin = datetime(2017, 1, 1)
+    scrape_args = ['-bd', '1.1.2017', '-ed', '1.1.2017', '-sr', 'benchmark']
+
+    with ImageServer((1024,)) as images, \
+            RedditServer(images.url, 'benchmark', begin, datetime(2017, 1, 2), 10, api_latency) as reddit, \
+            tempfile.TemporaryDirectory() as work:
+        env = bench.scraper_env(work, reddit)
+        token_cache = os.path.join(work, 'token.json')
+        command = [sys.executable, os.path.abspath(bench.__file__), '--child'] + scrape_args + ['--token-cache', token_cache]
+
+        results = list()
+        for name, cached in (('cold_login', False), ('cached_token', True)):
+            times = list()
+            logins_before = reddit.logins
+            for _ in range(repeat):
+                if not cached and os.path.exists(token_cache):
+                    os.remove(token_cache)
+                started = time.monotonic()
+                subprocess.run(command, env=env, cwd=work, stdout=subprocess.DEVNULL, check=True)
+                times.append(time.monotonic() - started)
+
+            results.append(OrderedDict([('name', name), ('seconds', round(statistics.median(times), 4)),
+                                        ('logins', reddit.logins - logins_before)]))
+
+    return results
+
+
+def main(args):
+    parser = parse_args(args)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    baseline = time_command([sys.executable, '-c', 'pass'], parser.repeat, env)
+    results = [OrderedDict([('name', 'interpreter'), ('seconds', round(baseline, 4))])]
+
+    # Exits once the help is printed, same as python -m redditimagescraper.scrape --help.
+    code = STAND_IN_CONFIG + 'import runpy; sys.argv = ["scrape", "--help"]; ' \
+                             'runpy.run_module("redditimagescraper.scrape", run_name="__main__")'
+    results.append(OrderedDict([('name', 'help'), ('seconds', round(time_command(
+        [sys.executable, '-c', code], parser.repeat, env, root), 4))]))
+
+    for module in MODULES:
+        seconds = time_command([sys.executable, '-c', STAND_IN_CONFIG + 'import ' + module], parser.repeat, env, root)
+        results.append(OrderedDict([('name', 'import ' + module), ('seconds', round(seconds - baseline, 4))]))
+
+    results += time_logins(parser.repeat, parser.api_latency)
+
+    for result in results:
+        print('  '.join('{}={}'.format(key, value) for key, value in result.items()))
+
+    if parser.json is not None:
+        with open(parser.json, 'w') as f:
+            json.dump({'args': vars(parser), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,3 +6,7 @@ client_id = "xxxxxx"
 client_secret = "xxxxxx"
 
 extensions = ('.jpg', '.jpeg', '.png')
+
+# Needed by -i to look up imgur albums.  Register an application at https://api.imgur.com/oauth2/addclient
+# and paste its client id here in quotes.
+imgur_client_id = None
@@ -1,15 +1,77 @@
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import praw
 import prawcore.exceptions
+from requests.adapters import HTTPAdapter
 
 from . import config
+from .metrics import metrics, timed
+from .records import CLOUDSEARCH_UTC_OFFSET, matching
+from .throttle import TokenBucket
+from .tokencache import TokenCache
 
-# Returns a list of urls posted to the subreddit_name between start_date and end_date.
-# The list is in the form: [url, date_string], [url, date_string], [url, date_string], ... ]
-def subs_to_download(subreddit_name, date_list, exts, verbose):
 
+# Transport adapter for the praw session that takes a token from the shared budget before every
+# request it sends, so however many listing threads are running, Reddit sees at most the budgeted
+# number of requests per minute.  Its connection pool is sized to the number of threads.
+class RateLimitedAdapter(HTTPAdapter):
+    def __init__(self, budget, **kwargs):
+        self.budget = budget
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.budget.take()
+        return super().send(request, **kwargs)
+
+
+# Has reddit's session take its access token from the TokenCache while the cached one is still good,
+# and save every token it gets from Reddit there, so the next run needn't log in at all.  If Reddit
+# turns down a cached token (it was revoked, say) it is dropped and the request is made again after
+# logging in properly.
+def cache_tokens(reddit, cache):
+    core = reddit._core
+    authorizer = core._authorizer
+    key = '{}:{}'.format(config.client_id, config.username)
+    cached = [False]
+
+    token = cache.load(key)
+    if token is not None:
+        authorizer.access_token = token['access_token']
+        authorizer._expiration_timestamp = token['expires_at']
+        authorizer.scopes = set(token['scopes'])
+        cached[0] = True
+        metrics.count('tokens_reused')
+
+    refresh = authorizer.refresh
+    request = core.request
+
+    def refresh_and_save():
+        refresh()
+        cached[0] = False
+        cache.save(key, authorizer.access_token, authorizer._expiration_timestamp, authorizer.scopes)
+
+    def request_with_cached_token(*args, **kwargs):
+        try:
+            return request(*args, **kwargs)
+        except prawcore.exceptions.InvalidToken:
+            if not cached[0]:
+                raise
+            cached[0] = False
+            cache.forget(key)
+            authorizer._clear_access_token()
+            return request(*args, **kwargs)
+
+    authorizer.refresh = refresh_and_save
+    core.request = request_with_cached_token
+
+
+# Logs into Reddit.  Every request made through the returned client counts against a budget of
+# api_rate requests per minute, shared by all of the threads that use it.
+# Given a token_cache path, the access token is kept there between runs (see cache_tokens).
+def login(verbose, workers=1, api_rate=60, token_cache=None):
     if verbose:
         print("Logging into Reddit.")
         login_time = datetime.now()
@@ -20,48 +82,201 @@ def subs_to_download(subreddit_name, date_list, exts, verbose):
                          client_id=config.client_id,
                          user_agent="redditimagescraper, created by ardeaf")
 
+    # praw 4 has no hook for its requests session, so mount the adapter on it through the core.
+    adapter = RateLimitedAdapter(TokenBucket(api_rate / 60, api_rate), pool_maxsize=workers)
+    reddit._core._requestor.mount('https://', adapter)
+    reddit._core._requestor.mount('http://', adapter)
+
+    if token_cache is not None:
+        cache_tokens(reddit, TokenCache(token_cache))
+
     if verbose:
         print("Login complete, took {} seconds.".format((datetime.now() - login_time).total_seconds()))
 
-    ret_list = list()
+    return reddit
+
+
+# Reddit's search never returns more than this many results for one query.
+SEARCH_CAP = 1000
+
+DAY = 86400
+
+# Yields a Submission for each submission in the window (epoch start and end) whose url ends in exts.
+# If an index is given, windows it already covers are read back from it, and anything listed is stored in it.
+def window_submissions(subreddit, window, exts, verbose, index=None):
+    start_date, end_date = window
+
+    if index is not None and index.covers(subreddit.display_name, window):
+        yield from matching(index.submissions(subreddit.display_name, window), exts)
+        return
+
+    if verbose:
+        print("Retrieving submission urls dated {}".format(
+            datetime.utcfromtimestamp(start_date).strftime("%m/%d/%Y")))
+
+    listed = list()
+    for submission in timed('listing_window_seconds', subreddit.submissions(start=start_date, end=end_date)):
+        if index is not None:
+            listed.append(submission)
+        yield from matching([submission], exts)
+
+    if index is not None:
+        index.add(subreddit.display_name, window, listed)
+
+
+# Yields a Submission for each submission posted to subreddit_name since its high-water mark in
+# follower (see follow.Follower) whose url ends in exts, from the subreddit's new listing.  Only
+# pages as far back as the mark, so a subreddit with nothing new costs a single request.
+def new_submissions(reddit, subreddit_name, follower, exts, verbose):
+    if verbose:
+        print("Retrieving new submissions from /r/{}".format(subreddit_name))
+
+    yield from matching(follower.newer(subreddit_name, reddit.subreddit(subreddit_name).new(limit=None)), exts)
+
+
+# Lists the windows on a pool of threads and yields each window along with its submissions, in the
+# same order as date_list.  Only a couple of windows per thread are let run ahead of the one being
+# yielded, so a slow day doesn't leave the rest of the range piling up in memory.
+def windows_in_parallel(subreddit, date_list, exts, workers, verbose, index=None):
+    def list_window(window):
+        return list(window_submissions(subreddit, window, exts, verbose, index))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for window in date_list:
+            pending.append((window, executor.submit(list_window, window)))
+            if len(pending) >= workers * 2:
+                window, submissions = pending.popleft()
+                yield window, submissions.result()
+
+        while pending:
+            window, submissions = pending.popleft()
+            yield window, submissions.result()
+
+
+# Every submission in the window, newest first, from a single search query.  Unlike praw's
+# submissions() this doesn't keep re-querying past the search cap, so a window that comes back
+# with SEARCH_CAP results may have been cut short.
+def search_window(subreddit, window):
+    start, end = window
+    query = 'timestamp:{}..{}'.format(int(start) + CLOUDSEARCH_UTC_OFFSET, int(end) + CLOUDSEARCH_UTC_OFFSET)
+
+    started = time.monotonic()
+    submissions = list(subreddit.search(query, sort='new', syntax='cloudsearch', limit=None))
+    metrics.observe('listing_window_seconds', time.monotonic() - started)
+
+    return submissions
+
+
+# Walks begin to end (epoch seconds) in windows sized by how busy the subreddit turns out to be, and
+# yields each window along with the submissions in it.  Starts with a day.  A window that comes back
+# at the search cap was truncated, so it is thrown away and searched again at half the size, down to
+# min_size.  After a quiet window (under a quarter of the cap) the next one doubles, up to max_size,
+# so empty stretches are covered in a handful of calls; after a busy one (over half) it halves.
+def adaptive_windows(subreddit, begin, end, verbose, min_size=60, max_size=32 * DAY):
+    size = DAY
+    start = int(begin)
+
+    while start <= end:
+        window = [start, min(start + size - 1, int(end))]
+        submissions = search_window(subreddit, window)
+        found = len(submissions)
+
+        if verbose:
+            print("Searched {} to {}, found {} submissions.".format(
+                datetime.utcfromtimestamp(window[0]).strftime("%m/%d/%Y %H:%M:%S"),
+                datetime.utcfromtimestamp(window[1]).strftime("%m/%d/%Y %H:%M:%S"), found))
+
+        if found >= SEARCH_CAP and size > min_size:
+            size = max(min_size, size // 2)
+            continue
+
+        yield window, submissions
+        start = window[1] + 1
+
+        if found < SEARCH_CAP // 4:
+            size = min(max_size, size * 2)
+        elif found > SEARCH_CAP // 2:
+            size = max(min_size, size // 2)
+
+
+# adaptive_windows, but stretches the index already covers are read back from it a day at a time and
+# only the gaps between them are searched.  Everything searched is stored in the index.
+def indexed_adaptive_windows(subreddit, begin, end, verbose, index):
+    for start, stop, covered in index.segments(subreddit.display_name, begin, end):
+        if covered:
+            for day in range(int(start), int(stop) + 1, DAY):
+                window = [max(start, day), min(stop, day + DAY - 1)]
+                yield window, index.submissions(subreddit.display_name, window)
+            continue
+
+        for window, submissions in adaptive_windows(subreddit, start, stop, verbose):
+            index.add(subreddit.display_name, window, submissions)
+            yield window, submissions
+
+
+# Yields the urls posted to the subreddit_name between start_date and end_date, one window at a time,
+# as soon as each submission comes back from Reddit so downloading can start straight away.
+# By default the windows are the days in date_list; with more than one worker they are listed on that
+# many threads and still yielded in date order.  With adaptive the window sizes follow how many
+# submissions each search finds instead (see adaptive_windows), and workers is ignored.
+# Given a SubmissionIndex, only the windows it doesn't already cover are listed from Reddit; if it
+# covers everything, Reddit is never contacted at all.
+# Given a reddit client from login, it is used instead of logging in again; otherwise the login
+# keeps its token in token_cache, if given.
+# Each item is a Submission, in the form: [url, date_string]
+def subs_to_download(subreddit_name, date_list, exts, verbose, workers=1, api_rate=60, adaptive=False,
+                     index=None, reddit=None, token_cache=None):
+
+    # praw doesn't ask Reddit for a token until the first real request, so a range the index
+    # already covers never logs in.
+    if reddit is None:
+        reddit = login(verbose, workers, api_rate, token_cache)
     subreddit = reddit.subreddit(subreddit_name)
+    date_list = list(date_list)
 
     if verbose:
         retrieve_time = datetime.now()
         print("Retrieving submissions. Started at {}".format(time.strftime("%H:%M:%S")))
 
     # date_list has start and end time in epoch for each day between the days we are scraping.
-    for date in date_list:
-        start_date, end_date = date
+    # Keep track of how far we've got so we can pick up where we left off if the subreddit is invalid.
+    done_until = date_list[0][0] - 1
+    end = date_list[-1][1]
+    while True:
+        try:
+            if adaptive:
+                if index is not None:
+                    searched = indexed_adaptive_windows(subreddit, done_until + 1, end, verbose, index)
+                else:
+                    searched = adaptive_windows(subreddit, done_until + 1, end, verbose)
+                windows = ((window, matching(submissions, exts)) for window, submissions in searched)
+            elif workers > 1:
+                windows = windows_in_parallel(subreddit, [window for window in date_list if window[0] > done_until],
+                                              exts, workers, verbose, index)
+            else:
+                windows = ((window, window_submissions(subreddit, window, exts, verbose, index))
+                           for window in date_list if window[0] > done_until)
 
-        if verbose:
-            print("Retrieving submission urls dated {}".format(
-                datetime.utcfromtimestamp(start_date).strftime("%m/%d/%Y")))
-
-        submissions_request = subreddit.submissions(start=start_date, end=end_date)
-
-        while True:
-            try:
-                ret_list += [[submission.url,
-                              datetime.utcfromtimestamp(submission.created_utc).strftime('%Y%m%d_%H%M%S')]
-                             for submission in submissions_request
-                             if submission.url.endswith(exts)]
-                break
-
-            # Check if the subreddit exists
-            except prawcore.exceptions.Redirect and prawcore.exceptions.BadRequest as e:
-                if verbose:
-                    print("\n!! Exception Raised: {}".format(e))
-                retrieve_time = datetime.now()
-                subreddit_name = input("{} does not exist. Please re-enter a valid subreddit: ".format(subreddit_name))
+            for window, submissions in windows:
+                yield from submissions
+                done_until = window[1]
+            break
+
+        # Check if the subreddit exists
+        except (prawcore.exceptions.Redirect, prawcore.exceptions.BadRequest) as e:
+            if verbose:
+                print("\n!! Exception Raised: {}".format(e))
+            retrieve_time = datetime.now()
+            subreddit_name = input("{} does not exist. Please re-enter a valid subreddit: ".format(subreddit_name))
+            subreddit = reddit.subreddit(subreddit_name)
 
     if verbose:
         delta = (datetime.now() - retrieve_time).total_seconds()
         print("Retrieval of submissions from /r/{} took {} seconds.  Completed at {}".format(
               subreddit_name, str(delta), time.strftime("%H:%M:%S")))
 
-    return ret_list
-
 if __name__ == '__main__':
     print("Nothing to see here! Move along!")
     exit()
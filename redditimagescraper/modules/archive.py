@@ -0,0 +1,120 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from .metrics import metrics
+
+# Kinds of archive --archive can write.  Images are compressed already, so neither is compressed
+# again.
+ARCHIVE_FORMATS = ('tar', 'zip')
+
+# Downloads up to this size are held in memory on their way into an archive, bigger ones spill
+# into a temporary file.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+# A download on its way into an archive, with the async write() of an aiofiles file for fetch_image.
+class AsyncSpool:
+    def __init__(self, spool):
+        self.spool = spool
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.spool.close()
+
+    async def write(self, data):
+        self.spool.write(data)
+
+
+# Writes downloads into numbered archives in directory, prefix-00001.tar and on, instead of a file
+# each.  Once an archive reaches max_bytes the next download starts a new one, so each can be moved
+# or backed up as soon as it is done.  Downloads are written to a spool() and added whole with add(),
+# so archives only ever hold complete files, one after the other.  An archive is written as .part
+# and renamed once it is finished, and numbering carries on from archives already in directory.
+# Safe to share between threads.
+class ArchiveSink:
+    def __init__(self, directory, kind='tar', max_bytes=1024 ** 3, prefix='images', verbose=False):
+        if kind not in ARCHIVE_FORMATS:
+            raise ValueError('Unknown archive format {}, pick from {}.'.format(kind, ', '.join(ARCHIVE_FORMATS)))
+
+        self.directory = directory
+        self.kind = kind
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.archive = None
+        self.path = None
+        self.written = 0
+        self.number = 0
+
+    def spool(self):
+        return tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def spool_async(self):
+        return AsyncSpool(self.spool())
+
+    # Path of the numbered archive, finished or not.
+    def archive_path(self, number):
+        return os.path.join(self.directory, '{}-{:05d}.{}'.format(self.prefix, number, self.kind))
+
+    # Finishes the archive being written, if there is one, and starts the next.
+    def roll(self):
+        self.finish()
+
+        self.number += 1
+        while os.path.exists(self.archive_path(self.number)) or \
+                os.path.exists(self.archive_path(self.number) + '.part'):
+            self.number += 1
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = self.archive_path(self.number)
+        if self.kind == 'tar':
+            self.archive = tarfile.open(self.path + '.part', 'w', format=tarfile.PAX_FORMAT)
+        else:
+            self.archive = zipfile.ZipFile(self.path + '.part', 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self.written = 0
+
+    def finish(self):
+        if self.archive is None:
+            return
+
+        self.archive.close()
+        os.replace(self.path + '.part', self.path)
+        metrics.count('archives_written')
+        if self.verbose:
+            print('\t{} finished, {} bytes.'.format(self.path, self.written))
+        self.archive = None
+
+    # Adds the download written to spool, which should be at its end, to the archive as name.
+    def add(self, name, spool):
+        size = spool.tell()
+        spool.seek(0)
+        name = name.replace(os.sep, '/')
+
+        with self.lock:
+            if self.archive is None or (self.written and self.written + size > self.max_bytes):
+                self.roll()
+
+            if self.kind == 'tar':
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = time.time()
+                self.archive.addfile(info, spool)
+            else:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                with self.archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                    shutil.copyfileobj(spool, member)
+
+            self.written += size
+        metrics.count('files_archived')
+
+    def close(self):
+        with self.lock:
+            self.finish()
@@ -1,23 +1,234 @@
 import argparse
 import asyncio
+import hashlib
+import os
 import sys
 import time
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
+from functools import partial
+from urllib.parse import urlparse
 
 import aiofiles
 import aiohttp
 
 import redditimagescraper.scrape
-from . import accessreddit
+from . import asyncreddit
+from . import concurrency
+from . import dedup
+from . import dumps
+from . import filters
+from . import follow
+from . import index
+from .layout import FLAT, Layout
+from . import pipeline
+from . import postprocess
 from .config import extensions
+from .manifest import Manifest, part_name
+from .metrics import metrics, reporting
+from .throttle import HostThrottle, DownloadError, TransientError, RETRY_STATUSES, backoff, retry_after
+from .writer import BUFFER_SIZE, DiskWriter
+
+
+# Builds the one ClientSession that every download in a run shares.  The connector pools at most
+# max_concurrency sockets, keeps idle connections open for keepalive seconds so later requests to
+# the same host skip the TCP+TLS handshake, and caches DNS lookups.  Downloads get timeout seconds
+# to finish, from connecting to the last byte, before they are given up on and retried.
+def make_session(loop, max_concurrency, keepalive, timeout=redditimagescraper.scrape.download_timeout):
+    connector = aiohttp.TCPConnector(limit=max_concurrency, keepalive_timeout=keepalive,
+                                     use_dns_cache=True, loop=loop)
+
+    return aiohttp.ClientSession(connector=connector, loop=loop, read_timeout=timeout)
+
+
+# One download waiting in a DownloadScheduler: the [url, date_created] submission, its host, how
+# many times it has failed so far, the earliest loop time it may be tried and the loop time it
+# was handed out.  target, if not None, is the (layout, archive) it goes to in place of the
+# workers' own.
+class Job:
+    __slots__ = ('submission', 'host', 'attempt', 'not_before', 'started', 'target')
+
+    def __init__(self, submission, attempt=0, not_before=0, target=None):
+        self.submission = submission
+        self.host = urlparse(str(submission[0])).netloc
+        self.attempt = attempt
+        self.not_before = not_before
+        self.started = None
+        self.target = target
+
+
+# Hands downloads to the workers host by host, round robin.  A host only gets a download started
+# when it has fewer than per_host_limit in flight, its circuit breaker isn't open and its token
+# bucket has a token (see HostThrottle), so a slow, rate limited or dead host has its downloads
+# parked here instead of tying up workers.  Downloads that fail with a TransientError are put back
+# after a jittered exponential backoff (or the host's Retry-After), up to retries times.
+# put() waits while queue_size downloads are waiting, which holds the listing back.  Given a
+# ConcurrencyController, no more downloads than its limit are handed out at once, and it is told how
+# each one went so it can move the limit.
+class DownloadScheduler:
+    def __init__(self, throttle, per_host_limit, queue_size, retries, loop, controller=None):
+        self.throttle = throttle
+        self.per_host_limit = per_host_limit
+        self.queue_size = queue_size
+        self.retries = retries
+        self.loop = loop
+        self.controller = controller
+        self.hosts = OrderedDict()
+        self.in_flight = defaultdict(int)
+        self.running = 0
+        self.queued = 0
+        self.closed = False
+        self.changed = asyncio.Event(loop=loop)
+
+    # Wakes everyone waiting for a download to start, finish or be added.
+    def notify(self):
+        metrics.gauge('queue_depth', self.queued)
+        metrics.gauge('downloads_in_flight', self.running)
+        self.changed.set()
+        self.changed = asyncio.Event(loop=self.loop)
+
+    async def wait_for_change(self, timeout):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+
+    def add(self, job):
+        self.hosts.setdefault(job.host, deque()).append(job)
+        self.queued += 1
+        self.notify()
+
+    async def put(self, submission, target=None):
+        while self.queued >= self.queue_size:
+            await self.wait_for_change(None)
+
+        self.add(Job(submission, target=target))
+
+    # Waits until every download put so far has finished for good, retries included.
+    async def drained(self):
+        while self.queued or self.running:
+            await self.wait_for_change(None)
+
+    # No more downloads are coming from the listing.
+    def close(self):
+        self.closed = True
+        self.notify()
+
+    # Takes the next download that can start right now.  Returns (job, None) if there is one,
+    # otherwise (None, seconds until one might be ready), with None for seconds if only a
+    # download finishing or being added can change that.
+    def ready(self):
+        if self.controller is not None and self.running >= self.controller.limit:
+            return None, None
+
+        now = self.loop.time()
+        soonest = None
+
+        for host, jobs in list(self.hosts.items()):
+            if self.in_flight[host] >= self.per_host_limit:
+                continue
+
+            job = next((job for job in jobs if job.not_before <= now), None)
+            if job is None:
+                wait = min(job.not_before for job in jobs) - now
+            else:
+                wait = self.throttle.wait(job.submission[0])
+
+            if wait:
+                soonest = wait if soonest is None else min(soonest, wait)
+                continue
+
+            jobs.remove(job)
+            if jobs:
+                self.hosts.move_to_end(host)
+            else:
+                del self.hosts[host]
+
+            self.queued -= 1
+            self.in_flight[host] += 1
+            self.running += 1
+            job.started = now
+            self.notify()
+            return job, None
+
+        return None, soonest
+
+    # Waits for the next download that can start.  Returns None once the listing is closed and
+    # every download has finished for good.
+    async def get(self):
+        while True:
+            job, wait = self.ready()
+            if job is not None:
+                return job
+
+            if self.closed and not self.queued and not self.running:
+                return None
+
+            await self.wait_for_change(wait)
+
+    # Records how job went: error is None for success.  Returns True if it has been put back to
+    # try again later.
+    def done(self, job, error=None):
+        url = job.submission[0]
+        self.in_flight[job.host] -= 1
+        self.running -= 1
+        retrying = False
+
+        if self.controller is not None:
+            self.controller.record(self.loop.time() - job.started, isinstance(error, TransientError))
+
+        if error is None or not isinstance(error, TransientError):
+            self.throttle.success(url)
+        else:
+            self.throttle.failure(url, error.retry_after)
+
+            if job.attempt < self.retries:
+                delay = max(backoff(job.attempt), error.retry_after or 0)
+                self.add(Job(job.submission, job.attempt + 1, self.loop.time() + delay, job.target))
+                metrics.count('retries')
+                retrying = True
+
+        if error is not None and not retrying:
+            metrics.count('files_failed')
+
+        self.notify()
+        return retrying
 
 
 # Download image.  Function actually downloads every url and saves it onto disk.
 # Does not discriminate on what to download.  Saves file with the "date_created"
-# parameter and the url.
-async def fetch_image(url, date_created, verbose):
+# parameter and the url.  Given a ContentStore, a url downloaded before is linked
+# instead of fetched, and a file whose bytes we already have becomes a link to them.
+# The download goes to a .part file that is renamed once complete.  Given a Manifest,
+# files it has as complete are skipped and a .part left by an earlier run is resumed
+# with a Range request.  Raises TransientError for statuses worth retrying and
+# DownloadError for ones that aren't, before anything is written.
+# Given a ContentFilter, the download is checked against it from its headers and first
+# bytes as they arrive, and one it rejects is cut off there and raises filters.Rejected.
+# Given a directory, the file goes there instead of the current directory, in the subdirectory
+# layout picks.  Given an ArchiveSink, the download is spooled in memory and added to its archive
+# on a thread of the loop's default executor, and nothing is written on its own.  Otherwise it is
+# written through writer, a DiskWriter shared by the downloads, or one of its own if not given.
+# Returns the file's name if it was downloaded and kept as a file of its own, otherwise None.
+async def fetch_image(session, url, date_created, verbose, store=None, manifest=None, content_filter=None,
+                      directory=None, layout=FLAT, archive=None, writer=None):
 
-    filename = date_created + "_" + str(url).split('/')[-1]
+    name = layout.name(date_created, url)
+    filename = os.path.join(directory, name) if directory is not None else name
+    if archive is None:
+        layout.prepare(filename)
+
+    if manifest is not None and manifest.complete(name):
+        metrics.count('files_skipped')
+        if verbose:
+            print('\t{} already downloaded, skipping.'.format(filename))
+        return
+
+    if store is not None and store.link_url(url, filename):
+        metrics.count('files_linked')
+        if verbose:
+            print('\t{} already downloaded, linked.'.format(filename))
+        return
 
     # Shows what is being downloaded.
     if verbose:
@@ -27,28 +238,152 @@ async def fetch_image(url, date_created, verbose):
         print(msg_start.format(filename))
         dl_time = datetime.now()
 
-    # Opens url and a file using aiohttp and aiofiles.
-    # Reads the content 1024 chunks at a time so that content is downloaded
-    # and written to disk asynchronously. Normal file writing is I/O blocking.
-    loop = asyncio.get_event_loop()
+    part = part_name(filename)
+    offset = manifest.start(url, name) if manifest is not None else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+
+    # Opens url using the shared session and writes it out through the DiskWriter, which collects what
+    # arrives into big buffers and writes each on a thread of its own, so the loop never blocks on
+    # the disk.  Whatever has arrived is read off the socket at once, however much that is.
+    # Each chunk is hashed on its way past so the file never has to be read back.
+    own_writer = writer is None and archive is None
+    if own_writer:
+        writer = DiskWriter(asyncio.get_event_loop(), threads=1)
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    received = 0
+    try:
+        async with session.get(url, headers=headers, timeout=None) as response:
+            metrics.observe('first_byte_seconds', time.monotonic() - started)
+            if response.status in RETRY_STATUSES:
+                raise TransientError(url, 'HTTP {}'.format(response.status),
+                                     retry_after(response.headers.get('Retry-After')))
+            if response.status >= 400 and response.status != 416:
+                raise DownloadError(url, 'HTTP {}'.format(response.status))
+
+            # 206 means the server is sending the rest of the file, 416 that the .part already had all of it.
+            # Anything else is the whole file again.
+            if response.status not in (206, 416):
+                offset = 0
+
+            # Leaving the response before the end of its body closes the connection, so a rejected file
+            # stops downloading.  A 416's headers describe its error page, not the file, so only the size
+            # of the .part is checked.
+            check = content_filter.stream(url, offset) if content_filter is not None else None
+            if check is not None and response.status != 416:
+                content_filter.check_headers(url, response.headers, response.status)
+
+            # A whole new file has its space set aside up front, unless a .part cut short could be
+            # resumed from (see DiskWriter.open).
+            size = None
+            if response.status == 200 and manifest is None:
+                size = int(response.headers.get('Content-Length', 0)) or None
+
+            try:
+                async with archive.spool_async() if archive is not None else \
+                        writer.open(part, append=bool(offset), size=size) as file:
+                    # What an earlier run left is hashed a buffer at a time, however big it is.
+                    if offset and store is not None:
+                        async with aiofiles.open(part, mode='rb') as resumed:
+                            while True:
+                                chunk = await resumed.read(BUFFER_SIZE)
+                                if not chunk:
+                                    break
+                                digest.update(chunk)
 
-    async with aiohttp.ClientSession(loop=loop) as session:
-        async with session.get(url) as response:
-            async with aiofiles.open(filename, mode='wb') as file:
-                while True:
-                    chunk = await response.content.read(1024)
-                    if not chunk:
-                        break
-                    await file.write(chunk)
+                    try:
+                        while response.status != 416:
+                            chunk = await response.content.readany()
+                            if not chunk:
+                                break
+                            received += len(chunk)
+                            if check is not None:
+                                chunk = check.feed(chunk)
+                            digest.update(chunk)
+                            await file.write(chunk)
+
+                        if check is not None:
+                            chunk = check.finish()
+                            digest.update(chunk)
+                            await file.write(chunk)
+                    finally:
+                        metrics.count('bytes_downloaded', received)
+
+                    if archive is not None:
+                        await asyncio.get_event_loop().run_in_executor(None, archive.add, name, file.spool)
+            # A rejected file is never wanted, and without a manifest nothing resumes from a .part cut short.
+            except Exception as e:
+                if (isinstance(e, filters.Rejected) or manifest is None) and os.path.exists(part):
+                    os.remove(part)
+                raise
+
+        if archive is None:
+            await writer.replace(part, filename)
+            if manifest is not None:
+                manifest.finish(name)
+    finally:
+        # Every write has been waited for by now, so the loop needn't block joining the writer's thread.
+        if own_writer:
+            writer.close(wait=False)
+
+    metrics.observe('file_seconds', time.monotonic() - started)
+    metrics.count('files_downloaded')
+
+    kept = filename if archive is None else None
+    if kept is not None and store is not None and store.add(url, filename, digest.hexdigest()):
+        metrics.count('duplicates')
+        if verbose:
+            print('\t{} is a duplicate, linked.'.format(filename))
+        kept = None
 
     # Prints out how long each file took to download.
     # Timing times each co-routine with its own local variables, so there is no
     # mixing up of printing from other co-routines.
-    delta = (datetime.now() - dl_time).total_seconds()
     if verbose:
+        delta = (datetime.now() - dl_time).total_seconds()
         print(msg_end.format(filename, str(delta), time.strftime("%H:%M:%S")))
 
-    return
+    return kept
+
+
+# Downloads whatever the scheduler hands out until it says there is nothing left.  Only
+# max_concurrency of these run, so that is the most downloads ever in flight, fewer with
+# --auto-concurrency if the scheduler's controller says so.  A download that
+# fails for good is reported and skipped rather than taking the worker down with it, whatever
+# it failed with, and the scheduler always hears how each job went.
+# Files are written through writer, a DiskWriter shared by all of the workers, if given.
+async def download_worker(scheduler, session, verbose, store=None, manifest=None, content_filter=None,
+                          processor=None, directory=None, layout=FLAT, archive=None, writer=None):
+    while True:
+        job = await scheduler.get()
+        if job is None:
+            return
+        url, date_created = job.submission
+        job_layout, job_archive = job.target or (layout, archive)
+
+        error = None
+        try:
+            filename = await fetch_image(session, url, date_created, verbose, store, manifest, content_filter,
+                                         directory, job_layout, job_archive, writer)
+            if processor is not None and filename is not None:
+                await processor.process_async(filename, scheduler.loop, manifest)
+        except filters.Rejected as e:
+            metrics.count('files_rejected')
+            if verbose:
+                print("\n!! Skipped {}".format(e))
+        except asyncreddit.NETWORK_ERRORS as e:
+            error = TransientError(url, '{}: {}'.format(type(e).__name__, e))
+        except DownloadError as e:
+            error = e
+        except asyncio.CancelledError:
+            error = DownloadError(url, 'cancelled')
+            raise
+        except Exception as e:
+            # A full disk, say, or the processing pool going wrong.  Not worth retrying.
+            error = DownloadError(url, '{}: {}'.format(type(e).__name__, e))
+        finally:
+            if not scheduler.done(job, error) and error is not None and verbose:
+                print("\n!! Download of {} failed: {}".format(url, error))
 
 
 # Can easily expand amount of args using the verbosity as a baseline example.
@@ -62,17 +397,36 @@ def get_args(args):
 
     parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output.', default=False)
     parser.add_argument('subreddit', help='Subreddit you intend to scrape.')
-    parser.add_argument('begin_date', help='Begin date.')
-    parser.add_argument('end_date', help='End date.')
+    parser.add_argument('begin_date', nargs='?', help='Begin date. With --follow, how far back to go the first time.')
+    parser.add_argument('end_date', nargs='?', help='End date. Not used with --follow.')
+    parser.add_argument('--follow', metavar='FILE',
+                        help='Download whatever has been posted to the subreddits (comma separated) since the last '
+                             'run, keeping how far each has got in this SQLite file.')
+    parser.add_argument('--poll', type=float, default=0,
+                        help='With --follow, keep checking for new submissions every this many seconds.')
+    parser.add_argument('--parallel-jobs', type=int, default=4,
+                        help='With --follow, number of subreddits to list at once.')
+    redditimagescraper.scrape.add_arguments(parser)
 
     return parser.parse_args(args)
 
 # Main function.  Get the submissions from the subreddit between the
-# specified dates, and then run the parse function on each one.
+# specified dates, and then run the parse function on each one.  args is the command line, or the
+# options scrape.py already parsed (see scrape.async_args).
 async def work(args):
 
     # Get our args stored in parser.
-    args = get_args(args)
+    if not isinstance(args, argparse.Namespace):
+        args = get_args(args)
+
+    # Bad filter or processing options end the run with a message before anything is listed, as in scrape.main.
+    try:
+        content_filter = filters.make_filter(args.min_bytes, args.max_bytes, args.min_dimensions,
+                                             args.max_dimensions, args.formats)
+        processing = postprocess.processing_options(args.thumbnails, args.thumbnail_dir, args.strip_metadata,
+                                                    args.reencode, args.quality, args.similar is not None)
+    except ValueError as e:
+        sys.exit(str(e))
 
     # Get the args.
     verbose = args.verbose
@@ -80,13 +434,30 @@ async def work(args):
     begin_date = args.begin_date
     end_date = args.end_date
 
-    month_b, day_b, year_b = map(int, begin_date.split('.'))
-    month_e, day_e, year_e = map(int, end_date.split('.'))
+    # With --follow, begin_date is only how far back a subreddit's first run goes, and there's no end_date.
+    date_list = None
+    if begin_date is not None:
+        month_b, day_b, year_b = map(int, begin_date.split('.'))
+        month_e, day_e, year_e = map(int, (end_date or begin_date).split('.'))
+        date_list = redditimagescraper.scrape.convert_dates(year_b, month_b, day_b, year_e, month_e, day_e)
+
+    follower = None
+    if args.follow is not None:
+        followed = follow.subreddits(designated_sub_reddit)
+        marks = follow.HighWaterMarks(args.follow)
+        follower = follow.Follower(marks, date_list[0][0] if date_list else None)
+    elif end_date is None:
+        sys.exit('Give the subreddit, begin date and end date, or --follow.')
 
-    date_list = redditimagescraper.scrape.convert_dates(year_b, month_b, day_b, year_e, month_e, day_e)
+    submission_index = index.SubmissionIndex(args.index) if args.index is not None else None
 
-    # Gets the submissions we're going to download.
-    subs_to_download = accessreddit.subs_to_download(designated_sub_reddit, date_list, extensions, verbose)
+    # With --imgur every link is listed, and resolved into the images behind it on its way to the downloads.
+    # Resolving runs on requests, so it is only imported then.
+    exts, resolver = extensions, None
+    if args.imgur:
+        from . import resolve
+        exts = resolve.ALL_LINKS
+        resolver = resolve.make_resolver(extensions, args.link_cache, args.resolve_workers, verbose)
 
     if verbose:
         total_start_msg = 'Downloading started at {}'
@@ -94,14 +465,130 @@ async def work(args):
         total_dl_time_start = datetime.now()
         print(total_start_msg.format(time.strftime("%H:%M:%S")))
 
-    # Start throwing in the tasks for our loop to download.
-    tasks = [
-            asyncio.ensure_future(fetch_image(url, date_created, verbose))
-            for url, date_created in subs_to_download
-        ]
+    loop = asyncio.get_event_loop()
+
+    # The listing feeds the scheduler while the workers drain it, so downloads start with the first
+    # submission found.  It holds at most queue_size, so the listing waits whenever it gets too far ahead.
+    throttle = HostThrottle(args.host_rate, args.breaker_threshold, args.breaker_cooldown)
+    controller = concurrency.ConcurrencyController(args.min_concurrency, args.max_concurrency, clock=loop.time) \
+        if args.auto_concurrency else None
+    scheduler = DownloadScheduler(throttle, args.per_host_limit, args.queue_size, args.retries, loop, controller)
+
+    # Lists the submissions on the loop, over the same session as the downloads, handing each to put.
+    # --adaptive sizes its windows by how busy the subreddit is, which only the praw listing does, so
+    # that one runs a step at a time in the loop's executor instead, as does reading --dumps.
+    async def listing(session, put):
+        if args.dumps is not None:
+            subs_to_download = dumps.dump_submissions(dumps.dump_files(args.dumps, date_list[0][0], date_list[-1][1]),
+                                                      designated_sub_reddit, date_list[0][0], date_list[-1][1], exts,
+                                                      args.dump_workers or None, verbose)
+            await pipeline.produce(subs_to_download, put, loop)
+            return
+
+        if args.adaptive:
+            from . import accessreddit
+            subs_to_download = accessreddit.subs_to_download(designated_sub_reddit, date_list, exts, verbose,
+                                                             args.listing_workers, args.api_rate, True,
+                                                             submission_index, token_cache=args.token_cache)
+            await pipeline.produce(subs_to_download, put, loop)
+            return
+
+        client = asyncreddit.AsyncReddit(session, loop, args.api_rate, token_cache=args.token_cache, verbose=verbose)
+        await asyncreddit.subs_to_download(client, designated_sub_reddit, date_list, exts, put,
+                                           args.listing_workers, submission_index, verbose)
+
+    # listing (a coroutine function taking put) with --imgur resolving its links into images, and with
+    # --spill running on ahead into a SpillQueue rather than waiting on the scheduler.
+    def wrapped(listing):
+        if resolver is not None:
+            listing = partial(resolve.resolving, listing, resolver=resolver, workers=args.resolve_workers, loop=loop)
+        if args.spill:
+            listing = partial(pipeline.spill, listing, queue_size=args.queue_size, loop=loop)
+        return listing
+
+    # --follow: lists what is new in each followed subreddit, --parallel-jobs at a time, and waits for
+    # it all to download before moving the high-water marks on, again every --poll seconds if given.
+    # A subreddit whose listing fails is reported and tried again next round.
+    async def follow_subreddits(session):
+        client = asyncreddit.AsyncReddit(session, loop, args.api_rate, token_cache=args.token_cache, verbose=verbose)
+        listing_slots = asyncio.Semaphore(args.parallel_jobs, loop=loop)
+
+        async def list_new(name, put):
+            async with listing_slots:
+                try:
+                    submissions = await client.new_submissions(name, follower, exts)
+                except asyncreddit.ListingError as e:
+                    print("\n!! Listing new submissions from /r/{} failed: {}".format(name, e))
+                    return
+            for submission in submissions:
+                await put(submission)
+
+        def put_into(name, submission):
+            return scheduler.put(submission, targets[name])
+
+        while True:
+            started = loop.time()
+            await asyncio.gather(*[wrapped(partial(list_new, name))(partial(put_into, name)) for name in followed],
+                                 loop=loop)
+            await scheduler.drained()
+            follower.commit()
+
+            if not args.poll:
+                return
+            wait = max(0, args.poll - (loop.time() - started))
+            if verbose:
+                print("Checking again in {:.0f} seconds.".format(wait))
+            await asyncio.sleep(wait, loop=loop)
+
+    async def list_submissions(session):
+        try:
+            if follower is not None:
+                await follow_subreddits(session)
+            else:
+                await wrapped(partial(listing, session))(scheduler.put)
+        finally:
+            scheduler.close()
+
+    # One session and connection pool for the whole run, drained by a fixed number of workers.
+    store = dedup.ContentStore(args.dedup, args.link) if args.dedup is not None else None
+    directory = args.output_dir
+    manifest = Manifest(directory or os.getcwd()) if args.resume else None
+    # Followed subreddits each have their own layout and archives, handed to the workers with each download.
+    if follower is not None:
+        layout, sink = FLAT, None
+        targets = {name: (Layout(args.layout, name), redditimagescraper.scrape.archive_sink(args, directory, name))
+                   for name in followed}
+    else:
+        layout = Layout(args.layout, designated_sub_reddit)
+        sink = redditimagescraper.scrape.archive_sink(args, directory, designated_sub_reddit)
+        targets = dict()
+
+    # Thumbnailing, re-encoding and hashing run in a pool of processes, so they never hold up the loop.
+    processor = postprocess.PostProcessor(processing, args.process_workers or None, verbose=verbose,
+                                          near_duplicates=postprocess.near_duplicates(
+                                              args.similar, args.similar_distance, args.similar_action, verbose)) \
+        if processing is not None else None
+    writer = DiskWriter(loop, args.write_buffer * 1024, args.fsync)
+    async with make_session(loop, args.max_concurrency, args.keepalive, args.timeout) as session:
+        workers = [
+                asyncio.ensure_future(download_worker(scheduler, session, verbose, store, manifest, content_filter,
+                                                      processor, directory, layout, sink, writer))
+                for _ in range(args.max_concurrency)
+            ]
 
-    # This will make the loop wait for all of the tasks above to finish before finishing work()
-    await asyncio.wait(tasks)
+        # This will make the loop wait for the listing and all of the workers above to finish before finishing work()
+        with reporting(args.progress, args.metrics_json, args.metrics_prom):
+            try:
+                await asyncio.gather(list_submissions(session), *workers)
+            finally:
+                if processor is not None:
+                    await loop.run_in_executor(None, processor.close)
+                await loop.run_in_executor(None, writer.close)
+                for job_sink in [sink] + [target[1] for target in targets.values()]:
+                    if job_sink is not None:
+                        await loop.run_in_executor(None, job_sink.close)
+                if follower is not None:
+                    marks.close()
 
     if verbose:
         print(total_end_msg.format(time.strftime("%H:%M:%S"),(datetime.now() - total_dl_time_start).total_seconds()))
@@ -0,0 +1,320 @@
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+
+import aiohttp
+
+from . import config
+from .index import IndexedSubmission
+from .metrics import metrics
+from .records import CLOUDSEARCH_UTC_OFFSET, matching
+from .throttle import TokenBucket, RETRY_STATUSES, backoff, retry_after
+from .tokencache import TokenCache
+
+USER_AGENT = 'redditimagescraper, created by ardeaf'
+
+# Most submissions Reddit hands back in one page of a listing.
+PAGE_SIZE = 100
+
+# What aiohttp raises when a connection fails or drops part way through.  In aiohttp 1.x a dropped
+# connection and a garbled response don't derive from ClientError, so they are listed on their own.
+NETWORK_ERRORS = (aiohttp.ClientError, aiohttp.errors.DisconnectedError, aiohttp.errors.HttpProcessingError,
+                  asyncio.TimeoutError)
+
+
+# A listing request Reddit turned down, or kept failing, so the listing can't go on.
+class ListingError(Exception):
+    pass
+
+
+# Reddit sent a search off somewhere else, or turned it down, because the subreddit doesn't exist.
+class SubredditNotFound(ListingError):
+    pass
+
+
+# Where Reddit's API and login are, from praw.ini like praw itself, so a site set up there for praw
+# applies to this client as well.
+def reddit_urls():
+    from praw.config import Config
+
+    praw_config = Config('DEFAULT')
+    return praw_config.oauth_url, praw_config.reddit_url
+
+
+# Lists submissions from Reddit with aiohttp, on the same session and loop as the downloads, so
+# async mode never blocks its loop on the listing.  Logs in as the script app in config.py, keeping
+# its access token in token_cache if given, and logs in again whenever Reddit stops accepting it.
+# Requests take a token from a budget of api_rate a minute, and also hold off for as long as
+# Reddit's X-Ratelimit headers say once they are close to running out.  A 429 or 5xx is retried up
+# to retries times after its Retry-After or a jittered exponential backoff.
+class AsyncReddit:
+    def __init__(self, session, loop, api_rate=60, retries=5, token_cache=None, verbose=False, urls=None):
+        self.session = session
+        self.loop = loop
+        self.budget = TokenBucket(api_rate / 60, api_rate)
+        self.retries = retries
+        self.token_cache = TokenCache(token_cache) if token_cache is not None else None
+        self.verbose = verbose
+        self.oauth_url, self.reddit_url = urls or reddit_urls()
+        self.key = '{}:{}'.format(config.client_id, config.username)
+        self.access_token = None
+        self.logging_in = None
+        self.paused_until = 0
+
+    async def authorize(self):
+        if self.token_cache is not None:
+            token = self.token_cache.load(self.key)
+            if token is not None:
+                self.access_token = token['access_token']
+                metrics.count('tokens_reused')
+                return
+
+        if self.verbose:
+            print("Logging into Reddit.")
+
+        auth = aiohttp.BasicAuth(config.client_id, config.client_secret)
+        data = {'grant_type': 'password', 'username': config.username, 'password': config.password}
+        async with self.session.post(self.reddit_url + '/api/v1/access_token', auth=auth, data=data,
+                                     headers={'User-Agent': USER_AGENT}) as response:
+            if response.status != 200:
+                raise ListingError('Logging into Reddit failed: HTTP {}'.format(response.status))
+            token = await response.json()
+
+        if 'access_token' not in token:
+            raise ListingError('Logging into Reddit failed: {}'.format(token.get('error', token)))
+
+        self.access_token = token['access_token']
+        if self.token_cache is not None:
+            self.token_cache.save(self.key, self.access_token, time.time() + token['expires_in'],
+                                  token.get('scope', '').split())
+
+    # Logs in, unless it already has.  Requests that need a token while a login is under way all wait
+    # on that one login.
+    async def login(self):
+        if self.access_token is not None:
+            return
+        if self.logging_in is None or self.logging_in.done():
+            self.logging_in = asyncio.ensure_future(self.authorize(), loop=self.loop)
+        await asyncio.shield(self.logging_in, loop=self.loop)
+
+    # Forgets a token Reddit has turned down, so the next request logs in again.
+    def forget_token(self, token):
+        if self.access_token == token:
+            self.access_token = None
+            if self.token_cache is not None:
+                self.token_cache.forget(self.key)
+
+    # Waits for room in the budget, and for a pause Reddit's headers asked for to be over.
+    async def wait_for_budget(self):
+        while True:
+            wait = max(self.paused_until - self.loop.time(), 0) or self.budget.try_take()
+            if not wait:
+                return
+            await asyncio.sleep(wait, loop=self.loop)
+
+    # Pauses every request until Reddit's window resets once the headers say it is nearly used up.
+    def read_rate_limit(self, headers):
+        try:
+            remaining = float(headers['X-Ratelimit-Remaining'])
+            reset = float(headers['X-Ratelimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        if remaining < 1:
+            self.paused_until = max(self.paused_until, self.loop.time() + reset)
+            metrics.count('listing_pauses')
+
+    # The JSON Reddit gives back for path with params.
+    async def get(self, path, params):
+        return (await self.fetch(path, params))[0]
+
+    # The JSON Reddit gives back for path with params, and the response's headers.  headers are sent
+    # along with the request, and a 304 Not Modified for a conditional request gives None for the
+    # JSON.  A token Reddit turns down is swapped for a new one once.
+    async def fetch(self, path, params, headers=None):
+        attempt = 0
+        logged_in_again = False
+        while True:
+            await self.login()
+            await self.wait_for_budget()
+
+            token = self.access_token
+            sent = {'Authorization': 'bearer ' + token, 'User-Agent': USER_AGENT}
+            sent.update(headers or {})
+            error = None
+            try:
+                async with self.session.get(self.oauth_url + path, params=params, headers=sent,
+                                            allow_redirects=False) as response:
+                    self.read_rate_limit(response.headers)
+
+                    if response.status == 200:
+                        return await response.json(), response.headers
+                    if response.status == 304:
+                        return None, response.headers
+                    if response.status == 401 and not logged_in_again:
+                        self.forget_token(token)
+                        logged_in_again = True
+                        continue
+                    if response.status in (301, 302, 400, 404):
+                        raise SubredditNotFound('{}: HTTP {}'.format(path, response.status))
+                    if response.status not in RETRY_STATUSES:
+                        raise ListingError('{}: HTTP {}'.format(path, response.status))
+
+                    error = 'HTTP {}'.format(response.status)
+                    delay = retry_after(response.headers.get('Retry-After'))
+            except NETWORK_ERRORS as e:
+                error = e
+                delay = None
+
+            if attempt >= self.retries:
+                raise ListingError('{}: {}'.format(path, error))
+            metrics.count('listing_retries')
+            await asyncio.sleep(max(backoff(attempt), delay or 0), loop=self.loop)
+            attempt += 1
+
+    # Every submission in one cloudsearch query, a page at a time, newest first.
+    async def search(self, subreddit_name, start, end):
+        params = {'q': 'timestamp:{}..{}'.format(start, end), 'restrict_sr': 'on', 'sort': 'new',
+                  'syntax': 'cloudsearch', 't': 'all', 'limit': str(PAGE_SIZE)}
+        found = list()
+
+        while True:
+            page = (await self.get('/r/{}/search'.format(subreddit_name), params))['data']
+            found += [child['data'] for child in page['children']]
+            if not page.get('after') or not page['children']:
+                return found
+            params['after'] = page['after']
+
+    # The submissions posted to subreddit_name since its high-water mark in follower (see
+    # follow.Follower) whose url ends in exts, as records.Submissions, from the subreddit's new
+    # listing.  Only pages as far back as the mark.  The first page is asked for with the ETag Reddit
+    # sent for it last time, so a subreddit with nothing new can be answered with a bodiless 304.
+    async def new_submissions(self, subreddit_name, follower, exts):
+        mark = follower.mark(subreddit_name)
+        path = '/r/{}/new'.format(subreddit_name)
+        params = {'limit': str(PAGE_SIZE)}
+        headers = {'If-None-Match': mark.etag} if mark is not None and mark.etag else None
+        started = time.monotonic()
+
+        if self.verbose:
+            print("Retrieving new submissions from /r/{}".format(subreddit_name))
+
+        page, response_headers = await self.fetch(path, params, headers)
+        if page is None:
+            metrics.count('listings_not_modified')
+            return list()
+        etag = response_headers.get('ETag')
+
+        found = list()
+        while True:
+            children = [IndexedSubmission(child['data']['id'], child['data']['url'], child['data']['created_utc'])
+                        for child in page['data']['children']]
+            found += children
+            if not children or not page['data'].get('after') or follower.past(mark, children[-1]):
+                break
+            params['after'] = page['data']['after']
+            page = await self.get(path, params)
+
+        metrics.observe('listing_window_seconds', time.monotonic() - started)
+        return list(matching(follower.newer(subreddit_name, found, etag), exts))
+
+    # Every submission posted to subreddit_name in window (epoch start and end).  Searches the way
+    # praw's submissions() does: once a search runs out, the window is searched again up to the
+    # oldest submission found, until a search turns up nothing new, so windows busier than a single
+    # search can return are still listed in full.
+    async def window(self, subreddit_name, window):
+        start = max(int(window[0]) + CLOUDSEARCH_UTC_OFFSET, 0)
+        end = min(int(window[1]), int(time.time())) + CLOUDSEARCH_UTC_OFFSET
+        seen = set()
+        found = list()
+        started = time.monotonic()
+
+        while True:
+            new = [submission for submission in await self.search(subreddit_name, start, end)
+                   if submission['id'] not in seen]
+            if not new:
+                break
+            seen.update(submission['id'] for submission in new)
+            found += new
+            end = int(min(submission['created'] for submission in new))
+
+        metrics.observe('listing_window_seconds', time.monotonic() - started)
+        return [IndexedSubmission(submission['id'], submission['url'], submission['created_utc'])
+                for submission in found]
+
+    # The submissions in window whose url ends in exts, as records.Submissions.  Given a
+    # SubmissionIndex, a window it covers is read back from it, and one it doesn't is stored in it.
+    async def window_submissions(self, subreddit_name, window, exts, index=None):
+        if index is not None and index.covers(subreddit_name, window):
+            return list(matching(index.submissions(subreddit_name, window), exts))
+
+        if self.verbose:
+            print("Retrieving submission urls dated {}".format(time.strftime('%m/%d/%Y', time.gmtime(window[0]))))
+
+        submissions = await self.window(subreddit_name, window)
+        if index is not None:
+            index.add(subreddit_name, window, submissions)
+        return list(matching(submissions, exts))
+
+    # Lists the windows in date_list, workers at a time, and hands every submission whose url ends
+    # in exts to the put coroutine function in date order, waiting on it whenever the downloads fall
+    # behind.  listed(window), if given, is called once each window has been handed over in full.
+    async def produce(self, subreddit_name, date_list, exts, put, workers=1, index=None, listed=None):
+        pending = deque()
+
+        async def hand_over():
+            window, listing = pending.popleft()
+            for submission in await listing:
+                await put(submission)
+            if listed is not None:
+                listed(window)
+
+        try:
+            for window in date_list:
+                pending.append((window, asyncio.ensure_future(
+                    self.window_submissions(subreddit_name, window, exts, index), loop=self.loop)))
+                if len(pending) >= workers:
+                    await hand_over()
+
+            while pending:
+                await hand_over()
+        finally:
+            for _, listing in pending:
+                listing.cancel()
+
+
+# Async version of accessreddit.subs_to_download: hands every submission in subreddit_name dated in
+# date_list whose url ends in exts to the put coroutine function, listing workers windows at a time
+# with client.  If the subreddit doesn't exist it asks for another and carries on from the first
+# window not yet listed.
+async def subs_to_download(client, subreddit_name, date_list, exts, put, workers=1, index=None, verbose=False):
+    date_list = list(date_list)
+
+    if verbose:
+        retrieve_time = datetime.now()
+        print("Retrieving submissions. Started at {}".format(time.strftime("%H:%M:%S")))
+
+    done_until = date_list[0][0] - 1
+
+    def listed(window):
+        nonlocal done_until
+        done_until = window[1]
+
+    while True:
+        try:
+            await client.produce(subreddit_name, [window for window in date_list if window[0] > done_until], exts,
+                                 put, workers, index, listed)
+            break
+
+        except SubredditNotFound as e:
+            if verbose:
+                print("\n!! Exception Raised: {}".format(e))
+            retrieve_time = datetime.now()
+            subreddit_name = await client.loop.run_in_executor(
+                None, input, "{} does not exist. Please re-enter a valid subreddit: ".format(subreddit_name))
+
+    if verbose:
+        delta = (datetime.now() - retrieve_time).total_seconds()
+        print("Retrieval of submissions from /r/{} took {} seconds.  Completed at {}".format(
+              subreddit_name, str(delta), time.strftime("%H:%M:%S")))
@@ -0,0 +1,106 @@
+import time
+
+from .metrics import metrics
+
+# Seconds between adjustments.  Rounds with fewer finished downloads than this carry on until they
+# have them, so a slow link isn't judged on one or two files.
+INTERVAL = 1.0
+MIN_SAMPLES = 4
+
+# A round is worth keeping the extra downloads for if its throughput beats the best yet by at least
+# this much.
+GAIN = 0.05
+
+# The best throughput seen is let slip by this much a round, so a link that has got slower since
+# doesn't leave every round looking like a loss.
+DECAY = 0.99
+
+# More than this fraction of downloads failing with a connection error, timeout, 429 or 5xx halves
+# the limit.
+MAX_ERROR_RATE = 0.1
+
+# Files taking this many times longer than the quickest rounds did, with nothing to show for it in
+# throughput, means the downloads are just queueing behind each other.
+LATENCY_TOLERANCE = 1.5
+
+# Rounds held at the same limit before trying one more download, in case the link has more to give.
+PROBE_AFTER = 5
+
+
+# Decides how many downloads to have in flight from how the last few rounds went, between minimum
+# and maximum.  Starts at minimum and doubles every round throughput keeps going up (slow start).
+# Once it stops going up, the limit goes up by one at a time while throughput still improves, and
+# holds where it doesn't, trying one more every few rounds (additive increase).  It is cut by a
+# quarter when files start taking much longer than they did at the best throughput seen without
+# that getting any better, and by half when downloads start failing (multiplicative decrease).
+# Settles on about the fewest downloads that fill the link, which keeps per-file latency down on
+# slow links and still opens right up on fast ones.  Throughput is read from the bytes_downloaded
+# counter, so partial downloads count too.
+class ConcurrencyController:
+    def __init__(self, minimum=4, maximum=256, interval=INTERVAL, clock=time.monotonic, received=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.clock = clock
+        self.received = received or (lambda: metrics.counter('bytes_downloaded'))
+        self.limit = self.minimum
+        self.slow_start = True
+        self.best_throughput = None
+        self.best_latency = None
+        self.held = 0
+        self.start_round()
+        metrics.gauge('concurrency_limit', self.limit)
+
+    def start_round(self):
+        self.round_started = self.clock()
+        self.round_bytes = self.received()
+        self.finished = 0
+        self.failed = 0
+        self.seconds = 0
+
+    # Records a download that took seconds, and whether it failed in a way worth retrying.  Returns
+    # the limit, adjusted if the round is over.
+    def record(self, seconds, failed=False):
+        self.finished += 1
+        self.failed += failed
+        self.seconds += seconds
+
+        elapsed = self.clock() - self.round_started
+        if elapsed >= self.interval and self.finished >= MIN_SAMPLES:
+            self.adjust(elapsed)
+        return self.limit
+
+    def adjust(self, elapsed):
+        received = self.received()
+        # The counters were reset under us, so count this round from zero.
+        if received < self.round_bytes:
+            self.round_bytes = 0
+        throughput = (received - self.round_bytes) / elapsed
+        latency = self.seconds / self.finished
+        error_rate = self.failed / self.finished
+        held = 0
+
+        if error_rate > MAX_ERROR_RATE:
+            self.limit = self.limit // 2
+            self.slow_start = False
+            metrics.count('concurrency_decreases')
+        elif self.best_throughput is None or throughput > self.best_throughput * (1 + GAIN):
+            self.limit = self.limit * 2 if self.slow_start else self.limit + 1
+            self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        elif self.best_latency is not None and latency > self.best_latency * LATENCY_TOLERANCE:
+            self.limit = self.limit * 3 // 4
+            self.slow_start = False
+            metrics.count('concurrency_decreases')
+        elif self.held + 1 >= PROBE_AFTER:
+            self.limit += 1
+            self.slow_start = False
+        else:
+            held = self.held + 1
+            self.slow_start = False
+
+        self.held = held
+        self.limit = max(self.minimum, min(self.maximum, self.limit))
+        self.best_throughput = throughput if self.best_throughput is None else \
+            max(throughput, self.best_throughput * DECAY)
+        metrics.gauge('concurrency_limit', self.limit)
+        self.start_round()
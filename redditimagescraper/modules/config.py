@@ -0,0 +1,8 @@
+# Fill these out to gain access to Reddit's API.
+# Change filename to config.py and move into the modules folder.
+username = "xxxxxx"
+password = "xxxxxx"
+client_id = "xxxxxx"
+client_secret = "xxxxxx"
+
+extensions = ('.jpg', '.jpeg', '.png')
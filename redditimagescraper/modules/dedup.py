@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+
+
+# Content-addressed record of everything downloaded, kept in a SQLite file.  Maps the sha256 of each
+# distinct image to the first file it was saved as, and every url downloaded to that same file.
+# Later copies, whether the same url posted again or the same bytes under another url, are replaced
+# by a hard link (link='hard') or symlink (link='sym') to that first file, so each image is stored once.
+# Safe to share between download threads.
+class ContentStore:
+    def __init__(self, path, link='hard'):
+        self.link = link
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, path TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT)')
+
+    # Makes filename a link to existing, unless it already is that file.
+    def link_to(self, existing, filename):
+        if os.path.exists(filename) and os.path.samefile(existing, filename):
+            return
+
+        if os.path.lexists(filename):
+            os.remove(filename)
+
+        if self.link == 'sym':
+            os.symlink(os.path.relpath(existing, os.path.dirname(os.path.abspath(filename))), filename)
+        else:
+            os.link(existing, filename)
+
+    # The stored file for digest, or None if we don't have it or it has since been deleted.
+    def blob(self, digest):
+        row = self.connection.execute('SELECT path FROM blobs WHERE digest = ?', (digest,)).fetchone()
+
+        if row is not None and os.path.exists(row[0]):
+            return row[0]
+
+        return None
+
+    # If url has been downloaded before, links filename to what it downloaded and returns True so the
+    # caller can skip fetching it again.  Returns False if url still needs downloading.
+    def link_url(self, url, filename):
+        with self.lock:
+            row = self.connection.execute('SELECT digest FROM urls WHERE url = ?', (str(url),)).fetchone()
+            existing = self.blob(row[0]) if row is not None else None
+
+            if existing is None:
+                return False
+
+            self.link_to(existing, filename)
+            return True
+
+    # Records that url was downloaded to filename with the given sha256 hex digest.  If the same bytes
+    # are already stored, filename is swapped for a link to them and True is returned.
+    def add(self, url, filename, digest):
+        with self.lock, self.connection:
+            existing = self.blob(digest)
+            duplicate = existing is not None
+
+            if duplicate:
+                self.link_to(existing, filename)
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?)',
+                                        (digest, os.path.abspath(filename)))
+
+            self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?)', (str(url), digest))
+
+            return duplicate
+
+    def close(self):
+        self.connection.close()
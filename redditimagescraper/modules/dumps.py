@@ -0,0 +1,177 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from .metrics import metrics
+from .records import Submission
+
+# Bytes of decompressed dump handed to a parsing process at a time, give or take the rest of the
+# last line.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Pushshift's zstd dumps were compressed with a long window, which the decompressor has to be told
+# it may use.
+ZSTD_WINDOW = 2 ** 31
+
+# Monthly dump files are named like RS_2017-01.zst, for submissions, or RC_2017-01.bz2 for comments.
+MONTHLY = re.compile(r'R[SC]_(\d{4})-(\d{2})')
+
+
+# The fastest JSON parser installed: orjson, then ujson, then the standard library's.
+def json_parser():
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        import json
+        return json.loads
+
+
+# The zstandard module, for reading the dump at path.  Raises ValueError if it isn't installed.
+def zstandard(path):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('{} is zstd compressed, which needs zstandard installed: pip install zstandard'.format(path))
+    return zstandard
+
+
+# Opens the dump at path for reading its decompressed bytes, going by its extension: .zst (which
+# needs the zstandard package), .bz2, .xz, .gz, or anything else as plain NDJSON.
+def open_dump(path):
+    if path.endswith('.zst'):
+        reader = zstandard(path).ZstdDecompressor(max_window_size=ZSTD_WINDOW).stream_reader(open(path, 'rb'))
+        return io.BufferedReader(reader, CHUNK_SIZE)
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+# The dump files in paths, with directories replaced by the files in them, in name order.  Monthly
+# dumps (see MONTHLY) for months wholly outside begin to end (epoch seconds) are left out without
+# being opened.  Raises ValueError if a path doesn't exist, or there are zstd dumps and zstandard
+# isn't installed.
+def dump_files(paths, begin, end):
+    first = datetime.utcfromtimestamp(begin).strftime('%Y-%m')
+    last = datetime.utcfromtimestamp(end).strftime('%Y-%m')
+    found = list()
+
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, name))))
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            raise ValueError('{} is not a dump file or a directory of them.'.format(path))
+
+    files = list()
+    for path in found:
+        month = MONTHLY.search(os.path.basename(path))
+        if month is not None and not first <= '{}-{}'.format(*month.groups()) <= last:
+            continue
+        if path.endswith('.zst'):
+            zstandard(path)
+        files.append(path)
+    return files
+
+
+# Yields the decompressed bytes of dump a chunk of whole lines at a time.
+def chunks(dump):
+    rest = b''
+    while True:
+        block = dump.read(CHUNK_SIZE)
+        if not block:
+            break
+        metrics.count('dump_bytes_read', len(block))
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        if cut:
+            yield block[:cut]
+            rest = block[cut:]
+        else:
+            rest = block
+    if rest:
+        yield rest
+
+
+# The url and created_utc of each submission in chunk (lines of NDJSON) posted to subreddit between
+# begin and end (epoch seconds) whose url ends in exts, as tuples, in the order they come in.  Only
+# the lines a regular expression finds subreddit's name in are parsed at all, so the rest of the
+# dump never leaves C.  Self posts and lines that aren't a submission are skipped.  Run in the
+# parsing processes, so it takes and returns only what pickles cheaply.
+def parse_chunk(chunk, subreddit, begin, end, exts):
+    loads = json_parser()
+    name = re.compile(b'"subreddit":\\s*"' + re.escape(subreddit.encode('utf-8')) + b'"', re.IGNORECASE)
+    subreddit = subreddit.lower()
+    found = list()
+    line_end = 0
+
+    for match in name.finditer(chunk):
+        # Another match on a line already looked at.
+        if match.start() < line_end:
+            continue
+        line_start = chunk.rfind(b'\n', 0, match.start()) + 1
+        line_end = chunk.find(b'\n', match.end())
+        if line_end < 0:
+            line_end = len(chunk)
+
+        try:
+            submission = loads(chunk[line_start:line_end])
+            created_utc = int(float(submission['created_utc']))
+            url = submission['url']
+        except (ValueError, KeyError, TypeError):
+            continue
+
+        if str(submission.get('subreddit', '')).lower() != subreddit or submission.get('is_self') or \
+                not begin <= created_utc <= end or not isinstance(url, str) or not url.endswith(exts):
+            continue
+        found.append((url, created_utc))
+
+    return found
+
+
+# Yields a Submission for each submission in the dump files (see dump_files) posted to subreddit
+# between begin and end whose url ends in exts, in the order the dumps have them, without going near
+# Reddit.  Decompression runs here, a chunk at a time, while parsing is spread over workers
+# processes (one per core if None).  Only a couple of chunks per process are let get ahead of the
+# one being yielded, so memory stays flat however big the dumps are.
+def dump_submissions(files, subreddit, begin, end, exts, workers=None, verbose=False):
+    workers = workers or os.cpu_count() or 1
+    exts = tuple(exts)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def finished():
+            for url, created_utc in pending.popleft().result():
+                metrics.count('submissions_listed')
+                yield Submission(url, created_utc)
+
+        for path in files:
+            if verbose:
+                print("Reading submissions from {}".format(path))
+
+            with open_dump(path) as dump:
+                for chunk in chunks(dump):
+                    pending.append(executor.submit(parse_chunk, chunk, subreddit, begin, end, exts))
+                    if len(pending) >= workers * 2:
+                        yield from finished()
+
+        while pending:
+            yield from finished()
@@ -0,0 +1,209 @@
+import struct
+
+from .throttle import DownloadError
+
+# The most of the start of a file held back while working out its format and dimensions.  A JPEG
+# whose dimensions aren't found by then is let through on its size and format alone.
+HEAD_SIZE = 64 * 1024
+
+# Formats told apart by their magic bytes, and other names they go by in --formats.
+FORMATS = ('jpeg', 'png', 'gif', 'webp', 'bmp')
+ALIASES = {'jpg': 'jpeg'}
+
+# Content types a server might send an image as without saying which kind.
+UNTYPED = ('application/octet-stream', 'binary/octet-stream')
+
+# JPEG start of frame markers, which hold the dimensions.  C4, C8 and CC are other segments.
+JPEG_FRAMES = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+# A download that isn't wanted, found out from its headers or first bytes.  Nothing is saved for
+# it and it isn't retried.
+class Rejected(DownloadError):
+    pass
+
+
+# Width and height of the JPEG in head, from its first start of frame segment, or None if head
+# ends before getting there.
+def jpeg_dimensions(head):
+    i = 2
+    while i + 9 <= len(head):
+        if head[i] != 0xFF:
+            return None
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in JPEG_FRAMES:
+            height, width = struct.unpack('>HH', head[i + 5:i + 9])
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+    return None
+
+
+# The format of the file that starts with head, and its (width, height) if head goes far enough
+# to tell.  Returns (None, None) for anything that isn't one of FORMATS.
+def image_info(head):
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg', jpeg_dimensions(head)
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png', struct.unpack('>II', head[16:24]) if len(head) >= 24 else None
+
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif', struct.unpack('<HH', head[6:10]) if len(head) >= 10 else None
+
+    if head.startswith(b'BM') and len(head) >= 26:
+        width, height = struct.unpack('<ii', head[18:26])
+        return 'bmp', (width, abs(height))
+
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        kind = head[12:16]
+        if kind == b'VP8 ' and len(head) >= 30:
+            width, height = struct.unpack('<HH', head[26:30])
+            return 'webp', (width & 0x3FFF, height & 0x3FFF)
+        if kind == b'VP8L' and len(head) >= 25:
+            bits = struct.unpack('<I', head[21:25])[0]
+            return 'webp', ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+        if kind == b'VP8X' and len(head) >= 30:
+            return 'webp', (int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+        return 'webp', None
+
+    return None, None
+
+
+# Size in bytes of the whole file a response with status and headers is for, or None if it doesn't
+# say.  A 206 gives it in Content-Range, anything else in Content-Length.
+def total_size(headers, status):
+    if status == 206:
+        total = (headers.get('Content-Range') or '').rpartition('/')[2]
+    else:
+        total = headers.get('Content-Length') or ''
+    return int(total) if total.isdigit() else None
+
+
+# Parses WIDTHxHEIGHT, like 640x480, into (width, height).  Raises ValueError for anything else.
+def parse_dimensions(text):
+    width, x, height = text.lower().partition('x')
+    if not x or not width.isdigit() or not height.isdigit():
+        raise ValueError('{} should be a width and height like 640x480.'.format(text))
+    return int(width), int(height)
+
+
+# Which downloads are wanted: files between min_bytes and max_bytes, images between min_dimensions
+# and max_dimensions ((width, height), either side of which may be 0 for no limit) and in one of
+# formats.  Limits of 0 or None aren't checked.  Whatever the limits, only files that really are one
+# of FORMATS get through, not just ones whose url says so.
+class ContentFilter:
+    def __init__(self, min_bytes=0, max_bytes=0, min_dimensions=None, max_dimensions=None, formats=None):
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.min_dimensions = min_dimensions or (0, 0)
+        self.max_dimensions = max_dimensions or (0, 0)
+        self.formats = tuple(formats) if formats else FORMATS
+
+    # Rejects a response whose headers say it is the wrong size or not an image at all.
+    def check_headers(self, url, headers, status):
+        content_type = (headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type and not content_type.startswith('image/') and content_type not in UNTYPED:
+            raise Rejected(url, 'served as {}'.format(content_type))
+
+        size = total_size(headers, status)
+        if size is not None:
+            self.check_size(url, size)
+            if size < self.min_bytes:
+                raise Rejected(url, '{} bytes, under the {} byte minimum'.format(size, self.min_bytes))
+
+    # Rejects a file once size bytes of it is over max_bytes, whatever the headers said.
+    def check_size(self, url, size):
+        if self.max_bytes and size > self.max_bytes:
+            raise Rejected(url, 'over the {} byte maximum'.format(self.max_bytes))
+
+    # Rejects a file whose first bytes, head, aren't an image in formats and in the dimensions
+    # allowed.  Dimensions head doesn't go far enough to tell aren't checked.
+    def check_head(self, url, head):
+        found, dimensions = image_info(head)
+        if found is None:
+            raise Rejected(url, 'not an image')
+        if found not in self.formats:
+            raise Rejected(url, 'a {}, not one of {}'.format(found, ', '.join(self.formats)))
+
+        if dimensions is not None:
+            width, height = dimensions
+            min_width, min_height = self.min_dimensions
+            max_width, max_height = self.max_dimensions
+            if width < min_width or height < min_height or (max_width and width > max_width) or \
+                    (max_height and height > max_height):
+                raise Rejected(url, '{}x{} is outside the dimensions allowed'.format(width, height))
+
+    # A StreamCheck for a download of url starting offset bytes into the file.
+    def stream(self, url, offset=0):
+        return StreamCheck(self, url, offset)
+
+
+# Runs a ContentFilter over a download as it arrives.  Each chunk goes through feed(), which hands
+# back what can be written so far, and finish() hands back the rest once the download is over.  The
+# start of the file is held back until check_head() has passed it, so a rejected file never has
+# anything written.  A download resumed part way through was checked when it started, so only its
+# size is.
+class StreamCheck:
+    def __init__(self, content_filter, url, offset=0):
+        self.filter = content_filter
+        self.url = url
+        self.received = offset
+        self.head = b'' if not offset else None
+
+    # Checks the head once it's long enough to tell the format, and the dimensions if it has them.
+    def decided(self):
+        if len(self.head) >= HEAD_SIZE:
+            return True
+        if len(self.head) < 32:
+            return False
+        found, dimensions = image_info(self.head)
+        return found is None or dimensions is not None
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        self.filter.check_size(self.url, self.received)
+
+        if self.head is None:
+            return chunk
+
+        self.head += chunk
+        if not self.decided():
+            return b''
+
+        self.filter.check_head(self.url, self.head)
+        head, self.head = self.head, None
+        return head
+
+    def finish(self):
+        head = b''
+        if self.head is not None:
+            self.filter.check_head(self.url, self.head)
+            head, self.head = self.head, None
+
+        if self.received < self.filter.min_bytes:
+            raise Rejected(self.url, '{} bytes, under the {} byte minimum'.format(self.received,
+                                                                                 self.filter.min_bytes))
+        return head
+
+
+# Builds the ContentFilter for the command line's --min-bytes, --max-bytes, --min-dimensions,
+# --max-dimensions and --formats, or None if none of them were given.  Raises ValueError for
+# dimensions or formats it can't make sense of.
+def make_filter(min_bytes=0, max_bytes=0, min_dimensions=None, max_dimensions=None, formats=None):
+    if not (min_bytes or max_bytes or min_dimensions or max_dimensions or formats):
+        return None
+
+    if formats:
+        formats = [ALIASES.get(name, name) for name in formats.lower().replace(' ', '').split(',') if name]
+        unknown = [name for name in formats if name not in FORMATS]
+        if unknown:
+            raise ValueError('Unknown format {}, pick from {}.'.format(', '.join(unknown), ', '.join(FORMATS)))
+
+    return ContentFilter(min_bytes, max_bytes, parse_dimensions(min_dimensions) if min_dimensions else None,
+                         parse_dimensions(max_dimensions) if max_dimensions else None, formats)
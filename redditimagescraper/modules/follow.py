@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# The newest submission --follow has seen in a subreddit, by its id and created_utc, plus the ETag
+# Reddit sent with the first page of the subreddit's new listing, if it sent one.
+Mark = namedtuple('Mark', ['id', 'created_utc', 'etag'])
+
+
+# On-disk high-water marks for --follow, one per subreddit, so each run only fetches what was posted
+# since the last.  Safe to share between threads.
+class HighWaterMarks:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS marks (subreddit TEXT PRIMARY KEY, id TEXT, '
+                                    'created_utc REAL, etag TEXT, updated REAL)')
+
+    def get(self, subreddit):
+        with self.lock:
+            row = self.connection.execute('SELECT id, created_utc, etag FROM marks WHERE subreddit = ?',
+                                          (subreddit.lower(),)).fetchone()
+        return Mark(*row) if row is not None else None
+
+    def set(self, subreddit, mark):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO marks VALUES (?, ?, ?, ?, ?)',
+                                    (subreddit.lower(), mark.id, mark.created_utc, mark.etag, time.time()))
+
+    def close(self):
+        self.connection.close()
+
+
+# Cuts each subreddit's new listing (newest first) off at its high-water mark, so only submissions
+# posted since the last run come through.  A subreddit followed for the first time goes back as far
+# as the listing does, which Reddit stops at about 1000 submissions, or to floor (epoch seconds) if
+# given.  The new marks are only written by commit(), once everything listed has been downloaded,
+# so a run that dies part way lists the same submissions again next time.
+class Follower:
+    def __init__(self, marks, floor=None):
+        self.marks = marks
+        self.floor = floor
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    # subreddit's mark, counting any not yet committed, or None if it hasn't been followed before.
+    def mark(self, subreddit):
+        with self.lock:
+            if subreddit.lower() in self.pending:
+                return self.pending[subreddit.lower()]
+        return self.marks.get(subreddit)
+
+    # Whether submission (anything with an id and created_utc) is where a new listing cut off at mark
+    # stops.
+    def past(self, mark, submission):
+        if mark is not None and (submission.id == mark.id or submission.created_utc < mark.created_utc):
+            return True
+        return self.floor is not None and submission.created_utc < self.floor
+
+    # Yields the submissions in listing (newest first) that are newer than subreddit's mark, and
+    # keeps the newest of them, with etag, for commit().
+    def newer(self, subreddit, listing, etag=None):
+        mark = self.mark(subreddit)
+        newest = None
+
+        for submission in listing:
+            if self.past(mark, submission):
+                break
+            if newest is None:
+                newest = submission
+            yield submission
+
+        if newest is not None:
+            self.keep(subreddit, Mark(newest.id, newest.created_utc, etag))
+        elif mark is not None and etag is not None and etag != mark.etag:
+            self.keep(subreddit, mark._replace(etag=etag))
+
+    def keep(self, subreddit, mark):
+        with self.lock:
+            self.pending[subreddit.lower()] = mark
+
+    # Writes the marks kept since the last commit.
+    def commit(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        for subreddit, mark in pending.items():
+            self.marks.set(subreddit, mark)
+
+
+# The subreddits named in -sr for --follow: comma separated, without any /r/.
+def subreddits(names):
+    found = list()
+    for name in names.split(','):
+        name = name.strip().strip('/')
+        if name.lower().startswith('r/'):
+            name = name[2:]
+        if name and name not in found:
+            found.append(name)
+    return found
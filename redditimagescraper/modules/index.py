@@ -0,0 +1,98 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+# What the index keeps of each submission.  Has the url and created_utc that the listing needs,
+# same as a praw submission.
+IndexedSubmission = namedtuple('IndexedSubmission', ['id', 'url', 'created_utc'])
+
+# A window only counts as complete once it ended at least this many seconds ago, so today's
+# submissions, and any Reddit hasn't finished indexing for search yet, get listed again next run.
+SETTLE_TIME = 3600
+
+
+# On-disk index of every submission we have listed, along with which stretches of time have been
+# listed completely for each subreddit.  Windows that are already covered can be read back from here
+# instead of asking Reddit again.  Safe to share between listing threads.
+class SubmissionIndex:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS submissions '
+                                    '(id TEXT PRIMARY KEY, subreddit TEXT, url TEXT, created_utc REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS submissions_by_date '
+                                    'ON submissions (subreddit, created_utc)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS windows '
+                                    '(subreddit TEXT, start REAL, end REAL)')
+
+    # Whether every submission in window has been listed and stored.
+    def covers(self, subreddit, window):
+        start, end = window
+
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM windows WHERE subreddit = ? AND start <= ? AND end >= ?',
+                                           (subreddit.lower(), start, end)).fetchone() is not None
+
+    # Splits begin to end into consecutive [start, end, covered] pieces, covered or not by the index.
+    def segments(self, subreddit, begin, end):
+        with self.lock:
+            windows = self.connection.execute('SELECT start, end FROM windows '
+                                              'WHERE subreddit = ? AND end >= ? AND start <= ? ORDER BY start',
+                                              (subreddit.lower(), begin, end)).fetchall()
+
+        segments = list()
+        cursor = begin
+        for start, stop in windows:
+            if start > cursor:
+                segments.append([cursor, math.ceil(start) - 1, False])
+            segments.append([max(cursor, start), min(stop, end), True])
+            cursor = math.floor(stop) + 1
+
+        if cursor <= end:
+            segments.append([cursor, end, False])
+
+        return segments
+
+    # The stored submissions in window, newest first like Reddit returns them.
+    def submissions(self, subreddit, window):
+        start, end = window
+
+        with self.lock:
+            rows = self.connection.execute('SELECT id, url, created_utc FROM submissions '
+                                           'WHERE subreddit = ? AND created_utc BETWEEN ? AND ? '
+                                           'ORDER BY created_utc DESC',
+                                           (subreddit.lower(), start, end)).fetchall()
+
+        return [IndexedSubmission(*row) for row in rows]
+
+    # Stores every submission listed in window and, if the window is over, marks it as covered.
+    # Marked windows that overlap or touch it are merged into one so a range listed a day at a
+    # time is still recognised as covered when it's asked for in one go.
+    def add(self, subreddit, window, submissions):
+        subreddit = subreddit.lower()
+        start, end = window
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?)',
+                                        [(submission.id, subreddit, submission.url, submission.created_utc)
+                                         for submission in submissions])
+
+            if end > time.time() - SETTLE_TIME:
+                return
+
+            touching = self.connection.execute('SELECT rowid, start, end FROM windows '
+                                               'WHERE subreddit = ? AND start <= ? AND end >= ?',
+                                               (subreddit, end + 1, start - 1)).fetchall()
+            for rowid, other_start, other_end in touching:
+                start, end = min(start, other_start), max(end, other_end)
+                self.connection.execute('DELETE FROM windows WHERE rowid = ?', (rowid,))
+
+            self.connection.execute('INSERT INTO windows VALUES (?, ?, ?)', (subreddit, start, end))
+
+    def close(self):
+        self.connection.close()
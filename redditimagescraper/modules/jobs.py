@@ -0,0 +1,45 @@
+import json
+import os
+from collections import namedtuple
+
+
+# One subreddit and date range to scrape, and the directory its images go in.  Dates are M.D.YYYY,
+# the same as -bd and -ed.
+Job = namedtuple('Job', ['subreddit', 'begin_date', 'end_date', 'output'])
+
+
+# Reads a list of jobs from a JSON file, or YAML if it ends in .yaml or .yml (which needs PyYAML).
+# Either a list of jobs or a mapping with the list under 'jobs'.  Each job has subreddit, begin
+# and end, and optionally output, which defaults to a directory named after the subreddit.
+# Raises ValueError if the file doesn't hold jobs like that.
+def load_jobs(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('{} is YAML, which needs PyYAML installed: pip install pyyaml'.format(path))
+            found = yaml.safe_load(f)
+        else:
+            found = json.load(f)
+
+    if isinstance(found, dict):
+        found = found.get('jobs')
+    if not isinstance(found, list) or not found:
+        raise ValueError('{} should hold a list of jobs.'.format(path))
+
+    jobs = list()
+    for number, job in enumerate(found, 1):
+        if not isinstance(job, dict) or not all(job.get(field) for field in ('subreddit', 'begin', 'end')):
+            raise ValueError('Job {} in {} needs a subreddit, begin and end.'.format(number, path))
+
+        for field in ('begin', 'end'):
+            parts = str(job[field]).split('.')
+            if len(parts) != 3 or not all(part.isdigit() for part in parts):
+                raise ValueError('Job {} in {} has {} {}, dates should look like 1.31.2017.'.format(
+                    number, path, field, job[field]))
+
+        jobs.append(Job(str(job['subreddit']), str(job['begin']), str(job['end']),
+                        os.path.normpath(str(job.get('output') or job['subreddit']))))
+
+    return jobs
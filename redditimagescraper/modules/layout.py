@@ -0,0 +1,54 @@
+import hashlib
+import os
+import threading
+
+# Ways of laying out downloads under the output directory.  flat puts them all in it, as they always
+# have been.  date puts them in a directory for the year and one for the month inside that, and
+# subreddit does the same inside a directory named after the subreddit.  hash spreads them over 65536
+# directories two levels deep, named after the start of a hash of the file's name, so no directory
+# gets more than a few entries however big the scrape.
+LAYOUTS = ('flat', 'date', 'subreddit', 'hash')
+
+
+# Where each download goes, relative to the directory it is downloaded into.  Names are always the
+# file's date created and the last part of its url, only the directories they go in change.  The
+# directories are made as they are first needed.  Safe to share between threads.
+class Layout:
+    def __init__(self, kind='flat', subreddit=None):
+        if kind not in LAYOUTS:
+            raise ValueError('Unknown layout {}, pick from {}.'.format(kind, ', '.join(LAYOUTS)))
+        if kind == 'subreddit' and not subreddit:
+            raise ValueError('The subreddit layout needs a subreddit.')
+
+        self.kind = kind
+        self.subreddit = subreddit
+        self.lock = threading.Lock()
+        self.made = set()
+
+    # The path for the file at url, created at date_created (as YYYYMMDD_HHMMSS).
+    def name(self, date_created, url):
+        name = date_created + "_" + str(url).split('/')[-1]
+
+        if self.kind == 'date':
+            return os.path.join(date_created[:4], date_created[4:6], name)
+        if self.kind == 'subreddit':
+            return os.path.join(self.subreddit, date_created[:4], date_created[4:6], name)
+        if self.kind == 'hash':
+            digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+            return os.path.join(digest[:2], digest[2:4], name)
+        return name
+
+    # Makes the directory filename goes in, unless it has already been made.
+    def prepare(self, filename):
+        directory = os.path.dirname(filename)
+        if not directory:
+            return
+
+        with self.lock:
+            if directory not in self.made:
+                os.makedirs(directory, exist_ok=True)
+                self.made.add(directory)
+
+
+# Laid out the way downloads always have been, for callers that don't pick a layout.
+FLAT = Layout()
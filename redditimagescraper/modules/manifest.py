@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import threading
+
+# Kept in the directory whose downloads it tracks.
+MANIFEST_NAME = 'redditimagescraper-manifest.sqlite'
+
+
+# Downloads are written here and only renamed to filename once they are complete, so a file
+# with its real name is never left half written.
+def part_name(filename):
+    return filename + '.part'
+
+
+# Record of the downloads in one directory, so a run that gets killed can be restarted without
+# fetching everything again.  Files marked complete are skipped, and partial downloads pick up
+# where their .part file left off.  Safe to share between download threads.
+class Manifest:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(directory, MANIFEST_NAME), check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS downloads '
+                                    '(filename TEXT PRIMARY KEY, url TEXT, complete INTEGER, size INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS moved (filename TEXT PRIMARY KEY, moved_to TEXT)')
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    # Whether filename was downloaded completely and is still there, or wherever it was moved to, or
+    # was deleted on purpose once downloaded.
+    def complete(self, filename):
+        with self.lock:
+            row = self.connection.execute('SELECT complete, moved.filename, moved_to FROM downloads '
+                                          'LEFT JOIN moved USING (filename) WHERE filename = ?', (filename,)).fetchone()
+
+        if row is None or row[0] != 1:
+            return False
+        if row[1] is not None and row[2] is None:
+            return True
+        return os.path.exists(self.path(row[2] or filename))
+
+    # Marks filename as partially downloaded from url and returns how many bytes of it are already
+    # in its .part file from an earlier attempt at the same url, which is where the download should resume.
+    def start(self, url, filename):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT url FROM downloads WHERE filename = ?', (filename,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, 0, NULL)', (filename, str(url)))
+            self.connection.execute('DELETE FROM moved WHERE filename = ?', (filename,))
+
+        part = self.path(part_name(filename))
+        if row is not None and row[0] == str(url) and os.path.exists(part):
+            return os.path.getsize(part)
+
+        return 0
+
+    # Marks filename as completely downloaded.
+    def finish(self, filename):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE downloads SET complete = 1, size = ? WHERE filename = ?',
+                                    (os.path.getsize(self.path(filename)), filename))
+
+    # Records that the download at path, in the directory or below it, is now at new_path, as
+    # --reencode leaves an image it changes the format of, so complete() looks for it there.
+    def moved(self, path, new_path):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO moved VALUES (?, ?)',
+                                    (os.path.relpath(path, self.directory), os.path.relpath(new_path, self.directory)))
+
+    # Records that the download at path was deleted on purpose, as --similar-action delete does with
+    # near duplicates, so complete() counts it done rather than it being downloaded again.
+    def deleted(self, path):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO moved VALUES (?, NULL)',
+                                    (os.path.relpath(path, self.directory),))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,266 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the buckets every latency histogram counts into.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+# Prefix for every metric written out for Prometheus.
+PROMETHEUS_PREFIX = 'redditimagescraper_'
+
+# What each metric means, for the Prometheus HELP lines.  Anything recorded that isn't here is
+# still exported, just without help.
+DESCRIPTIONS = {
+    'submissions_listed': 'Submissions with a matching url handed over by the listing.',
+    'submissions_spilled': 'Listed submissions that waited on disk with --spill.',
+    'files_downloaded': 'Files downloaded in full.',
+    'files_skipped': 'Files the manifest already had as complete.',
+    'files_linked': 'Files linked to an earlier download of the same url instead of fetched.',
+    'duplicates': 'Downloaded files whose content was already stored, and were linked to it.',
+    'files_failed': 'Downloads given up on.',
+    'files_rejected': 'Downloads cut off because the filters did not want them.',
+    'retries': 'Downloads retried after a transient error.',
+    'files_processed': 'Downloaded files thumbnailed, stripped or re-encoded.',
+    'files_process_failed': 'Downloaded files that could not be processed, and were left as they were.',
+    'near_duplicates': 'Downloaded images that looked the same as one kept earlier, flagged or deleted.',
+    'files_archived': 'Downloads written into an archive with --archive instead of a file of their own.',
+    'archives_written': 'Archives finished with --archive.',
+    'bytes_downloaded': 'Bytes of image data received.',
+    'queue_depth': 'Listed submissions waiting to be downloaded.',
+    'downloads_in_flight': 'Downloads currently running.',
+    'concurrency_limit': 'Most downloads let run at once by --auto-concurrency right now.',
+    'concurrency_decreases': 'Times --auto-concurrency cut the downloads in flight for errors or rising latency.',
+    'tokens_reused': 'Reddit logins skipped by using an access token cached by an earlier run.',
+    'listing_retries': 'Reddit listing requests retried after a connection error, 429 or 5xx.',
+    'listing_pauses': 'Times the listing waited for Reddit\'s rate limit window to reset.',
+    'listings_not_modified': 'New listings Reddit answered with 304 Not Modified for --follow, nothing new.',
+    'dump_bytes_read': 'Bytes of submission dump decompressed by --dumps.',
+    'listing_window_seconds': 'Time spent listing each search window from Reddit.',
+    'first_byte_seconds': 'Time from sending a download request to its response arriving.',
+    'file_seconds': 'Time taken by each file download, from request to renamed into place.',
+    'process_seconds': 'Time from handing a file to the processing pool to it being done.',
+}
+
+
+# Counts of observations into BUCKETS, plus their sum and largest value.
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    # Upper bound of the bucket the observation fraction (0 to 1) of the way through falls in,
+    # capped at the largest value seen.
+    def quantile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return min(bound, self.max)
+        return 0
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else 0,
+                'p50': round(self.quantile(0.5), 6), 'p99': round(self.quantile(0.99), 6), 'max': round(self.max, 6)}
+
+
+# Counters, gauges and latency histograms for one run, keyed by name.  Safe to record into from
+# any thread.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Forgets everything and restarts the clock.
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    # Everything recorded so far, with overall rates worked out, as a dict ready for json.
+    def summary(self):
+        elapsed = self.elapsed()
+
+        with self.lock:
+            return {
+                'elapsed': round(elapsed, 3),
+                'files_per_sec': round(self.counters.get('files_downloaded', 0) / elapsed, 3) if elapsed else 0,
+                'bytes_per_sec': round(self.counters.get('bytes_downloaded', 0) / elapsed, 1) if elapsed else 0,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            }
+
+    # Everything recorded so far in the Prometheus text exposition format.
+    def prometheus(self):
+        lines = list()
+
+        def describe(name, kind, exported):
+            if name in DESCRIPTIONS:
+                lines.append('# HELP {} {}'.format(exported, DESCRIPTIONS[name]))
+            lines.append('# TYPE {} {}'.format(exported, kind))
+
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                exported = PROMETHEUS_PREFIX + name + '_total'
+                describe(name, 'counter', exported)
+                lines.append('{} {}'.format(exported, value))
+
+            for name, value in sorted(self.gauges.items()):
+                exported = PROMETHEUS_PREFIX + name
+                describe(name, 'gauge', exported)
+                lines.append('{} {}'.format(exported, value))
+
+            for name, histogram in sorted(self.histograms.items()):
+                exported = PROMETHEUS_PREFIX + name
+                describe(name, 'histogram', exported)
+                seen = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    seen += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(exported, '+Inf' if bound == float('inf') else bound,
+                                                                 seen))
+                lines.append('{}_sum {}'.format(exported, histogram.sum))
+                lines.append('{}_count {}'.format(exported, histogram.count))
+
+        exported = PROMETHEUS_PREFIX + 'elapsed_seconds'
+        lines += ['# TYPE {} gauge'.format(exported), '{} {}'.format(exported, round(self.elapsed(), 3))]
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')
+
+    # Written for node_exporter's textfile collector, which should never see a half written file.
+    def write_prometheus(self, path):
+        write_atomically(path, self.prometheus())
+
+
+# Writes text to a temporary file next to path and renames it over path.
+def write_atomically(path, text):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+# The metrics for the run in progress.  Everything records into this one.
+metrics = Metrics()
+
+
+# Yields from iterable, and once it runs out records the time spent waiting on it (not on whoever is
+# consuming it) in the histogram name.
+def timed(name, iterable):
+    iterator = iter(iterable)
+    elapsed = 0
+
+    while True:
+        started = time.monotonic()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.monotonic() - started
+        yield item
+
+    metrics.observe(name, elapsed)
+
+
+# A single line on stream summing up the run so far, redrawn every interval seconds from a
+# background thread instead of a print per file.
+class Progress:
+    def __init__(self, run_metrics=metrics, interval=1.0, stream=None):
+        self.metrics = run_metrics
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.width = 0
+
+    def line(self):
+        summary = self.metrics.summary()
+        counters = summary['counters']
+        return '{:.0f}s  listed {}  downloaded {} ({:.1f} MB, {:.1f}/s, {:.2f} MB/s)  queued {}  ' \
+               'retries {}  failed {}'.format(summary['elapsed'], counters.get('submissions_listed', 0),
+                                             counters.get('files_downloaded', 0),
+                                             counters.get('bytes_downloaded', 0) / 2 ** 20,
+                                             summary['files_per_sec'], summary['bytes_per_sec'] / 2 ** 20,
+                                             summary['gauges'].get('queue_depth', 0),
+                                             counters.get('retries', 0), counters.get('files_failed', 0))
+
+    def draw(self):
+        line = self.line()
+        self.stream.write('\r' + line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.draw()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Draws the line one last time and moves off it.
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.draw()
+        self.stream.write('\n')
+        self.stream.flush()
+
+
+# Starts a fresh set of metrics for a run, with a progress line if asked for.  Once the run is over,
+# even if it failed, the summary is written as JSON to json_path and for Prometheus to
+# prometheus_path, for whichever of those were given.
+@contextmanager
+def reporting(progress=False, json_path=None, prometheus_path=None):
+    metrics.reset()
+    ticker = Progress().start() if progress else None
+
+    try:
+        yield metrics
+    finally:
+        if ticker is not None:
+            ticker.stop()
+        if json_path is not None:
+            metrics.write_json(json_path)
+        if prometheus_path is not None:
+            metrics.write_prometheus(prometheus_path)
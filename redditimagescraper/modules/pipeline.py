@@ -0,0 +1,245 @@
+import queue
+import tempfile
+import threading
+from collections import deque
+
+from . import records
+from .metrics import metrics
+
+
+# Put on a queue by the listing side once it has nothing left to hand over.
+DONE = object()
+
+# Submissions written to or read back from disk by a SpillQueue at a time.
+SPILL_BATCH = 1024
+
+
+# A queue for submissions that never blocks put().  The first memory_items waiting are held in
+# memory, and once that many are, everything after goes to a temporary file until the file has been
+# read back empty, so submissions still come out in the order they went in.  Lets the listing run
+# as far ahead of the downloads as it likes while memory stays flat.  Safe to share between threads.
+class SpillQueue:
+    def __init__(self, memory_items):
+        self.memory_items = memory_items
+        self.condition = threading.Condition()
+        self.memory = deque()
+        self.file = None
+        self.writing = list()
+        self.read_at = 0
+        self.on_disk = 0
+
+    def put(self, submission):
+        with self.condition:
+            if self.on_disk or len(self.memory) >= self.memory_items:
+                self.writing.append('DONE\n' if submission is DONE else records.encode(submission))
+                self.on_disk += 1
+                metrics.count('submissions_spilled')
+                if len(self.writing) >= SPILL_BATCH:
+                    self.flush()
+            else:
+                self.memory.append(submission)
+            self.condition.notify()
+
+    # Writes out the submissions waiting to go to disk.
+    def flush(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.file.seek(0, 2)
+        self.file.writelines(self.writing)
+        self.writing = list()
+
+    # Reads the next batch of submissions from disk into memory, and empties the file once it has all
+    # been read.
+    def unspill(self):
+        self.flush()
+        self.file.seek(self.read_at)
+        for _ in range(min(SPILL_BATCH, self.on_disk)):
+            line = self.file.readline()
+            self.memory.append(DONE if line == 'DONE\n' else records.decode(line))
+            self.on_disk -= 1
+        self.read_at = self.file.tell()
+
+        if not self.on_disk:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_at = 0
+
+    def get(self, block=True):
+        with self.condition:
+            while block and not self.memory and not self.on_disk:
+                self.condition.wait()
+            if not self.memory and not self.on_disk:
+                raise queue.Empty
+            if not self.memory:
+                self.unspill()
+            return self.memory.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.memory) + self.on_disk
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+# A queue holding queue_size submissions, which blocks put() once it is full, or with spill a
+# SpillQueue holding that many in memory.
+def make_queue(queue_size, spill=False):
+    return SpillQueue(queue_size) if spill else queue.Queue(maxsize=queue_size)
+
+
+# Runs the listing generator on a background thread and yields each submission as soon as it arrives,
+# so downloading starts with the first day's results instead of after the whole range is listed.
+# The queue holds at most queue_size submissions; once the listing gets that far ahead it blocks
+# until the downloads catch up, which keeps memory flat.  With spill it carries on instead, with the
+# rest spilled to disk (see SpillQueue).  Errors in the listing are re-raised here.
+def stream(submissions, queue_size, spill=False):
+    submission_queue = make_queue(queue_size, spill)
+    errors = list()
+
+    def list_submissions():
+        try:
+            for submission in submissions:
+                submission_queue.put(submission)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            submission_queue.put(DONE)
+
+    threading.Thread(target=list_submissions, daemon=True).start()
+
+    while True:
+        submission = submission_queue.get()
+        metrics.gauge('queue_depth', submission_queue.qsize())
+        if submission is DONE:
+            break
+        yield submission
+
+    if spill:
+        submission_queue.close()
+
+    if errors:
+        raise errors[0]
+
+
+# stream for several listings at once, for running many jobs in one process.  listings yields
+# (job, submissions) pairs, and at most parallel of them are listed at a time, each on its own
+# thread with its own queue of queue_size, spilling to disk with spill.  Yields (job, submission)
+# pairs, taking turns between the jobs that have submissions waiting so one busy job can't starve
+# the rest.  A job whose listing raises is handed to failed(job, error), from its listing thread,
+# and dropped; without failed the first error is raised once the other jobs are done.
+def interleave(listings, parallel, queue_size, failed=None, spill=False):
+    listings = iter(listings)
+    ready = threading.Semaphore(0)
+    active = list()
+    errors = list()
+
+    def start_next():
+        job, submissions = next(listings, (DONE, None))
+        if job is DONE:
+            return
+
+        job_queue = make_queue(queue_size, spill)
+
+        def list_submissions():
+            try:
+                for submission in submissions:
+                    job_queue.put(submission)
+                    ready.release()
+            except Exception as e:
+                if failed is None:
+                    errors.append(e)
+                else:
+                    failed(job, e)
+            finally:
+                job_queue.put(DONE)
+                ready.release()
+
+        active.append((job, job_queue))
+        threading.Thread(target=list_submissions, daemon=True).start()
+
+    for _ in range(parallel):
+        start_next()
+
+    turn = 0
+    while active:
+        # Every release is one item waiting in one of the queues, so the search below always finds it.
+        ready.acquire()
+
+        for offset in range(len(active)):
+            i = (turn + offset) % len(active)
+            job, job_queue = active[i]
+            try:
+                submission = job_queue.get_nowait()
+            except queue.Empty:
+                continue
+            break
+
+        if submission is DONE:
+            if spill:
+                job_queue.close()
+            del active[i]
+            turn = i
+            start_next()
+            continue
+
+        turn = i + 1
+        yield job, submission
+
+    if errors:
+        raise errors[0]
+
+
+# Async version of stream.  The listing generator blocks, so each step of it runs in the loop's
+# default executor while downloads carry on.  Each submission is handed to the put coroutine
+# function, which should wait whenever the downloads fall behind.
+async def produce(submissions, put, loop):
+    submissions = iter(submissions)
+
+    while True:
+        submission = await loop.run_in_executor(None, next, submissions, DONE)
+        if submission is DONE:
+            break
+        await put(submission)
+
+
+# Async version of stream with spill, for a listing that runs on the loop.  Runs the coroutine
+# function listing(put) with a put that never waits, so the listing carries on as far ahead of the
+# downloads as it likes with everything past queue_size spilled to disk, while the submissions are
+# handed on to put in the order they were listed.
+async def spill(listing, put, queue_size, loop):
+    import asyncio
+
+    submission_queue = SpillQueue(queue_size)
+
+    async def spill_put(submission):
+        submission_queue.put(submission)
+
+    async def list_submissions():
+        try:
+            await listing(spill_put)
+        finally:
+            submission_queue.put(DONE)
+
+    listed = asyncio.ensure_future(list_submissions(), loop=loop)
+    try:
+        while True:
+            # Only waits on a thread when the queue is empty, which is when the listing is behind.
+            try:
+                submission = submission_queue.get_nowait()
+            except queue.Empty:
+                submission = await loop.run_in_executor(None, submission_queue.get)
+            metrics.gauge('queue_depth', submission_queue.qsize())
+            if submission is DONE:
+                break
+            await put(submission)
+    finally:
+        listed.cancel()
+        submission_queue.close()
+
+    # Re-raises anything the listing raised.
+    await listed
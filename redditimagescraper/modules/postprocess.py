@@ -0,0 +1,233 @@
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .filters import parse_dimensions
+from .metrics import metrics
+
+# Formats --reencode can turn images into, and the extension each is saved under.
+REENCODE_FORMATS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+# JPEG segments stripped as metadata: APP1 (EXIF, XMP) and APP3 to APP13, APP15 and comments.
+# APP0 (JFIF), APP2 (ICC colour profile) and APP14 (Adobe colour transform) change how the image
+# looks, so they stay.
+JPEG_METADATA = set(range(0xE3, 0xEE)) | {0xE1, 0xEF, 0xFE}
+
+# PNG chunks stripped as metadata: text, EXIF and modification time.
+PNG_METADATA = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'}
+
+
+# data, a JPEG, without its JPEG_METADATA segments.  Everything from the start of the scan on is
+# copied as it is, so the image itself is untouched.
+def strip_jpeg(data):
+    kept = [data[:2]]
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        if marker == 0xDA:
+            break
+        end = i + 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+        if marker not in JPEG_METADATA:
+            kept.append(data[i:end])
+        i = end
+
+    kept.append(data[i:])
+    return b''.join(kept)
+
+
+# data, a PNG, without its PNG_METADATA chunks.
+def strip_png(data):
+    kept = [data[:8]]
+    i = 8
+    while i + 8 <= len(data):
+        end = i + 12 + struct.unpack('>I', data[i:i + 4])[0]
+        if data[i + 4:i + 8] not in PNG_METADATA:
+            kept.append(data[i:end])
+        i = end
+
+    kept.append(data[i:])
+    return b''.join(kept)
+
+
+# Writes data to a temporary file next to path and renames it over path.
+def replace(path, data):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+# The work done on one downloaded image, in a worker process.  Writes a copy shrunk to fit within
+# thumbnails ((width, height)) to thumbnail_dir, next to the image unless absolute.  With
+# strip_metadata, drops EXIF and other metadata from a JPEG or PNG without re-encoding it.  With
+# reencode, saves the image again in that format at quality, under the matching extension, in
+# place of the original.  With image_hash, works out its perceptual hash (see similar.py) once
+# the rest is done.  Thumbnails, re-encoding and hashing need Pillow.  Returns the image's path,
+# which changes if it was re-encoded into another format, and its hash or None.
+def process_file(path, thumbnails=None, thumbnail_dir='thumbnails', strip_metadata=False, reencode=None,
+                 quality=85, image_hash=False):
+    if strip_metadata:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.startswith(b'\xff\xd8'):
+            replace(path, strip_jpeg(data))
+        elif data.startswith(b'\x89PNG\r\n\x1a\n'):
+            replace(path, strip_png(data))
+
+    if thumbnails is not None or reencode is not None:
+        path = transform(path, thumbnails, thumbnail_dir, reencode, quality)
+
+    if not image_hash:
+        return path, None
+
+    from . import similar
+    return path, similar.dhash(path)
+
+
+# The Pillow half of process_file: thumbnailing and re-encoding.  Returns the image's path once done.
+def transform(path, thumbnails, thumbnail_dir, reencode, quality):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.load()
+        directory, name = os.path.split(path)
+
+        if thumbnails is not None:
+            thumbnail = image.copy()
+            thumbnail.thumbnail(thumbnails)
+            thumbnail_path = os.path.join(directory, thumbnail_dir, name)
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            thumbnail.save(thumbnail_path, format=image.format)
+
+        # Saving an animation as a single frame would lose the rest of it.
+        if reencode is None or getattr(image, 'is_animated', False):
+            return path
+
+        reencoded = image.convert('RGB') if reencode == 'jpeg' and image.mode not in ('RGB', 'L') else image
+        new_path = os.path.splitext(path)[0] + REENCODE_FORMATS[reencode]
+        temporary = '{}.{}.tmp'.format(new_path, os.getpid())
+        reencoded.save(temporary, format=reencode.upper(), quality=quality, optimize=True,
+                       icc_profile=image.info.get('icc_profile'))
+
+    os.replace(temporary, new_path)
+    if new_path != path:
+        os.remove(path)
+    return new_path
+
+
+# Runs process_file on downloaded images in a pool of worker processes, so thumbnailing and
+# re-encoding use every core and never hold up the downloads, or the asyncio loop.  Files are
+# processed straight after being written, while they are still in the page cache.  Once limit files
+# are waiting, process() blocks, and process_async() waits, until one is done.  A file that can't be
+# processed is reported (if verbose) and left as downloaded.  Given a similar.NearDuplicates, each
+# file's hash is checked against it once processed.  A file handed over with the Manifest it was
+# downloaded under is recorded there if re-encoding moves it or it is deleted as a near duplicate.
+# Safe to share between threads.
+class PostProcessor:
+    def __init__(self, options, workers=None, limit=None, verbose=False, near_duplicates=None):
+        self.options = options
+        self.near_duplicates = near_duplicates
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.limit = limit or 2 * (workers or os.cpu_count() or 1)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def finished(self, future, path, started, manifest=None):
+        with self.lock:
+            self.pending.discard(future)
+
+        error = future.exception()
+        if error is not None:
+            metrics.count('files_process_failed')
+            if self.verbose:
+                print("\n!! Processing {} failed: {}".format(path, error))
+            return
+
+        metrics.observe('process_seconds', time.monotonic() - started)
+        metrics.count('files_processed')
+
+        new_path, image_hash = future.result()
+        if manifest is not None and new_path != path:
+            manifest.moved(path, new_path)
+        if self.near_duplicates is not None and image_hash is not None:
+            match = self.near_duplicates.landed(new_path, image_hash)
+            if manifest is not None and match is not None and self.near_duplicates.action == 'delete':
+                manifest.deleted(path)
+
+    # Hands path to the pool and returns its future.
+    def submit(self, path, manifest=None):
+        started = time.monotonic()
+        future = self.executor.submit(process_file, path, **self.options)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(lambda done: self.finished(done, path, started, manifest))
+        return future
+
+    def waiting(self):
+        with self.lock:
+            return [future for future in self.pending if not future.done()]
+
+    def process(self, path, manifest=None):
+        self.submit(path, manifest)
+        while True:
+            waiting = self.waiting()
+            if len(waiting) < self.limit:
+                return
+            wait(waiting, return_when=FIRST_COMPLETED)
+
+    # process(), but waits for room on a thread of loop's default executor rather than blocking loop.
+    async def process_async(self, path, loop, manifest=None):
+        self.submit(path, manifest)
+        while True:
+            waiting = self.waiting()
+            if len(waiting) < self.limit:
+                return
+            await loop.run_in_executor(None, wait, waiting, None, FIRST_COMPLETED)
+
+    # Waits for every file handed over to be processed.
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.near_duplicates is not None:
+            self.near_duplicates.index.close()
+
+
+# The process_file options for the command line's --thumbnails, --thumbnail-dir, --strip-metadata,
+# --reencode, --quality and --similar (as image_hash), for a PostProcessor, or None if there is
+# nothing to do.  Raises ValueError for options it can't make sense of, or if they need Pillow or
+# NumPy and it isn't installed.
+def processing_options(thumbnails=None, thumbnail_dir='thumbnails', strip_metadata=False, reencode=None, quality=85,
+                       image_hash=False):
+    if not (thumbnails or strip_metadata or reencode or image_hash):
+        return None
+
+    if reencode is not None and reencode not in REENCODE_FORMATS:
+        raise ValueError('Can only re-encode to {}.'.format(', '.join(sorted(REENCODE_FORMATS))))
+
+    thumbnails = parse_dimensions(thumbnails) if thumbnails else None
+    if thumbnails or reencode or image_hash:
+        try:
+            import PIL
+        except ImportError:
+            raise ValueError('Thumbnails, re-encoding and --similar need Pillow installed: pip install pillow')
+
+    if image_hash:
+        try:
+            import numpy
+        except ImportError:
+            raise ValueError('--similar needs NumPy installed: pip install numpy')
+
+    return {'thumbnails': thumbnails, 'thumbnail_dir': thumbnail_dir, 'strip_metadata': strip_metadata,
+            'reencode': reencode, 'quality': quality, 'image_hash': image_hash}
+
+
+# The similar.NearDuplicates for the command line's --similar, --similar-distance and
+# --similar-action, or None if --similar wasn't given.
+def near_duplicates(path, distance=6, action='flag', verbose=False):
+    if path is None:
+        return None
+
+    from . import similar
+    return similar.NearDuplicates(similar.SimilarIndex(path), distance, action, verbose)
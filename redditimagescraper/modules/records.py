@@ -0,0 +1,78 @@
+import json
+from datetime import datetime
+
+from .metrics import metrics
+
+# Cloudsearch timestamps are off by eight hours from UTC, praw's submissions() corrects for the same thing.
+CLOUDSEARCH_UTC_OFFSET = 28800
+
+
+# One submission to download: its url and when it was posted, in epoch seconds.  Unpacks and indexes
+# like the [url, date_string] lists it stands in for, with the date string only formatted once
+# something asks for it, so the listing never holds a formatted date for every submission queued.
+# Compares and sorts the same as a list holding the same url and date string.
+class Submission:
+    __slots__ = ('url', 'created_utc')
+
+    def __init__(self, url, created_utc):
+        self.url = url
+        self.created_utc = created_utc
+
+    @property
+    def date_created(self):
+        return datetime.utcfromtimestamp(self.created_utc).strftime('%Y%m%d_%H%M%S')
+
+    def __iter__(self):
+        yield self.url
+        yield self.date_created
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, i):
+        return (self.url, self.date_created)[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (Submission, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __lt__(self, other):
+        if not isinstance(other, (Submission, list, tuple)):
+            return NotImplemented
+        return list(self) < list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Submission({!r}, {!r})'.format(self.url, self.created_utc)
+
+
+# Yields a Submission for each of the submissions (anything with a url and created_utc, like praw's
+# or Reddit's JSON) whose url ends in exts.  Only the url and time are kept, not the rest of what
+# the listing has for them.
+def matching(submissions, exts):
+    for submission in submissions:
+        if submission.url.endswith(exts):
+            metrics.count('submissions_listed')
+            yield Submission(submission.url, submission.created_utc)
+
+
+# submission, a Submission or [url, date_string] list, with url in place of its own.
+def with_url(submission, url):
+    if isinstance(submission, Submission):
+        return Submission(url, submission.created_utc)
+    return [url, submission[1]]
+
+
+# One line of text holding submission, for writing to disk, and back again.  Anything that isn't a
+# Submission is kept as a list.
+def encode(submission):
+    if isinstance(submission, Submission):
+        return json.dumps([submission.url, submission.created_utc, True]) + '\n'
+    return json.dumps([submission[0], submission[1], False]) + '\n'
+
+
+def decode(line):
+    first, second, is_submission = json.loads(line)
+    return Submission(first, second) if is_submission else [first, second]
@@ -0,0 +1,216 @@
+import json
+import re
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import config
+from .metrics import metrics
+from .records import with_url
+
+IMGUR_API_URL = 'https://api.imgur.com/3'
+REDDIT_URL = 'https://www.reddit.com'
+
+# imgur.com/<id> is a page for a single image; imgur.com/a/<id> and imgur.com/gallery/<id> hold several.
+IMGUR_PAGE = re.compile(r'^https?://(?:www\.|m\.)?imgur\.com/(?:(a|gallery)/)?([A-Za-z0-9]+)/?(?:[?#].*)?$')
+REDDIT_GALLERY = re.compile(r'^https?://(?:www\.|old\.|new\.)?reddit\.com/gallery/([A-Za-z0-9]+)/?(?:[?#].*)?$')
+
+# Every url ends with the empty string, so listing with these as the extensions hands every
+# submission over to be resolved.
+ALL_LINKS = ('',)
+
+# File extension for each mime type Reddit gives gallery images.
+GALLERY_EXTENSIONS = {'image/jpg': '.jpg', 'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif'}
+
+
+# Resolved links kept in a SQLite file, so an album or gallery posted again is never looked up
+# twice.  Holds at most capacity links, dropping whichever was used longest ago to make room.
+# Safe to share between resolving threads.
+class LinkCache:
+    def __init__(self, path, capacity=100000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS links '
+                                    '(url TEXT PRIMARY KEY, images TEXT, used INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS links_by_use ON links (used)')
+
+        self.clock = self.connection.execute('SELECT COALESCE(MAX(used), 0) FROM links').fetchone()[0]
+
+    # The images url resolved to, or None if it isn't cached.
+    def get(self, url):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT images FROM links WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+
+            self.clock += 1
+            self.connection.execute('UPDATE links SET used = ? WHERE url = ?', (self.clock, url))
+            return json.loads(row[0])
+
+    def put(self, url, images):
+        with self.lock, self.connection:
+            self.clock += 1
+            self.connection.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                                    (url, json.dumps(images), self.clock))
+            self.connection.execute('DELETE FROM links WHERE used <= ?', (self.clock - self.capacity,))
+
+    def close(self):
+        self.connection.close()
+
+
+# Turns the links submissions point at into the direct image urls behind them.  Links ending in
+# exts are already images.  imgur pages become their i.imgur.com image without a request.  imgur
+# albums and galleries are looked up with the imgur API (which needs config.imgur_client_id), and
+# reddit galleries through the submission's JSON.  Anything else resolves to nothing.
+# Given a LinkCache, lookups are saved there and never made again.  Safe to share between threads.
+class Resolver:
+    def __init__(self, exts, cache=None, workers=1, verbose=False, imgur_client_id=None,
+                 imgur_api_url=IMGUR_API_URL, reddit_url=REDDIT_URL):
+        self.exts = exts
+        self.cache = cache
+        self.verbose = verbose
+        self.imgur_client_id = imgur_client_id
+        self.imgur_api_url = imgur_api_url
+        self.reddit_url = reddit_url
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'redditimagescraper, created by ardeaf'
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # The direct image urls behind url, in order.  A lookup that fails resolves to nothing and is
+    # tried again next time.
+    def resolve(self, url):
+        url = str(url)
+        if url.endswith(self.exts):
+            return [url]
+
+        imgur = IMGUR_PAGE.match(url)
+        gallery = REDDIT_GALLERY.match(url)
+        if imgur is not None and imgur.group(1) is None:
+            return [image for image in ['https://i.imgur.com/{}.jpg'.format(imgur.group(2))]
+                    if image.endswith(self.exts)]
+        if imgur is None and gallery is None:
+            return []
+
+        images = self.cache.get(url) if self.cache is not None else None
+        if images is not None:
+            metrics.count('links_cached')
+        else:
+            try:
+                if imgur is not None:
+                    images = self.imgur_album(imgur.group(1), imgur.group(2))
+                else:
+                    images = self.reddit_gallery(gallery.group(1))
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                metrics.count('links_failed')
+                if self.verbose:
+                    print("\n!! Couldn't resolve {}: {}".format(url, e))
+                return []
+
+            metrics.count('links_resolved')
+            if self.cache is not None:
+                self.cache.put(url, images)
+
+        return [image for image in images if image.endswith(self.exts)]
+
+    # GETs url for its JSON.  None for a 404, since a deleted album will always be gone.
+    def get_json(self, url, headers=None):
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def imgur_album(self, kind, album_id):
+        if self.imgur_client_id is None:
+            raise ValueError('imgur albums need imgur_client_id set in config.py')
+
+        headers = {'Authorization': 'Client-ID {}'.format(self.imgur_client_id)}
+        if kind == 'a':
+            found = self.get_json('{}/album/{}/images'.format(self.imgur_api_url, album_id), headers)
+            return [image['link'] for image in found['data']] if found is not None else []
+
+        # A gallery post is either an album or a lone image.
+        found = self.get_json('{}/gallery/{}'.format(self.imgur_api_url, album_id), headers)
+        if found is None:
+            return []
+        post = found['data']
+        return [image['link'] for image in post['images']] if post.get('is_album') else [post['link']]
+
+    def reddit_gallery(self, submission_id):
+        found = self.get_json('{}/comments/{}.json'.format(self.reddit_url, submission_id))
+        if found is None:
+            return []
+
+        post = found[0]['data']['children'][0]['data']
+        metadata = post.get('media_metadata') or {}
+        images = list()
+        for item in (post.get('gallery_data') or {}).get('items', []):
+            media = metadata.get(item['media_id'], {})
+            if media.get('status', 'valid') == 'valid' and media.get('m') in GALLERY_EXTENSIONS:
+                images.append('https://i.redd.it/{}{}'.format(item['media_id'], GALLERY_EXTENSIONS[media['m']]))
+        return images
+
+
+# Makes a Resolver for the extensions given, with the imgur client id and any endpoints set in config.py.
+def make_resolver(exts, cache_path=None, workers=1, verbose=False):
+    cache = LinkCache(cache_path) if cache_path is not None else None
+
+    return Resolver(exts, cache, workers, verbose, getattr(config, 'imgur_client_id', None),
+                    getattr(config, 'imgur_api_url', IMGUR_API_URL), getattr(config, 'reddit_url', REDDIT_URL))
+
+
+# Yields the submission for every image behind each submission ([url, date_string], or a
+# records.Submission) in submissions, the same kind with the image's url, resolving links on workers
+# threads so lookups overlap each other and the listing.  Results come back in the order the
+# submissions did, with only a couple of lookups per thread run ahead.
+def resolve_all(submissions, resolver, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for submission in submissions:
+            pending.append((submission, executor.submit(resolver.resolve, submission[0])))
+
+            while len(pending) >= workers * 2 or (pending and pending[0][1].done()):
+                submission, images = pending.popleft()
+                for image in images.result():
+                    yield with_url(submission, image)
+
+        while pending:
+            submission, images = pending.popleft()
+            for image in images.result():
+                yield with_url(submission, image)
+
+
+# Async version of resolve_all, for a listing that runs on the loop.  Runs the coroutine function
+# listing(put) with a put that starts resolving each submission on one of workers threads, and hands
+# the submission for every image behind it on to put, in listing order and with only a couple of
+# lookups per thread run ahead.
+async def resolving(listing, put, resolver, workers, loop):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        async def hand_over():
+            submission, images = pending.popleft()
+            for image in await images:
+                await put(with_url(submission, image))
+
+        async def resolve_put(submission):
+            pending.append((submission, loop.run_in_executor(executor, resolver.resolve, submission[0])))
+
+            while len(pending) >= workers * 2 or (pending and pending[0][1].done()):
+                await hand_over()
+
+        await listing(resolve_put)
+
+        while pending:
+            await hand_over()
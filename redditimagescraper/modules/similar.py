@@ -0,0 +1,271 @@
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from .metrics import metrics
+
+# Hashes are 64 bits, split into CHUNKS chunks of CHUNK_BITS for the multi-index.  Two hashes within
+# distance d of each other match exactly, or within d // CHUNKS bits, on at least one chunk.
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Past this distance probing the chunks costs more than comparing against every hash.
+MAX_INDEXED_DISTANCE = 3 * CHUNKS - 1
+
+# Below this many hashes, comparing against every one is quicker than probing the chunks.
+BRUTE_FORCE_BELOW = 4096
+
+# Bits set in each 16 bit value, for counting the bits two hashes differ in.
+POPCOUNT = numpy.unpackbits(numpy.arange(1 << 16, dtype='>u2').view(numpy.uint8)).reshape(-1, 16).sum(axis=1) \
+    .astype(numpy.uint8)
+
+# Image files the standalone command looks at.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+
+# The 64 bit difference hash of the image at path: whether each pixel is brighter than the one to
+# its left, over the image shrunk to 9x8 in greyscale.  Copies that have been resized, re-compressed
+# or lightly edited hash to within a few bits of each other.  Needs Pillow.
+def dhash(path):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        # Lets JPEGs be decoded at a fraction of their size, which is most of the time saved.
+        image.draft('L', (64, 64))
+        small = image.convert('L').resize((9, 8), Image.LANCZOS)
+
+    pixels = numpy.asarray(small, dtype=numpy.int16)
+    return int(numpy.packbits(pixels[:, 1:] > pixels[:, :-1]).view('>u8')[0])
+
+
+# Number of bits each of hashes (a uint64 array) differs from target in.
+def distances(hashes, target):
+    differing = numpy.ascontiguousarray(numpy.bitwise_xor(hashes, numpy.uint64(target)))
+    return POPCOUNT[differing.view(numpy.uint16)].reshape(-1, CHUNKS).sum(axis=1)
+
+
+# Every value within radius bits of value, value included.
+def neighbours(value, radius):
+    found = [value]
+    if radius >= 1:
+        found += [value ^ (1 << i) for i in range(CHUNK_BITS)]
+    if radius >= 2:
+        found += [value ^ (1 << i) ^ (1 << j) for i in range(CHUNK_BITS) for j in range(i)]
+    return found
+
+
+# SQLite stores 64 bit integers signed.
+def to_signed(image_hash):
+    return image_hash - (1 << 64) if image_hash >= 1 << 63 else image_hash
+
+
+def to_unsigned(image_hash):
+    return image_hash + (1 << 64) if image_hash < 0 else image_hash
+
+
+# Perceptual hashes of the images kept so far, for finding new ones that look the same.  Hashes
+# are held packed in a uint64 array and searched with vectorised Hamming distances, through a
+# multi-index on their 16 bit chunks so only hashes that could be near are ever compared.  Given a
+# path, the hashes are kept in a SQLite file there, along with the near duplicates found, and loaded
+# back on opening.  Safe to share between threads.
+class SimilarIndex:
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.hashes = numpy.zeros(1024, dtype=numpy.uint64)
+        self.paths = list()
+        self.chunks = [dict() for _ in range(CHUNKS)]
+        self.connection = None
+
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, hash INTEGER)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS near_duplicates '
+                                        '(path TEXT PRIMARY KEY, original TEXT, distance INTEGER)')
+
+            rows = self.connection.execute('SELECT path, hash FROM images ORDER BY rowid').fetchall()
+            self.load([row[0] for row in rows], numpy.array([row[1] for row in rows], dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Replaces everything held with paths and their hashes (an int64 or uint64 array), building the
+    # chunk index a chunk at a time rather than a hash at a time.
+    def load(self, paths, hashes):
+        hashes = hashes.astype(numpy.uint64)
+        self.hashes = numpy.concatenate([hashes, numpy.zeros(max(1024, len(hashes)), dtype=numpy.uint64)])
+        self.paths = list(paths)
+
+        for chunk in range(CHUNKS):
+            values = ((hashes >> numpy.uint64(chunk * CHUNK_BITS)) & numpy.uint64(CHUNK_MASK)).astype(numpy.uint32)
+            order = numpy.argsort(values, kind='mergesort').astype(numpy.uint32)
+            starts = numpy.flatnonzero(numpy.diff(values[order])) + 1
+            self.chunks[chunk] = {int(values[rows[0]]): array('I', rows.tobytes())
+                                  for rows in numpy.split(order, starts) if len(rows)}
+
+    def insert(self, path, image_hash):
+        row = len(self.paths)
+        if row == len(self.hashes):
+            self.hashes = numpy.concatenate([self.hashes, numpy.zeros(row, dtype=numpy.uint64)])
+
+        self.hashes[row] = image_hash
+        self.paths.append(path)
+        for chunk, rows in enumerate(self.chunks):
+            rows.setdefault((image_hash >> (chunk * CHUNK_BITS)) & CHUNK_MASK, array('I')).append(row)
+
+    # Rows of the hashes that could be within distance of image_hash.
+    def candidates(self, image_hash, distance):
+        radius = distance // CHUNKS
+        found = list()
+        for chunk, rows in enumerate(self.chunks):
+            for value in neighbours((image_hash >> (chunk * CHUNK_BITS)) & CHUNK_MASK, radius):
+                if value in rows:
+                    found.append(numpy.frombuffer(rows[value].tobytes(), dtype=numpy.uint32))
+
+        return numpy.unique(numpy.concatenate(found)) if found else numpy.zeros(0, dtype=numpy.uint32)
+
+    # (path, distance) of the kept image nearest to image_hash, if one is within distance bits.
+    def find(self, image_hash, distance):
+        with self.lock:
+            count = len(self.paths)
+            if count < BRUTE_FORCE_BELOW or distance > MAX_INDEXED_DISTANCE:
+                rows = numpy.arange(count)
+            else:
+                rows = self.candidates(image_hash, distance)
+
+            if not len(rows):
+                return None
+
+            found = distances(self.hashes[rows], image_hash)
+            nearest = int(numpy.argmin(found))
+            if found[nearest] > distance:
+                return None
+            return self.paths[rows[nearest]], int(found[nearest])
+
+    # Keeps path, with image_hash, for later images to be compared against.
+    def add(self, path, image_hash):
+        with self.lock:
+            self.insert(path, image_hash)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?)', (path, to_signed(image_hash)))
+
+    # Records that path was found to be a near duplicate of original.
+    def flag(self, path, original, distance):
+        if self.connection is not None:
+            with self.lock, self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO near_duplicates VALUES (?, ?, ?)',
+                                        (path, original, distance))
+
+    # Every path the index has seen, kept or flagged.
+    def seen(self):
+        if self.connection is None:
+            return set(self.paths)
+
+        with self.lock:
+            return {row[0] for row in self.connection.execute('SELECT path FROM images UNION '
+                                                              'SELECT path FROM near_duplicates')}
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+# What happens to images that land within distance bits of one already kept in a SimilarIndex:
+# with action 'flag' they are recorded as near duplicates and kept, with 'delete' they are deleted.
+# Anything else is added to the index.
+class NearDuplicates:
+    def __init__(self, index, distance=6, action='flag', verbose=False):
+        self.index = index
+        self.distance = distance
+        self.action = action
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+    # Checks the image at path, with image_hash, against those kept.  Returns (original, distance)
+    # if it is a near duplicate, otherwise None.
+    def landed(self, path, image_hash):
+        path = os.path.abspath(path)
+
+        # Held from the search to the add, so two copies landing at once can't both be kept.
+        with self.lock:
+            match = self.index.find(image_hash, self.distance)
+            if match is None:
+                self.index.add(path, image_hash)
+                return None
+
+        original, distance = match
+        metrics.count('near_duplicates')
+        if self.action == 'delete':
+            os.remove(path)
+        else:
+            self.index.flag(path, original, distance)
+
+        if self.verbose:
+            print('\t{} looks like {} ({} bits apart), {}.'.format(
+                path, original, distance, 'deleted' if self.action == 'delete' else 'flagged'))
+        return match
+
+
+# (path, dhash) for the image at path, with None for the hash if it can't be read as an image.
+def hash_file(path):
+    try:
+        return path, dhash(path)
+    except (OSError, ValueError, SyntaxError):
+        return path, None
+
+
+def get_args(args):
+    parser = argparse.ArgumentParser(description='Finds images in a directory that look the same as an earlier '
+                                                 'one, even once resized or re-compressed.')
+
+    parser.add_argument('directory', help='Directory to look through, and everything under it.')
+    parser.add_argument('--index', help='SQLite file to keep the hashes in, so a later run only hashes new images. '
+                                        'The same file as --similar when scraping.')
+    parser.add_argument('--distance', type=int, default=6,
+                        help='Most bits two images can differ in and still count as the same (default 6).')
+    parser.add_argument('--delete', action='store_true', default=False,
+                        help='Delete near duplicates instead of only listing them.')
+    parser.add_argument('--workers', type=int, default=0, help='Processes hashing images, 0 for one per core.')
+
+    return parser.parse_args(args)
+
+
+# Looks through a directory for near duplicates, oldest name first so the first copy of each image
+# is the one kept.  Files are hashed on a pool of processes, a chunk at a time.
+def main(args):
+    args = get_args(args)
+    index = SimilarIndex(args.index)
+    near_duplicates = NearDuplicates(index, args.distance, 'delete' if args.delete else 'flag')
+    seen = index.seen()
+
+    paths = sorted(os.path.abspath(os.path.join(directory, name)) for directory, _, names in os.walk(args.directory)
+                   for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+    paths = [path for path in paths if path not in seen]
+
+    found = 0
+    with ProcessPoolExecutor(max_workers=args.workers or None) as executor:
+        for path, image_hash in executor.map(hash_file, paths, chunksize=64):
+            if image_hash is None:
+                continue
+
+            match = near_duplicates.landed(path, image_hash)
+            if match is not None:
+                found += 1
+                print('{}\t{}\t{}'.format(path, match[0], match[1]))
+
+    print('{} images looked at, {} near duplicates {}.'.format(len(paths), found,
+                                                               'deleted' if args.delete else 'found'),
+          file=sys.stderr)
+    index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+
+# Token bucket that can be shared between threads.  Holds at most capacity tokens and refills at
+# rate tokens per second, so over any stretch of time no more than capacity + rate * seconds
+# tokens are handed out.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes a token if there is one and returns 0, otherwise returns how many seconds until there will be.
+    def try_take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    # Blocks until a token is free and takes it.
+    def take(self):
+        while True:
+            wait = self.try_take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+# Statuses that mean the host is overloaded or rate limiting us, so the download is worth trying again.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# A download that failed and won't be retried, like a 404.
+class DownloadError(Exception):
+    def __init__(self, url, reason):
+        super().__init__('{}: {}'.format(url, reason))
+        self.url = url
+        self.retry_after = None
+
+
+# A download that failed in a way that might go away: a connection error or one of RETRY_STATUSES.
+# retry_after is how long the host asked us to wait, if it said.
+class TransientError(DownloadError):
+    def __init__(self, url, reason, retry_after=None):
+        super().__init__(url, reason)
+        self.retry_after = retry_after
+
+
+# Seconds to wait before retry number attempt (counting from 0).  Exponential with full jitter,
+# so a crowd of downloads that failed together don't all come back at the same moment.
+def backoff(attempt, base=0.5, cap=60):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Seconds asked for by a Retry-After header, which is either a number of seconds or an HTTP date.
+# None if there was no header or it couldn't be read.
+def retry_after(value):
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+# Seconds between checks on whether a half open breaker's probe has come back.
+PROBE_CHECK = 1
+
+
+# Stops sending requests to a host that keeps failing.  After threshold failures in a row the host
+# is parked for cooldown seconds, after which the breaker is half open: one request, the probe, is
+# let through to see if the host has recovered while the rest keep waiting.  The probe succeeding
+# closes the breaker, failing parks the host again, and a probe never heard back from is given up on
+# after cooldown seconds so another can go.  A Retry-After from the host parks it for at least that long.
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.parked_until = 0
+        self.probe_until = 0
+
+    # Seconds until a request may be sent, 0 if it may go now.  While the probe is out, the seconds
+    # until it is next worth asking.
+    def wait(self):
+        now = time.monotonic()
+        if now < self.parked_until:
+            return self.parked_until - now
+        if now < self.probe_until:
+            return min(PROBE_CHECK, self.probe_until - now)
+        return 0
+
+    # Called as a request is sent.  If the breaker is half open, that request is its probe.
+    def sent(self):
+        if self.failures >= self.threshold:
+            self.probe_until = time.monotonic() + self.cooldown
+
+    def success(self):
+        self.failures = 0
+        self.parked_until = 0
+        self.probe_until = 0
+
+    def failure(self, retry_after=None):
+        self.failures += 1
+        self.probe_until = 0
+
+        if self.failures >= self.threshold:
+            self.parked_until = max(self.parked_until, time.monotonic() + self.cooldown)
+        if retry_after:
+            self.parked_until = max(self.parked_until, time.monotonic() + retry_after)
+
+
+# A token bucket and circuit breaker for every host we download from.  rate is requests per second
+# allowed to each host (0 for no limit), with up to a second's worth allowed in a burst.
+# Safe to share between download threads.
+class HostThrottle:
+    def __init__(self, rate=0, threshold=5, cooldown=30):
+        self.rate = rate
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    # The [bucket, breaker] for url's host.
+    def host(self, url):
+        host = urlparse(str(url)).netloc
+
+        with self.lock:
+            if host not in self.hosts:
+                bucket = TokenBucket(self.rate, max(1, self.rate)) if self.rate else None
+                self.hosts[host] = [bucket, CircuitBreaker(self.threshold, self.cooldown)]
+
+            return self.hosts[host]
+
+    # Seconds until a request to url's host may be sent.  Returns 0 when it may go now, and in that
+    # case has already taken its token from the host's bucket and told its breaker it was sent.
+    def wait(self, url):
+        bucket, breaker = self.host(url)
+
+        with self.lock:
+            wait = breaker.wait()
+            if not wait and bucket is not None:
+                wait = bucket.try_take()
+            if not wait:
+                breaker.sent()
+
+        return wait
+
+    # Blocks until a request to url's host may be sent.
+    def acquire(self, url):
+        while True:
+            wait = self.wait(url)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def success(self, url):
+        breaker = self.host(url)[1]
+        with self.lock:
+            breaker.success()
+
+    def failure(self, url, retry_after=None):
+        breaker = self.host(url)[1]
+        with self.lock:
+            breaker.failure(retry_after)
@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+import time
+
+
+# Reddit OAuth access tokens kept in a JSON file between runs, so a run started while the last
+# one's token is still good can use it instead of logging in again.  Tokens are keyed by app and
+# account, and the file is only readable by its owner since a token is as good as the password
+# for the hour it lasts.  Safe to share between threads.
+class TokenCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                tokens = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        return tokens if isinstance(tokens, dict) else dict()
+
+    # Writes tokens to a temporary file next to path and renames it over path.
+    def write(self, tokens):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(tokens, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    # The token saved under key as {'access_token', 'expires_at', 'scopes'}, or None if there isn't
+    # one that is still good at least margin seconds from now.
+    def load(self, key, margin=60):
+        with self.lock:
+            token = self.read().get(key)
+
+        if not isinstance(token, dict) or not token.get('access_token') or \
+                token.get('expires_at', 0) < time.time() + margin:
+            return None
+        return token
+
+    # Saves access_token, good until the epoch time expires_at, under key.
+    def save(self, key, access_token, expires_at, scopes):
+        with self.lock:
+            tokens = self.read()
+            tokens[key] = {'access_token': access_token, 'expires_at': expires_at, 'scopes': sorted(scopes or ())}
+            self.write(tokens)
+
+    # Drops the token under key, for when Reddit has stopped accepting it.
+    def forget(self, key):
+        with self.lock:
+            tokens = self.read()
+            if tokens.pop(key, None) is not None:
+                self.write(tokens)
@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+# Kinds of work.  A window is one subreddit's submissions between two epoch times to be listed, and
+# each image found becomes a download.
+WINDOW = 'window'
+DOWNLOAD = 'download'
+
+# One claimed piece of work.  payload is whatever it was added with, attempts counts this claim.
+Item = namedtuple('Item', ['id', 'kind', 'payload', 'attempts'])
+
+
+# Work shared between machines through a SQLite file on a shared volume, which has to support file
+# locking.  Workers claim items and hold a lease on them for lease seconds, extended by heartbeat()
+# while they are being worked on.  An item whose lease runs out, because its worker died or lost the
+# volume, goes back to be claimed again, up to max_attempts claims after which it is marked failed.
+# Items are unique by kind and payload, so adding the same work twice is harmless.  Leases are in
+# wall clock time, so the machines' clocks need to agree to within a fraction of lease.
+# Safe to share between threads.
+class WorkQueue:
+    def __init__(self, path, lease=60, max_attempts=5):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS items '
+                                    '(id INTEGER PRIMARY KEY, kind TEXT, payload TEXT, state TEXT, owner TEXT, '
+                                    'lease_until REAL, attempts INTEGER, UNIQUE (kind, payload))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS items_by_state ON items (state, lease_until)')
+
+    # Runs statements(cursor) in a transaction that holds the write lock from the start, so two
+    # workers can never claim the same item.
+    def transaction(self, statements):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    @staticmethod
+    def insert(cursor, kind, payloads):
+        cursor.executemany('INSERT OR IGNORE INTO items (kind, payload, state, attempts) VALUES (?, ?, ?, 0)',
+                           [(kind, json.dumps(payload, sort_keys=True), 'pending') for payload in payloads])
+
+    def add(self, kind, payloads):
+        self.transaction(lambda cursor: self.insert(cursor, kind, payloads))
+
+    # Leases up to limit items to owner and returns them.  Downloads come before windows, so what
+    # has already been listed gets downloaded before more is listed.
+    def claim(self, owner, limit=1):
+        now = time.time()
+
+        def claim_items(cursor):
+            cursor.execute("UPDATE items SET state = 'failed', owner = NULL "
+                           "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+            rows = cursor.execute("SELECT id, kind, payload, attempts FROM items "
+                                  "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                                  "ORDER BY kind = ?, id LIMIT ?", (now, WINDOW, limit)).fetchall()
+            cursor.executemany("UPDATE items SET state = 'leased', owner = ?, lease_until = ?, "
+                               "attempts = attempts + 1 WHERE id = ?",
+                               [(owner, now + self.lease, row[0]) for row in rows])
+            return [Item(row[0], row[1], json.loads(row[2]), row[3] + 1) for row in rows]
+
+        return self.transaction(claim_items)
+
+    # Extends owner's leases on the items with item_ids.  Returns the ids it still held.
+    def heartbeat(self, owner, item_ids):
+        item_ids = list(item_ids)
+        lease_until = time.time() + self.lease
+
+        def extend(cursor):
+            held = list()
+            for item_id in item_ids:
+                cursor.execute("UPDATE items SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                               (lease_until, item_id, owner))
+                if cursor.rowcount:
+                    held.append(item_id)
+            return held
+
+        return self.transaction(extend)
+
+    # Marks owner's item done and adds the work it led to, all at once.  Returns False, and adds
+    # nothing, if owner had lost the item to another worker in the meantime.
+    def finish(self, owner, item_id, kind=None, payloads=()):
+        def finish_item(cursor):
+            cursor.execute("UPDATE items SET state = 'done', owner = NULL WHERE id = ? AND owner = ? AND state = 'leased'",
+                           (item_id, owner))
+            if not cursor.rowcount:
+                return False
+
+            if payloads:
+                self.insert(cursor, kind, payloads)
+            return True
+
+        return self.transaction(finish_item)
+
+    # Hands owner's item back to be tried again, or with retry=False, or once it has been claimed
+    # max_attempts times, marks it failed for good.
+    def fail(self, owner, item_id, retry=True):
+        def fail_item(cursor):
+            cursor.execute("UPDATE items SET state = CASE WHEN ? AND attempts < ? THEN 'pending' ELSE 'failed' END, "
+                           "owner = NULL WHERE id = ? AND owner = ? AND state = 'leased'",
+                           (retry, self.max_attempts, item_id, owner))
+
+        self.transaction(fail_item)
+
+    # Number of items in each state: pending, leased, done and failed.
+    def counts(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall()
+
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(rows)
+        return counts
+
+    # Whether there is nothing left that anyone could claim, now or once a lease runs out.
+    def finished(self):
+        counts = self.counts()
+        return not counts['pending'] and not counts['leased']
+
+    def close(self):
+        self.connection.close()
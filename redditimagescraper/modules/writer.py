@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes of a download collected before they are written out.  Most images fit in one, so they are
+# opened, written and closed in a single trip to a writer thread.
+BUFFER_SIZE = 256 * 1024
+
+# Threads the writes run on, apart from the loop's own executor so they never wait behind a listing.
+THREADS = 4
+
+# Spare buffers kept for the next downloads, beyond which finished ones are let go.
+SPARE_BUFFERS = 64
+
+# none leaves flushing to the OS, file fsyncs each download before it is renamed into place, and
+# dir also fsyncs its directory after the rename so the new name survives a crash too.
+FSYNC_POLICIES = ('none', 'file', 'dir')
+
+
+# Writes all of buffer[:length] to fd.
+def write_all(fd, buffer, length):
+    view = memoryview(buffer)[:length]
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# fsyncs the directory path is in, so an entry just made or renamed in it is on disk.
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Writes downloads to disk for the event loop without it ever blocking, and without a thread hop for
+# every chunk read off the socket.  Chunks are copied into fixed size buffers, handed out from a
+# pool so they are reused from one download to the next, and each buffer is written with one
+# os.write on one of the writer's own threads while the next fills.  fsync is one of FSYNC_POLICIES.
+class DiskWriter:
+    def __init__(self, loop, buffer_size=BUFFER_SIZE, fsync='none', threads=THREADS):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy {}, pick from {}.'.format(fsync, ', '.join(FSYNC_POLICIES)))
+
+        self.loop = loop
+        self.buffer_size = max(1, buffer_size)
+        self.fsync = fsync
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.spare = list()
+
+    def buffer(self):
+        return self.spare.pop() if self.spare else bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        if len(self.spare) < SPARE_BUFFERS:
+            self.spare.append(buffer)
+
+    def run(self, function, *args):
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    # A WriterFile for path, appended to if append, else started afresh.  Given the size the file
+    # will end up (its Content-Length), the space is set aside for it up front so it is written
+    # in one piece.  Only pass size where a .part cut short won't be resumed from, since the space
+    # set aside counts towards the file's size until it is closed.
+    def open(self, path, append=False, size=None):
+        return WriterFile(self, path, append, size)
+
+    # Renames part to filename once it is complete, fsyncing the directory as well with the dir policy.
+    async def replace(self, part, filename):
+        if self.fsync == 'dir':
+            await self.run(self.replace_and_sync, part, filename)
+        else:
+            os.replace(part, filename)
+
+    @staticmethod
+    def replace_and_sync(part, filename):
+        os.replace(part, filename)
+        fsync_directory(filename)
+
+    # Shuts down the writer threads, blocking until they finish if wait.  From the loop itself, wait
+    # for every write first and close without wait.
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+# A download being written through a DiskWriter, used like an aiofiles file:
+# async with writer.open(path) as file: await file.write(chunk).  The file itself is only opened
+# with the first buffer written out, so a download that fits in one buffer costs one trip to a
+# writer thread for the lot.  Leaving the block because of an error closes the file without
+# writing out what is still buffered.
+class WriterFile:
+    def __init__(self, writer, path, append=False, size=None):
+        self.writer = writer
+        self.path = path
+        self.append = append
+        self.size = size
+        self.fd = None
+        self.buffer = writer.buffer()
+        self.filled = 0
+        self.written = 0
+        self.pending = None
+        self.pending_buffer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close(flush=exc_type is None)
+
+    async def write(self, data):
+        view = memoryview(data)
+        size = len(self.buffer)
+
+        while view:
+            n = min(len(view), size - self.filled)
+            self.buffer[self.filled:self.filled + n] = view[:n]
+            self.filled += n
+            view = view[n:]
+            if self.filled == size:
+                await self.flush()
+
+    # Waits for the buffer being written, if there is one, and starts writing this one, carrying on
+    # into the one just finished with.
+    async def flush(self):
+        await self.wait()
+        if not self.filled:
+            return
+
+        self.pending = self.writer.run(self.write_out, self.buffer, self.filled, False)
+        self.pending_buffer, self.buffer = self.buffer, self.writer.buffer()
+        self.written += self.filled
+        self.filled = 0
+
+    async def wait(self):
+        if self.pending is None:
+            return
+        try:
+            await self.pending
+        finally:
+            self.writer.release(self.pending_buffer)
+            self.pending = self.pending_buffer = None
+
+    async def close(self, flush=True):
+        try:
+            await self.wait()
+        finally:
+            if flush:
+                self.written += self.filled
+                await self.writer.run(self.write_out, self.buffer, self.filled, True)
+            elif self.fd is not None:
+                await self.writer.run(os.close, self.fd)
+            self.writer.release(self.buffer)
+            self.buffer = None
+
+    # Runs on a writer thread.  Opens the file if it isn't yet, writes buffer[:length] to it and, if
+    # last, gives back any space set aside that wasn't used, fsyncs it if the policy says to and
+    # closes it.
+    def write_out(self, buffer, length, last):
+        if self.fd is None:
+            flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if self.append else os.O_TRUNC)
+            self.fd = os.open(self.path, flags, 0o666)
+            if self.size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(self.fd, 0, self.size)
+                except OSError:
+                    self.size = None
+
+        write_all(self.fd, buffer, length)
+
+        if last:
+            try:
+                if self.size and self.size != self.written:
+                    os.ftruncate(self.fd, self.written)
+                if self.writer.fsync != 'none':
+                    os.fsync(self.fd)
+            finally:
+                os.close(self.fd)
+                self.fd = None
@@ -1,19 +1,46 @@
 import sys
 
 import argparse
+import hashlib
+import os
+import re
+import socket
+import threading
 import time
-from datetime import datetime, timedelta, date
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, date, timezone
 
-import requests
-import pytz
-
-from redditimagescraper.modules import async
-from redditimagescraper.modules import accessreddit
+# requests, praw and aiohttp take most of the time it takes to start up, so the modules that need
+# them (accessreddit, async and resolve) are imported by whichever code path uses them instead of
+# here.  Everything imported here only needs the standard library.
 from redditimagescraper.modules import config
+from redditimagescraper.modules.archive import ArchiveSink, ARCHIVE_FORMATS
+from redditimagescraper.modules import dedup
+from redditimagescraper.modules import dumps
+from redditimagescraper.modules import filters
+from redditimagescraper.modules import follow
+from redditimagescraper.modules import index
+from redditimagescraper.modules.jobs import load_jobs
+from redditimagescraper.modules.layout import Layout, LAYOUTS, FLAT
+from redditimagescraper.modules.manifest import Manifest, part_name
+from redditimagescraper.modules.metrics import metrics, reporting
+from redditimagescraper.modules import pipeline
+from redditimagescraper.modules import postprocess
+from redditimagescraper.modules.workqueue import WorkQueue, WINDOW, DOWNLOAD
+from redditimagescraper.modules.writer import BUFFER_SIZE, FSYNC_POLICIES
+from redditimagescraper.modules.throttle import HostThrottle, DownloadError, TransientError, RETRY_STATUSES, \
+    backoff, retry_after
 
 # Error msg. Global for now.
 error_msg = "\n\t{} is an invalid {}."
 
+# Downloads are read off the socket and written to disk this many bytes at a time.
+chunk_size = 64 * 1024
+
+# Seconds a download waits on its host before giving up and retrying, the same as aiohttp's default
+# request timeout for the async downloads.
+download_timeout = 5 * 60
+
 
 # Returns subreddit that user wishes to scrape.
 def subreddit():
@@ -107,9 +134,9 @@ def daterange(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         date = start_date + timedelta(n)
 
-        begin_datetime = datetime(date.year, date.month, date.day, 0, 0, 0, 000000, pytz.utc).timestamp()
+        begin_datetime = datetime(date.year, date.month, date.day, 0, 0, 0, 000000, timezone.utc).timestamp()
 
-        end_datetime = datetime(date.year, date.month, date.day, 23, 59, 59, 999999, pytz.utc).timestamp()
+        end_datetime = datetime(date.year, date.month, date.day, 23, 59, 59, 999999, timezone.utc).timestamp()
 
         yield [begin_datetime, end_datetime]
 
@@ -160,28 +187,683 @@ def get_user_input():
     return user_vars
 
 
+# Builds the requests session shared by every download in a run, so connections are kept alive
+# between files.  Its pool holds a connection per worker thread for each host.
+def make_session(workers, timeout=download_timeout):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Gives every request that didn't bring a timeout of its own timeout seconds to connect and
+    # timeout seconds between reads, so a host that stalls can't hold a worker thread forever.
+    class TimeoutAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = (timeout, timeout)
+            return super().send(request, **kwargs)
+
+    session = requests.Session()
+    adapter = TimeoutAdapter(pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# Bytes the body of a response with headers should hold, from its Content-Length or, failing that,
+# its Content-Range, or None if it says neither.  Also None for a compressed body, since requests
+# hands that over decompressed.
+def expected_length(headers):
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        pass
+
+    content_range = re.match(r'bytes (\d+)-(\d+)/', headers.get('Content-Range', ''))
+    if content_range is not None:
+        return int(content_range.group(2)) - int(content_range.group(1)) + 1
+    return None
+
+
+# GETs url through the throttle for its host, retrying connection errors and RETRY_STATUSES up to
+# retries times with jittered exponential backoff, or longer if the host sends Retry-After.
+# Returns the streaming response once it's one we can save.  Raises DownloadError for a status
+# like 404, or any other requests error like too many redirects, straight away, and TransientError
+# once the retries run out.
+# Given read, a function taking the response, the body is read with it as part of the same
+# attempt, and what read returns is returned instead.  A connection that drops part way through
+# the body, or a body shorter than the response said (read raises TransientError for that), is
+# retried like any other connection error.  The response is closed once read is done with it.
+def get_with_retries(session, url, headers, throttle, retries, read=None):
+    import requests
+
+    attempt = 0
+    while True:
+        throttle.acquire(url)
+        sent = time.monotonic()
+
+        try:
+            response = session.get(str(url), headers=headers, stream=True)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = TransientError(url, e)
+        except requests.exceptions.RequestException as e:
+            # Too many redirects, a url requests can't fetch and the like.  Not worth retrying.
+            raise DownloadError(url, '{}: {}'.format(type(e).__name__, e))
+        else:
+            if response.status_code in RETRY_STATUSES:
+                response.close()
+                error = TransientError(url, 'HTTP {}'.format(response.status_code),
+                                       retry_after(response.headers.get('Retry-After')))
+            else:
+                metrics.observe('first_byte_seconds', time.monotonic() - sent)
+                throttle.success(url)
+                if response.status_code >= 400 and response.status_code != 416:
+                    response.close()
+                    raise DownloadError(url, 'HTTP {}'.format(response.status_code))
+                if read is None:
+                    return response
+
+                try:
+                    return read(response)
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout) as e:
+                    error = TransientError(url, e)
+                except requests.exceptions.RequestException as e:
+                    raise DownloadError(url, '{}: {}'.format(type(e).__name__, e))
+                except TransientError as e:
+                    error = e
+                finally:
+                    response.close()
+
+        throttle.failure(url, error.retry_after)
+        if attempt >= retries:
+            raise error
+
+        metrics.count('retries')
+        time.sleep(max(backoff(attempt), error.retry_after or 0))
+        attempt += 1
+
+
 # Download the file for a given url.
 # File name is date created and the filename.
 # If verbose is True the script prints the name of the file being downloaded and file download time.
-def download_file(url, date_created, verbose):
-    filename = date_created + "_" + str(url).split('/')[-1]
+# The body is streamed to disk chunk_size bytes at a time so a large gif never sits in memory whole.
+# Given a session, the download reuses its pooled connections.  Given a HostThrottle, requests wait
+# on their host's rate limit and circuit breaker, and failures are retried up to retries times.
+# Raises DownloadError if the file couldn't be downloaded; nothing is saved for it.
+# Given a ContentStore, a url downloaded before is linked instead of fetched, and a file whose bytes
+# we already have becomes a link to them.
+# The download goes to a .part file that is renamed once complete.  Given a Manifest, files it has
+# as complete are skipped and a .part left by an earlier run is resumed with a Range request.
+# Given a directory, the file goes there instead of the current directory; the manifest should be
+# the one for that directory.  Given a Layout, the file goes in the subdirectory it picks.
+# Given a ContentFilter, the download is checked against it from its headers and first bytes as they
+# arrive, and one it rejects is cut off there and raises filters.Rejected, with nothing kept.
+# Given an ArchiveSink, the download is spooled in memory and added to its archive, and nothing is
+# written on its own.
+# Returns the file's name if it was downloaded and kept as a file of its own, otherwise None.
+def download_file(url, date_created, verbose, store=None, manifest=None, session=None, throttle=None, retries=0,
+                  directory=None, content_filter=None, layout=FLAT, archive=None):
+    name = layout.name(date_created, url)
+    filename = os.path.join(directory, name) if directory is not None else name
+    if archive is None:
+        layout.prepare(filename)
+
+    if manifest is not None and manifest.complete(name):
+        metrics.count('files_skipped')
+        if verbose:
+            print('\t{} already downloaded, skipping.'.format(filename))
+        return
+
+    if store is not None and store.link_url(url, filename):
+        metrics.count('files_linked')
+        if verbose:
+            print('\t{} already downloaded, linked.'.format(filename))
+        return
 
     if verbose:
         download_started_message = 'Downloading file: {}.'
         download_finished_message = '\t{} downloaded in {} seconds.'
         print(download_started_message.format(filename))
 
-    with open(filename, "wb") as file:
+    part = part_name(filename)
+    offset = manifest.start(url, name) if manifest is not None else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+
+    dl_time = datetime.now()
+    started = time.monotonic()
+
+    # Reads the body of response into the .part, or the archive's spool, and returns its hash.  Each
+    # chunk is hashed on its way past so the file never has to be read back.  Run afresh for every
+    # attempt get_with_retries makes, so a body cut short starts over from where this call began.
+    def save(response):
+        digest = hashlib.sha256()
+        received = 0
+
+        # 206 means the server is sending the rest of the file, 416 that the .part already had all of it.
+        # Anything else is the whole file again.
+        resumed_from = offset if response.status_code in (206, 416) else 0
 
-        dl_time = datetime.now()
+        # Closing the response part way through drops the connection, so a rejected file stops downloading.
+        # A 416's headers describe its error page, not the file, so only the size of the .part is checked.
+        check = content_filter.stream(url, resumed_from) if content_filter is not None else None
+        try:
+            if check is not None and response.status_code != 416:
+                content_filter.check_headers(url, response.headers, response.status_code)
+
+            with archive.spool() if archive is not None else open(part, "ab" if resumed_from else "wb") as file:
+                if resumed_from:
+                    # Drop anything an earlier attempt added before it was cut off.
+                    file.truncate(resumed_from)
+                    if store is not None:
+                        with open(part, 'rb') as resumed:
+                            for chunk in iter(lambda: resumed.read(chunk_size), b''):
+                                digest.update(chunk)
+
+                if response.status_code != 416:
+                    for chunk in response.iter_content(chunk_size):
+                        received += len(chunk)
+                        if check is not None:
+                            chunk = check.feed(chunk)
+                        digest.update(chunk)
+                        file.write(chunk)
+
+                    expected = expected_length(response.headers)
+                    if expected is not None and received < expected:
+                        raise TransientError(url, 'connection closed after {} of {} bytes'.format(received, expected))
+
+                if check is not None:
+                    chunk = check.finish()
+                    digest.update(chunk)
+                    file.write(chunk)
+
+                if archive is not None:
+                    archive.add(name, file)
+        except filters.Rejected:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            metrics.count('bytes_downloaded', received)
+
+        return digest
+
+    if session is None:
+        session = make_session(1)
+    try:
+        digest = get_with_retries(session, url, headers, throttle or HostThrottle(), retries, save)
+    except DownloadError:
+        # Without a manifest nothing resumes from a .part cut short.
+        if manifest is None and os.path.exists(part):
+            os.remove(part)
+        raise
+
+    if archive is None:
+        os.replace(part, filename)
+        if manifest is not None:
+            manifest.finish(name)
+
+    delta = (datetime.now() - dl_time).total_seconds()
+    metrics.observe('file_seconds', time.monotonic() - started)
+    metrics.count('files_downloaded')
 
-        response = requests.get(str(url))
-        file.write(response.content)
+    if verbose:
+        print(download_finished_message.format(filename, str(delta)))
 
-        delta = (datetime.now() - dl_time).total_seconds()
+    if archive is not None:
+        return None
 
+    if store is not None and store.add(url, filename, digest.hexdigest()):
+        metrics.count('duplicates')
+        if verbose:
+            print('\t{} is a duplicate, linked.'.format(filename))
+        return None
+
+    return filename
+
+
+# download_file, but a download that fails or is rejected is reported (if verbose) instead of raised.
+# Given a PostProcessor, a file that was downloaded is handed to it.
+def download_or_report(url, date_created, verbose, store, manifest, session, throttle, retries, directory=None,
+                       content_filter=None, processor=None, layout=FLAT, archive=None):
+    try:
+        filename = download_file(url, date_created, verbose, store, manifest, session, throttle, retries, directory,
+                                 content_filter, layout, archive)
+        if processor is not None and filename is not None:
+            processor.process(filename, manifest)
+    except filters.Rejected as e:
+        metrics.count('files_rejected')
+        if verbose:
+            print("\n!! Skipped {}".format(e))
+    except DownloadError as e:
+        metrics.count('files_failed')
         if verbose:
-            print(download_finished_message.format(filename, str(delta)))
+            print("\n!! Download of {} failed: {}".format(url, e))
+
+
+# Runs download_or_report with each of the argument lists in downloads on a pool of worker threads.
+# Only a couple of downloads per worker are queued up at a time so the listing isn't drained into memory.
+def run_downloads(downloads, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+
+        for download_args in downloads:
+            pending.add(executor.submit(download_or_report, *download_args))
+
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for download in done:
+                    download.result()
+
+        for download in pending:
+            download.result()
+
+
+# Downloads the submissions on a pool of worker threads sharing one session and throttle.
+# A download that fails is reported and skipped, same as when downloading one at a time.
+def download_in_parallel(submissions, workers, verbose, store, manifest, session, throttle, retries,
+                         content_filter=None, processor=None, directory=None, layout=FLAT, archive=None):
+    run_downloads(([url, date_created, verbose, store, manifest, session, throttle, retries, directory,
+                    content_filter, processor, layout, archive] for url, date_created in submissions), workers)
+
+
+# The ArchiveSink for --archive, writing archives named after prefix into directory (the current
+# directory if None), or None if --archive wasn't given.
+def archive_sink(parser, directory, prefix):
+    if parser.archive is None:
+        return None
+    return ArchiveSink(directory or os.curdir, parser.archive, parser.archive_size * 1024 * 1024, prefix,
+                       parser.verbose)
+
+
+# Where the downloads for output, a directory relative to --output-dir unless absolute, go.
+def output_directory(parser, output=None):
+    if parser.output_dir is None:
+        return output
+    return os.path.join(parser.output_dir, output) if output is not None else parser.output_dir
+
+
+# Runs every job in jobs (see modules/jobs.py) in this one process.  They share a single Reddit login
+# and API budget, one HTTP session, throttle, index, content store and link cache, and the pool of
+# --workers download threads.  --parallel-jobs of them are listed at a time, and their downloads take
+# turns so a big job doesn't hold up the small ones.  Each job's images go in its output directory,
+# under --output-dir if given, laid out by --layout, with its own manifest there if --resume is given,
+# or its own archives with --archive.  A job whose listing fails is reported and skipped.
+# content_filter and processor, if given, apply to every job's downloads.  processor is closed once
+# they are all done.
+def run_jobs(jobs, parser, content_filter=None, processor=None):
+    from redditimagescraper.modules import accessreddit
+    from redditimagescraper.modules import resolve
+
+    verbose = parser.verbose
+    reddit = accessreddit.login(verbose, parser.parallel_jobs * parser.listing_workers, parser.api_rate,
+                                parser.token_cache)
+    submission_index = index.SubmissionIndex(parser.index) if parser.index is not None else None
+    store = dedup.ContentStore(parser.dedup, parser.link) if parser.dedup is not None else None
+    resolver = resolve.make_resolver(config.extensions, parser.link_cache,
+                                      parser.parallel_jobs * parser.resolve_workers, verbose) if parser.imgur else None
+    session = make_session(parser.workers, parser.timeout)
+    throttle = HostThrottle(parser.host_rate, parser.breaker_threshold, parser.breaker_cooldown)
+    manifests = dict()
+    directories = {job: output_directory(parser, job.output) for job in jobs}
+    layouts = {job: Layout(parser.layout, job.subreddit) for job in jobs}
+    archives = dict()
+
+    def listings():
+        for job in jobs:
+            os.makedirs(directories[job], exist_ok=True)
+            if parser.resume:
+                manifests[job] = Manifest(directories[job])
+            archives[job] = archive_sink(parser, directories[job], job.subreddit)
+
+            month_b, day_b, year_b = map(int, job.begin_date.split('.'))
+            month_e, day_e, year_e = map(int, job.end_date.split('.'))
+            subs = accessreddit.subs_to_download(job.subreddit, convert_dates(year_b, month_b, day_b,
+                                                                              year_e, month_e, day_e),
+                                                 resolve.ALL_LINKS if parser.imgur else config.extensions,
+                                                 verbose, parser.listing_workers, parser.api_rate, parser.adaptive,
+                                                 submission_index, reddit)
+            if resolver is not None:
+                subs = resolve.resolve_all(subs, resolver, parser.resolve_workers)
+
+            if verbose:
+                print("Starting job /r/{} {} to {} into {}".format(job.subreddit, job.begin_date, job.end_date,
+                                                                   directories[job]))
+            yield job, subs
+
+    def failed(job, error):
+        print("\n!! Listing /r/{} {} to {} failed: {}".format(job.subreddit, job.begin_date, job.end_date, error))
+
+    submissions = pipeline.interleave(listings(), parser.parallel_jobs, parser.queue_size, failed, parser.spill)
+    with reporting(parser.progress, parser.metrics_json, parser.metrics_prom):
+        try:
+            run_downloads(([url, date_created, verbose, store, manifests.get(job), session, throttle, parser.retries,
+                            directories[job], content_filter, processor, layouts[job], archives[job]]
+                           for job, (url, date_created) in submissions), parser.workers)
+        finally:
+            if processor is not None:
+                processor.close()
+            for sink in archives.values():
+                if sink is not None:
+                    sink.close()
+
+
+# --follow: downloads everything posted to each of subreddit_names since the high-water marks kept
+# in the --follow file, from each subreddit's new listing, and moves the marks on once the downloads
+# are done.  Steady state costs a request per subreddit plus one per hundred new submissions, however
+# long it has been.  A subreddit followed for the first time goes back as far as its new listing
+# does, or to floor (epoch seconds) if given.  With --poll it goes round again every --poll
+# seconds until interrupted.  Otherwise runs like run_jobs, with each subreddit's images in
+# --output-dir (the current directory if not given) laid out by --layout, and listed --parallel-jobs
+# subreddits at a time.  A subreddit whose listing fails is reported and tried again next round.
+def follow_subreddits(subreddit_names, parser, floor=None, content_filter=None, processor=None):
+    from redditimagescraper.modules import accessreddit
+    from redditimagescraper.modules import resolve
+
+    verbose = parser.verbose
+    reddit = accessreddit.login(verbose, parser.parallel_jobs, parser.api_rate, parser.token_cache)
+    marks = follow.HighWaterMarks(parser.follow)
+    follower = follow.Follower(marks, floor)
+    store = dedup.ContentStore(parser.dedup, parser.link) if parser.dedup is not None else None
+    resolver = resolve.make_resolver(config.extensions, parser.link_cache,
+                                      parser.parallel_jobs * parser.resolve_workers, verbose) if parser.imgur else None
+    session = make_session(parser.workers, parser.timeout)
+    throttle = HostThrottle(parser.host_rate, parser.breaker_threshold, parser.breaker_cooldown)
+    directory = output_directory(parser)
+    manifest = Manifest(directory or os.getcwd()) if parser.resume else None
+    layouts = {name: Layout(parser.layout, name) for name in subreddit_names}
+    archives = {name: archive_sink(parser, directory, name) for name in subreddit_names}
+
+    def listings():
+        for name in subreddit_names:
+            subs = accessreddit.new_submissions(reddit, name, follower,
+                                                resolve.ALL_LINKS if parser.imgur else config.extensions, verbose)
+            if resolver is not None:
+                subs = resolve.resolve_all(subs, resolver, parser.resolve_workers)
+            yield name, subs
+
+    def failed(name, error):
+        print("\n!! Listing new submissions from /r/{} failed: {}".format(name, error))
+
+    with reporting(parser.progress, parser.metrics_json, parser.metrics_prom):
+        try:
+            while True:
+                started = time.monotonic()
+                submissions = pipeline.interleave(listings(), parser.parallel_jobs, parser.queue_size, failed,
+                                                  parser.spill)
+                run_downloads(([url, date_created, verbose, store, manifest, session, throttle, parser.retries,
+                                directory, content_filter, processor, layouts[name], archives[name]]
+                               for name, (url, date_created) in submissions), parser.workers)
+                follower.commit()
+
+                if not parser.poll:
+                    break
+                wait = max(0, parser.poll - (time.monotonic() - started))
+                if verbose:
+                    print("Checking again in {:.0f} seconds.".format(wait))
+                time.sleep(wait)
+        finally:
+            if processor is not None:
+                processor.close()
+            for sink in archives.values():
+                if sink is not None:
+                    sink.close()
+            marks.close()
+
+
+# Coordinator side of --coordinate: puts a window for each day of date_list in subreddit_name on the
+# work queue at queue_path, for workers started with --work to list and download.  Days already on
+# the queue aren't added twice.  Returns how many items the queue holds in each state.
+def coordinate(queue_path, subreddit_name, date_list, lease):
+    work_queue = WorkQueue(queue_path, lease)
+    work_queue.add(WINDOW, [{'subreddit': subreddit_name, 'window': window} for window in date_list])
+    counts = work_queue.counts()
+    work_queue.close()
+
+    return counts
+
+
+# Worker side of --work: claims items from the work queue at queue_path and runs them on --workers
+# threads until the queue has nothing left.  Listing a window queues a download for each image found
+# in it; downloads go to --output-dir, or the current directory, laid out by --layout or into this
+# worker's own archives with --archive.  Leases on items in progress are renewed every
+# third of --lease, so a worker that dies has its items picked up by the others once they run out.
+# Items that fail with a transient error go back on the queue, ones that can't succeed are failed.
+# Checks the queue for more work every poll seconds while other workers are still busy.
+# Downloads content_filter rejects are done with, same as if they had been downloaded.  Downloaded
+# files are handed to processor, if given, which is closed once the queue is finished.
+def work_from_queue(queue_path, parser, poll=5, content_filter=None, processor=None):
+    from redditimagescraper.modules import accessreddit
+    from redditimagescraper.modules import resolve
+
+    verbose = parser.verbose
+    work_queue = WorkQueue(queue_path, parser.lease)
+    owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    submission_index = index.SubmissionIndex(parser.index) if parser.index is not None else None
+    store = dedup.ContentStore(parser.dedup, parser.link) if parser.dedup is not None else None
+    directory = output_directory(parser)
+    manifest = Manifest(directory or os.getcwd()) if parser.resume else None
+    sink = archive_sink(parser, directory, owner.replace(':', '-'))
+    resolver = resolve.make_resolver(config.extensions, parser.link_cache, parser.workers, verbose) \
+        if parser.imgur else None
+    exts = resolve.ALL_LINKS if parser.imgur else config.extensions
+    session = make_session(parser.workers, parser.timeout)
+    throttle = HostThrottle(parser.host_rate, parser.breaker_threshold, parser.breaker_cooldown)
+
+    # Only logs in once there is a window to list.
+    login_lock = threading.Lock()
+    subreddits = dict()
+    layouts = dict()
+
+    def layout(name):
+        with login_lock:
+            if name not in layouts:
+                layouts[name] = Layout(parser.layout, name)
+            return layouts[name]
+
+    def subreddit(name):
+        with login_lock:
+            if not subreddits:
+                subreddits[None] = accessreddit.login(verbose, parser.workers, parser.api_rate, parser.token_cache)
+            if name not in subreddits:
+                subreddits[name] = subreddits[None].subreddit(name)
+            return subreddits[name]
+
+    def execute(item):
+        payload = item.payload
+        try:
+            if item.kind == WINDOW:
+                submissions = accessreddit.window_submissions(subreddit(payload['subreddit']), payload['window'],
+                                                              exts, verbose, submission_index)
+                if resolver is not None:
+                    submissions = ([image, date_created] for url, date_created in submissions
+                                   for image in resolver.resolve(url))
+                work_queue.finish(owner, item.id, DOWNLOAD, [{'url': url, 'date': date_created,
+                                                              'subreddit': payload['subreddit']}
+                                                             for url, date_created in submissions])
+            else:
+                # Downloads queued before they carried their subreddit go under the one given with -sr.
+                filename = download_file(payload['url'], payload['date'], verbose, store, manifest, session, throttle,
+                                         parser.retries, directory, content_filter,
+                                         layout(payload.get('subreddit') or parser.subreddit), sink)
+                work_queue.finish(owner, item.id)
+                if processor is not None and filename is not None:
+                    processor.process(filename, manifest)
+        except filters.Rejected as e:
+            metrics.count('files_rejected')
+            work_queue.finish(owner, item.id)
+            if verbose:
+                print("\n!! Skipped {}".format(e))
+        except TransientError as e:
+            work_queue.fail(owner, item.id)
+            if verbose:
+                print("\n!! {} will be retried: {}".format(item.kind.capitalize(), e))
+        except DownloadError as e:
+            metrics.count('files_failed')
+            work_queue.fail(owner, item.id, retry=False)
+            if verbose:
+                print("\n!! Download of {} failed: {}".format(payload['url'], e))
+        except Exception as e:
+            work_queue.fail(owner, item.id)
+            print("\n!! {} failed, it will be retried: {}".format(item.kind.capitalize(), e))
+
+    # The item id each running download or listing is working on.
+    running = dict()
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(parser.lease / 3):
+            with lock:
+                held = list(running.values())
+            work_queue.heartbeat(owner, held)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    with reporting(parser.progress, parser.metrics_json, parser.metrics_prom), \
+            ThreadPoolExecutor(max_workers=parser.workers) as executor:
+        try:
+            while True:
+                free = parser.workers - len(running)
+                for item in work_queue.claim(owner, free) if free else []:
+                    with lock:
+                        running[executor.submit(execute, item)] = item.id
+
+                if running:
+                    done, _ = wait(list(running), timeout=poll, return_when=FIRST_COMPLETED)
+                    for finished in done:
+                        with lock:
+                            del running[finished]
+                        finished.result()
+                elif work_queue.finished():
+                    break
+                else:
+                    time.sleep(poll)
+        finally:
+            stopped.set()
+            if processor is not None:
+                processor.close()
+            if sink is not None:
+                sink.close()
+
+    counts = work_queue.counts()
+    work_queue.close()
+    return counts
+
+
+# The options for async.main: parser's own, with the subreddit and dates to scrape in place of -sr, -bd
+# and -ed, which may have come from asking rather than the command line.
+def async_args(parser, subreddit, begin_date=None, end_date=None):
+    return argparse.Namespace(**dict(vars(parser), subreddit=subreddit, begin_date=begin_date, end_date=end_date))
+
+
+# Adds the options the threaded and async downloaders share to parser, the same for this command line
+# and async's own.  Given async_note, the ones only the async downloader looks at say so.
+def add_arguments(parser, async_note=False):
+    note = 'Async only. ' if async_note else ''
+
+    parser.add_argument('-i', '--imgur', action='store_true', default=False,
+                        help='Download images from imgur pages and albums and reddit galleries as well.')
+    parser.add_argument('--max-concurrency', type=int, default=64,
+                        help=note + 'Most downloads in flight at once, and the size of the connection pool.')
+    parser.add_argument('--auto-concurrency', action='store_true', default=False,
+                        help=note + 'Work out how many downloads to have in flight from the throughput, latency '
+                                    'and errors seen, between --min-concurrency and --max-concurrency.')
+    parser.add_argument('--min-concurrency', type=int, default=4,
+                        help=note + 'With --auto-concurrency, fewest downloads in flight at once.')
+    parser.add_argument('--per-host-limit', type=int, default=8,
+                        help=note + 'Most simultaneous connections to any one host.')
+    parser.add_argument('--keepalive', type=float, default=30,
+                        help=note + 'Seconds to keep an idle pooled connection open.')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='Most listed submissions waiting to be downloaded at once, or held in memory with '
+                             '--spill.')
+    parser.add_argument('--spill', action='store_true', default=False,
+                        help='Let the listing run ahead of the downloads, with submissions past --queue-size '
+                             'waiting in a temporary file instead of memory.')
+    parser.add_argument('--listing-workers', type=int, default=1,
+                        help='Number of days to list from Reddit in parallel.')
+    parser.add_argument('--api-rate', type=int, default=60,
+                        help='Most Reddit API requests per minute, shared by all listing workers.')
+    parser.add_argument('--adaptive', action='store_true', default=False,
+                        help='Size search windows by how busy the subreddit is instead of listing day by day.')
+    parser.add_argument('--dumps', nargs='+', metavar='PATH',
+                        help='Pushshift style submission dumps (NDJSON, plain or compressed with zstd, bz2, xz or '
+                             'gzip), or directories of them, to list from instead of Reddit.')
+    parser.add_argument('--dump-workers', type=int, default=0,
+                        help='With --dumps, processes parsing the dumps. 0 for one per core.')
+    parser.add_argument('--index', help='SQLite file to keep listed submissions in, so later runs only list what is new.')
+    parser.add_argument('--dedup', help='SQLite file recording downloaded images by content, so each one is stored once.')
+    parser.add_argument('--link', choices=['hard', 'sym'], default='hard',
+                        help='How duplicates found by --dedup are linked to the stored copy.')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Keep a manifest of downloads so a restarted run skips finished files and resumes partial ones.')
+    parser.add_argument('--output-dir', help='Directory to download into, instead of the current directory.')
+    parser.add_argument('--layout', choices=LAYOUTS, default='flat',
+                        help='How downloads are laid out in the output directory: flat, in date (year/month) or '
+                             'subreddit (subreddit/year/month) directories, or spread over hash directories.')
+    parser.add_argument('--archive', choices=ARCHIVE_FORMATS,
+                        help='Write downloads into numbered archives of this kind instead of a file each.')
+    parser.add_argument('--archive-size', type=int, default=1024,
+                        help='Megabytes an archive grows to before the next one is started (default 1024).')
+    parser.add_argument('--write-buffer', type=int, default=BUFFER_SIZE // 1024,
+                        help=note + 'Kilobytes of each download collected before writing them to disk '
+                                    '(default {}).'.format(BUFFER_SIZE // 1024))
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none',
+                        help=note + 'none leaves flushing downloads to disk to the OS, file fsyncs each one '
+                                    'before renaming it into place, dir fsyncs its directory after the rename as well.')
+    parser.add_argument('--host-rate', type=float, default=0,
+                        help='Most requests per second to any one image host. 0 for no limit.')
+    parser.add_argument('--timeout', type=float, default=download_timeout,
+                        help='Seconds to wait for an image host to connect or send more of a download before '
+                             'retrying it. Async applies it to the whole request instead, like aiohttp does '
+                             '(default {}).'.format(download_timeout))
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Times to retry a download after a connection error, 429 or 5xx.')
+    parser.add_argument('--breaker-threshold', type=int, default=5,
+                        help='Failures in a row after which a host is left alone for --breaker-cooldown seconds.')
+    parser.add_argument('--breaker-cooldown', type=float, default=30,
+                        help='Seconds a failing host is left alone before trying it again.')
+    parser.add_argument('--resolve-workers', type=int, default=8,
+                        help='With -i, number of links to resolve at once.')
+    parser.add_argument('--link-cache', help='With -i, SQLite file to keep resolved links in so they are never looked up twice.')
+    parser.add_argument('--token-cache',
+                        help='JSON file to keep the Reddit access token in, so runs within the hour it lasts '
+                             'skip logging in.')
+    parser.add_argument('--min-bytes', type=int, default=0, help='Skip files smaller than this many bytes.')
+    parser.add_argument('--max-bytes', type=int, default=0,
+                        help='Skip files larger than this many bytes, cutting them off as soon as they are.')
+    parser.add_argument('--min-dimensions', metavar='WxH', help='Skip images narrower or shorter than this, like 640x480.')
+    parser.add_argument('--max-dimensions', metavar='WxH', help='Skip images wider or taller than this.')
+    parser.add_argument('--formats',
+                        help='Comma separated image formats to keep, out of {}, going by the file itself rather '
+                             'than its url.'.format(', '.join(filters.FORMATS)))
+    parser.add_argument('--thumbnails', metavar='WxH',
+                        help='Also save a copy of each image shrunk to fit in this size, like 256x256. Needs Pillow.')
+    parser.add_argument('--thumbnail-dir', default='thumbnails',
+                        help='Directory to save thumbnails in, relative to the images unless absolute.')
+    parser.add_argument('--strip-metadata', action='store_true', default=False,
+                        help='Remove EXIF and other metadata from JPEGs and PNGs, without re-encoding them.')
+    parser.add_argument('--reencode', choices=sorted(postprocess.REENCODE_FORMATS),
+                        help='Save each image again in this format, in place of the original. Needs Pillow.')
+    parser.add_argument('--quality', type=int, default=85, help='Quality to re-encode at, 1 to 100.')
+    parser.add_argument('--process-workers', type=int, default=0,
+                        help='Processes for thumbnails, --strip-metadata, --reencode and --similar. 0 for one per '
+                             'core.')
+    parser.add_argument('--similar', metavar='FILE',
+                        help='Keep perceptual hashes of the images downloaded in this SQLite file, and catch ones that '
+                             'look the same as an earlier one even once resized or re-compressed. Needs Pillow and '
+                             'NumPy.')
+    parser.add_argument('--similar-distance', type=int, default=6,
+                        help='Most bits two hashes can differ in for the images to count as the same (default 6).')
+    parser.add_argument('--similar-action', choices=('flag', 'delete'), default='flag',
+                        help='flag records near duplicates in the --similar file and keeps them, delete deletes them.')
+    parser.add_argument('--progress', action='store_true', default=False,
+                        help='Show a single progress line, redrawn every second, instead of a print per file.')
+    parser.add_argument('--metrics-json', help='Write a JSON summary of counters and latencies here once done.')
+    parser.add_argument('--metrics-prom', help='Write the same metrics here for the Prometheus textfile collector.')
 
 
 # Can easily expand amount of args using the verbosity as a baseline example.
@@ -193,10 +875,28 @@ def parse_args(args):
     # Add arguments here.
     parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output.', default=False)
     parser.add_argument('-as', '--async', action='store_true', help='Run async version of code. Should be faster.')
-    parser.add_argument('-i', '--imgur', action='store_true', help='Download images from imgur albums as well.')
     parser.add_argument('-bd', '--begin-date', help='Begin date')
     parser.add_argument('-ed', '--end-date', help='End date.')
     parser.add_argument('-sr', '--subreddit', help='Subreddit.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Sync only. Number of files to download at once on a pool of threads.')
+    parser.add_argument('--jobs', help='JSON or YAML file listing subreddits, date ranges and output directories '
+                                       'to scrape, all in this one process.')
+    parser.add_argument('--parallel-jobs', type=int, default=4,
+                        help='With --jobs or --follow, number of jobs or subreddits to list at once.')
+    parser.add_argument('--follow', metavar='FILE',
+                        help='Download whatever has been posted to the -sr subreddits (comma separated) since the '
+                             'last run, keeping how far each has got in this SQLite file. -bd limits how far back '
+                             'the first run goes.')
+    parser.add_argument('--poll', type=float, default=0,
+                        help='With --follow, keep checking for new submissions every this many seconds.')
+    parser.add_argument('--coordinate', metavar='QUEUE',
+                        help='Put the days to scrape on the work queue in this SQLite file, for --work to run.')
+    parser.add_argument('--work', metavar='QUEUE',
+                        help='Run work from the queue in this SQLite file, on -w threads, until there is none left.')
+    parser.add_argument('--lease', type=float, default=60,
+                        help='Seconds a worker holds work it has claimed before others may take it over.')
+    add_arguments(parser, async_note=True)
 
     # Return the parse object.
     return parser.parse_args(args)
@@ -211,6 +911,84 @@ def main(args):
     end_date = parser.end_date
     subreddit = parser.subreddit
 
+    # With any of the filters given, only files that really are images get through, not just urls that say so.
+    try:
+        content_filter = filters.make_filter(parser.min_bytes, parser.max_bytes, parser.min_dimensions,
+                                             parser.max_dimensions, parser.formats)
+        processing = postprocess.processing_options(parser.thumbnails, parser.thumbnail_dir, parser.strip_metadata,
+                                                    parser.reencode, parser.quality, parser.similar is not None)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if parser.reencode is not None and parser.dedup is not None:
+        sys.exit("--reencode replaces downloaded files, which --dedup keeps links to, so they can't be used together.")
+    if parser.similar_action == 'delete' and parser.dedup is not None:
+        sys.exit("--similar-action delete deletes downloaded files, which --dedup keeps links to, so they can't be "
+                 "used together.")
+    if parser.archive is not None and (parser.resume or parser.dedup is not None or processing is not None):
+        sys.exit("--archive never writes downloads as files of their own, so it can't be used with --resume, "
+                 "--dedup or any of the processing options.")
+
+    if parser.output_dir is not None:
+        os.makedirs(parser.output_dir, exist_ok=True)
+
+    # Processing runs on its own pool of processes, next to the downloads, rather than as a pass afterwards.
+    def post_processor():
+        return postprocess.PostProcessor(processing, parser.process_workers or None, verbose=verbose,
+                                         near_duplicates=postprocess.near_duplicates(
+                                             parser.similar, parser.similar_distance, parser.similar_action,
+                                             verbose)) \
+            if processing is not None else None
+
+    if parser.dumps is not None and (parser.work is not None or parser.follow is not None or parser.jobs is not None or
+                                     parser.coordinate is not None):
+        sys.exit("--dumps lists one -sr between -bd and -ed, so it can't be used with --work, --follow, --jobs or "
+                 "--coordinate.")
+
+    if parser.work is not None:
+        if parser.async:
+            sys.exit('--work runs on the threaded downloader, set its size with -w instead of using -as.')
+
+        print("\nWorking on the queue in {} as {}:{}".format(parser.work, socket.gethostname(), os.getpid()))
+        counts = work_from_queue(parser.work, parser, content_filter=content_filter, processor=post_processor())
+        print("Queue finished: {done} done, {failed} failed.".format(**counts))
+        return {'queue': counts, 'async': False, 'verbose': verbose}
+
+    if parser.follow is not None:
+        if subreddit is None:
+            sys.exit('--follow needs the subreddits to follow, comma separated, with -sr.')
+        if end_date is not None:
+            sys.exit('--follow downloads everything up to now, leave out -ed.')
+
+        names = follow.subreddits(subreddit)
+        floor = None
+        if begin_date is not None:
+            month_b, day_b, year_b = map(int, begin_date.split('.'))
+            floor = convert_dates(year_b, month_b, day_b, year_b, month_b, day_b)[0][0]
+
+        print("\nFollowing {} in {}".format(', '.join('/r/' + name for name in names), parser.follow))
+        if parser.async:
+            from redditimagescraper.modules import async
+            async.main(async_args(parser, ','.join(names), begin_date))
+        else:
+            follow_subreddits(names, parser, floor, content_filter, post_processor())
+        print("Scraping complete.")
+        return {'follow': names, 'async': parser.async, 'verbose': verbose}
+
+    if parser.jobs is not None:
+        if parser.async:
+            sys.exit('--jobs runs on the threaded downloader, set its size with -w instead of using -as.')
+
+        try:
+            jobs = load_jobs(parser.jobs)
+        except ValueError as e:
+            sys.exit(str(e))
+
+        print("\nRunning {} jobs from {}".format(len(jobs), parser.jobs))
+        run_jobs(jobs, parser, content_filter, post_processor())
+        print("Scraping complete.")
+        return {'jobs': jobs, 'async': False, 'verbose': verbose}
+
     # Check if user passed in their own arguments in the command line and update user_vars dict appropriately.
     if begin_date is not None and end_date is not None and subreddit is not None:
         month_b, day_b, year_b = map(int, begin_date.split('.'))
@@ -226,20 +1004,35 @@ def main(args):
         # Didn't do a quick run, so set that value to False.
         user_vars['quick_run'] = False
 
-    # Do future imgur stuff here.
+    # Whether links were resolved into the images behind them.
     user_vars['imgur'] = parser.imgur
 
+    if parser.coordinate is not None:
+        counts = coordinate(parser.coordinate, user_vars['subreddit'], user_vars['epoch_date_range'], parser.lease)
+        print("\nQueued /r/{} from {} to {} on {}: {} items waiting, {} in progress, {} done, {} failed.".format(
+            user_vars['subreddit'], user_vars['start_date'], user_vars['end_date'], parser.coordinate,
+            counts['pending'], counts['leased'], counts['done'], counts['failed']))
+        user_vars['queue'] = counts
+        return user_vars
+
+    # --dumps lists from submission dumps on disk instead of Reddit, which never has to be logged into.
+    dump_files = None
+    if parser.dumps is not None:
+        try:
+            dump_files = dumps.dump_files(parser.dumps, user_vars['epoch_date_range'][0][0],
+                                          user_vars['epoch_date_range'][-1][1])
+        except ValueError as e:
+            sys.exit(str(e))
+
     print("\nDownloading all {} from /r/{} between dates {} and {}".format(
         str(config.extensions), str(user_vars['subreddit']), user_vars['start_date'], user_vars['end_date']))
 
     if parser.async:
-        args = [user_vars['subreddit'], user_vars['start_date'], user_vars['end_date']]
-        # Gotta add in the '-v' argument if user passed it in.
+        args = async_args(parser, user_vars['subreddit'], user_vars['start_date'], user_vars['end_date'])
         if verbose:
             user_vars['verbose'] = True
-            # Appending -v arg to our call to async since it needs our args added to it again.
-            args.append('-v')
 
+        from redditimagescraper.modules import async
         async.main(args)
 
         # Update user_vars to indicate that we ran the async module.
@@ -250,10 +1043,33 @@ def main(args):
         # Didn't run async, so set that to false.
         user_vars['async'] = False
 
-    # Get the subs to download from accessreddit
-    subs_to_download = accessreddit.subs_to_download(user_vars['subreddit'],
-                                                     user_vars['epoch_date_range'],
-                                                     config.extensions, verbose)
+    submission_index = index.SubmissionIndex(parser.index) if parser.index is not None else None
+    store = dedup.ContentStore(parser.dedup, parser.link) if parser.dedup is not None else None
+    directory = output_directory(parser)
+    manifest = Manifest(directory or os.getcwd()) if parser.resume else None
+    layout = Layout(parser.layout, user_vars['subreddit'])
+
+    from redditimagescraper.modules import accessreddit
+    from redditimagescraper.modules import resolve
+
+    # Get the subs to download from accessreddit, or from --dumps. Listing only starts once we begin streaming
+    # them below.
+    # With -i every link is listed, and resolved into the images behind it on its way to being downloaded.
+    exts = resolve.ALL_LINKS if parser.imgur else config.extensions
+    if dump_files is not None:
+        subs_to_download = dumps.dump_submissions(dump_files, user_vars['subreddit'],
+                                                  user_vars['epoch_date_range'][0][0],
+                                                  user_vars['epoch_date_range'][-1][1], exts,
+                                                  parser.dump_workers or None, verbose)
+    else:
+        subs_to_download = accessreddit.subs_to_download(user_vars['subreddit'],
+                                                         user_vars['epoch_date_range'],
+                                                         exts, verbose, parser.listing_workers, parser.api_rate,
+                                                         parser.adaptive, submission_index,
+                                                         token_cache=parser.token_cache)
+    if parser.imgur:
+        resolver = resolve.make_resolver(config.extensions, parser.link_cache, parser.resolve_workers, verbose)
+        subs_to_download = resolve.resolve_all(subs_to_download, resolver, parser.resolve_workers)
 
     if verbose:
         total_start_msg = 'Downloading started at {}'
@@ -264,11 +1080,29 @@ def main(args):
     else:
         user_vars['verbose'] = False
 
-    # This is the actual downloading part.
-    for sub_urls in subs_to_download:
-        url = sub_urls[0]
-        date_created = sub_urls[1]
-        download_file(url, date_created, verbose)
+    # This is the actual downloading part. Submissions are listed on a background thread and
+    # downloaded here as they arrive, one at a time or on --workers threads.
+    session = make_session(parser.workers, parser.timeout)
+    throttle = HostThrottle(parser.host_rate, parser.breaker_threshold, parser.breaker_cooldown)
+    processor = post_processor()
+    sink = archive_sink(parser, directory, user_vars['subreddit'])
+    with reporting(parser.progress, parser.metrics_json, parser.metrics_prom):
+        try:
+            if parser.workers > 1:
+                download_in_parallel(pipeline.stream(subs_to_download, parser.queue_size, parser.spill),
+                                     parser.workers, verbose, store, manifest, session, throttle, parser.retries,
+                                     content_filter, processor, directory, layout, sink)
+            else:
+                for sub_urls in pipeline.stream(subs_to_download, parser.queue_size, parser.spill):
+                    url = sub_urls[0]
+                    date_created = sub_urls[1]
+                    download_or_report(url, date_created, verbose, store, manifest, session, throttle,
+                                       parser.retries, directory, content_filter, processor, layout, sink)
+        finally:
+            if processor is not None:
+                processor.close()
+            if sink is not None:
+                sink.close()
 
     if verbose:
         print(total_end_msg.format(time.strftime("%H:%M:%S"), (datetime.now() - total_dl_time_start).total_seconds()))
@@ -1,3 +1,215 @@
+import time
+import unittest.mock as mock
+
+import prawcore.exceptions
 import pytest
-import hypothesis
+import requests_mock
+
+from redditimagescraper import scrape
+from redditimagescraper.modules import accessreddit
+from redditimagescraper.modules import index
+from redditimagescraper.modules.tokencache import TokenCache
+
+# list of epoch ranges for each day between
+date_list = scrape.convert_dates(2017, 1, 1, 2017, 1, 10)
+
+
+# Stand-in for a praw subreddit.  Each day has an image, a gif and a self post, newest first,
+# and every listing takes a little while to come back.
+class FakeSubreddit:
+    display_name = 'hamsters'
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.listed = 0
+
+    def submissions(self, start, end):
+        time.sleep(self.delay)
+        self.listed += 1
+        return [mock.Mock(id='a{}'.format(int(start)), url='https://i.redd.it/{}.png'.format(int(start)),
+                          created_utc=start + 3),
+                mock.Mock(id='b{}'.format(int(start)), url='https://i.redd.it/{}.gif'.format(int(start)),
+                          created_utc=start + 2),
+                mock.Mock(id='c{}'.format(int(start)), url='https://www.reddit.com/r/hamsters/{}'.format(int(start)),
+                          created_utc=start + 1)]
+
+
+def expected_subs(exts):
+    return [sub for window in date_list
+            for sub in accessreddit.window_submissions(FakeSubreddit(), window, exts, False)]
+
+
+# Parallel listing should give back exactly what sequential listing does, in the same order, only faster.
+@pytest.mark.parametrize('exts', [('.png',), ('.png', '.gif')])
+def test_subs_to_download_parallel(exts):
+    with mock.patch('praw.Reddit') as reddit:
+        reddit.return_value.subreddit.return_value = FakeSubreddit(0.05)
+
+        sequential_time = time.monotonic()
+        sequential = list(accessreddit.subs_to_download('hamsters', date_list, exts, False))
+        sequential_time = time.monotonic() - sequential_time
+
+        parallel_time = time.monotonic()
+        parallel = list(accessreddit.subs_to_download('hamsters', date_list, exts, False, workers=5))
+        parallel_time = time.monotonic() - parallel_time
+
+    assert sequential == parallel == expected_subs(exts)
+    assert len(parallel) == len(date_list) * len(exts)
+    assert parallel_time < sequential_time / 2
+
+
+# Given an invalid subreddit, we should be asked for another and carry on from the day that failed.
+@pytest.mark.parametrize('workers', [1, 4])
+def test_subs_to_download_invalid_subreddit(workers):
+    invalid = mock.Mock()
+    invalid.submissions.side_effect = prawcore.exceptions.BadRequest(mock.Mock(status_code=400))
+
+    with mock.patch('praw.Reddit') as reddit, mock.patch('builtins.input', return_value='hamsters'):
+        reddit.return_value.subreddit.side_effect = lambda name: invalid if name == 'hamstrs' else FakeSubreddit()
+        subs = list(accessreddit.subs_to_download('hamstrs', date_list, ('.png',), False, workers=workers))
+
+    assert subs == expected_subs(('.png',))
+
+
+# Every request sent through the adapter should take a token from the budget first.
+def test_rate_limited_adapter():
+    budget = mock.Mock()
+    adapter = accessreddit.RateLimitedAdapter(budget)
+
+    with mock.patch('requests.adapters.HTTPAdapter.send', return_value='response') as send:
+        assert adapter.send('request', timeout=1) == 'response'
+        assert adapter.send('request', timeout=1) == 'response'
+
+    assert budget.take.call_count == 2
+    assert send.call_count == 2
+
+
+# Stand-in for a praw subreddit that answers cloudsearch timestamp queries the way Reddit does,
+# newest first and cut off at the search cap, from a fixed list of submission times.
+class FakeSearchSubreddit:
+    display_name = 'hamsters'
+
+    def __init__(self, created):
+        self.created = sorted(created, reverse=True)
+        self.queries = 0
+
+    def search(self, query, sort, syntax, limit):
+        self.queries += 1
+        start, end = (int(t) - accessreddit.CLOUDSEARCH_UTC_OFFSET for t in query.split(':')[1].split('..'))
+        found = [mock.Mock(id=str(t), url='https://i.redd.it/{}.jpg'.format(t), created_utc=t)
+                 for t in self.created if start <= t <= end]
+        return found[:accessreddit.SEARCH_CAP]
+
+
+def adaptive_subs(subreddit, date_list, index=None):
+    with mock.patch('praw.Reddit') as reddit:
+        reddit.return_value.subreddit.return_value = subreddit
+        return list(accessreddit.subs_to_download('hamsters', date_list, ('.jpg',), False, adaptive=True,
+                                                  index=index))
+
+
+# A sparse subreddit over a year should take far fewer searches than there are days, without losing anything.
+def test_adaptive_sparse():
+    year = scrape.convert_dates(2016, 1, 1, 2016, 12, 31)
+    begin = int(year[0][0])
+    created = [begin + n * 7 * accessreddit.DAY + 3600 for n in range(52)]
+    subreddit = FakeSearchSubreddit(created)
+
+    subs = adaptive_subs(subreddit, year)
+
+    assert sorted(int(url.split('/')[-1][:-4]) for url, _ in subs) == created
+    assert subreddit.queries * 10 < len(year)
+
+
+# A day with more submissions than the search cap should be split until nothing is cut off.
+def test_adaptive_dense():
+    days = scrape.convert_dates(2016, 1, 1, 2016, 1, 3)
+    begin = int(days[0][0])
+    created = [begin + accessreddit.DAY + n * 20 for n in range(3000)]
+    subreddit = FakeSearchSubreddit(created)
+
+    subs = adaptive_subs(subreddit, days)
+
+    assert sorted(int(url.split('/')[-1][:-4]) for url, _ in subs) == created
+
+
+# A second run over the same days should come entirely out of the index, and a run over a longer
+# range should only list the days the index is missing.
+@pytest.mark.parametrize('workers', [1, 4])
+def test_subs_to_download_index(workers, tmpdir):
+    submission_index = index.SubmissionIndex(str(tmpdir.join('index.sqlite')))
+    longer_date_list = scrape.convert_dates(2017, 1, 1, 2017, 1, 15)
+
+    with mock.patch('praw.Reddit') as reddit:
+        subreddit = reddit.return_value.subreddit.return_value = FakeSubreddit()
+
+        first = list(accessreddit.subs_to_download('hamsters', date_list, ('.png',), False, workers, index=submission_index))
+        assert subreddit.listed == len(date_list)
+
+        second = list(accessreddit.subs_to_download('hamsters', date_list, ('.png',), False, workers, index=submission_index))
+        assert subreddit.listed == len(date_list)
+
+        # A different filter should still be answered from the index.
+        gifs = list(accessreddit.subs_to_download('hamsters', date_list, ('.gif',), False, workers, index=submission_index))
+        assert subreddit.listed == len(date_list)
+
+        longer = list(accessreddit.subs_to_download('hamsters', longer_date_list, ('.png',), False, workers,
+                                                    index=submission_index))
+        assert subreddit.listed == len(longer_date_list)
+
+    assert first == second == expected_subs(('.png',))
+    assert gifs == expected_subs(('.gif',))
+    assert longer[:len(first)] == first and len(longer) == len(longer_date_list)
+
+
+# Adaptive listing with an index should only search the stretch the index doesn't cover.
+def test_adaptive_index(tmpdir):
+    submission_index = index.SubmissionIndex(str(tmpdir.join('index.sqlite')))
+    year = scrape.convert_dates(2016, 1, 1, 2016, 12, 31)
+    begin = int(year[0][0])
+    created = [begin + n * 7 * accessreddit.DAY + 3600 for n in range(52)]
+
+    first = adaptive_subs(FakeSearchSubreddit(created), year[:180], submission_index)
+
+    subreddit = FakeSearchSubreddit(created)
+    subs = adaptive_subs(subreddit, year, submission_index)
+
+    assert sorted(subs[:len(first)]) == sorted(first)
+    assert sorted(int(url.split('/')[-1][:-4]) for url, _ in subs) == created
+    assert subreddit.queries * 20 < len(year)
+
+
+# Logging in with a token cache should only ask Reddit for a token when the cache has no good one,
+# and a cached token Reddit has revoked should be replaced by a fresh one.
+def test_login_token_cache(tmpdir):
+    token_cache = str(tmpdir.join('token.json'))
+    tokens = iter(['first', 'second'])
+
+    def token(request, context):
+        return {'access_token': next(tokens), 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*'}
+
+    def me(request, context):
+        if request.headers['Authorization'] == 'bearer revoked':
+            context.status_code = 401
+            context.headers['www-authenticate'] = 'Bearer realm="reddit", error="invalid_token"'
+            return {}
+        return {'name': request.headers['Authorization']}
+
+    with requests_mock.Mocker() as adapter, mock.patch('praw.Reddit.update_checked', True):
+        adapter.post('https://www.reddit.com/api/v1/access_token', json=token)
+        adapter.get('https://oauth.reddit.com/api/v1/me', json=me)
+
+        def whoami():
+            return accessreddit.login(False, token_cache=token_cache)._core.request('GET', '/api/v1/me')['name']
+
+        assert whoami() == 'bearer first'
+        assert whoami() == 'bearer first'
+        assert len([r for r in adapter.request_history if r.method == 'POST']) == 1
+
+        cache = TokenCache(token_cache)
+        key = list(cache.read())[0]
+        cache.save(key, 'revoked', time.time() + 3600, ['*'])
 
+        assert whoami() == 'bearer second'
+        assert len([r for r in adapter.request_history if r.method == 'POST']) == 2
+        assert cache.load(key)['access_token'] == 'second'
@@ -0,0 +1,51 @@
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from redditimagescraper.modules.archive import ArchiveSink
+from redditimagescraper.modules.metrics import reporting
+
+
+def add(sink, name, data):
+    with sink.spool() as spool:
+        spool.write(data)
+        sink.add(name, spool)
+
+
+def members(path):
+    if path.endswith('.tar'):
+        with tarfile.open(path) as archive:
+            return {info.name: archive.extractfile(info).read() for info in archive.getmembers()}
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+# Downloads should be split over archives of about max_bytes each, only renamed once finished, and
+# numbering should carry on from the archives a previous run left.
+@pytest.mark.parametrize('kind', ['tar', 'zip'])
+def test_archive_sink(kind, tmpdir):
+    files = {'2017/01/20170101_000000_{}.jpg'.format(n): os.urandom(400 + n) for n in range(5)}
+
+    with reporting() as run_metrics:
+        sink = ArchiveSink(str(tmpdir), kind, max_bytes=1000, prefix='pics')
+        for name, data in sorted(files.items()):
+            add(sink, name.replace('/', os.sep), data)
+            assert len([path for path in os.listdir(str(tmpdir)) if path.endswith('.part')]) == 1
+        sink.close()
+
+    names = ['pics-00001.{}'.format(kind), 'pics-00002.{}'.format(kind), 'pics-00003.{}'.format(kind)]
+    assert sorted(os.listdir(str(tmpdir))) == names
+    assert run_metrics.counter('files_archived') == 5
+    assert run_metrics.counter('archives_written') == 3
+
+    found = dict()
+    for name in names:
+        found.update(members(str(tmpdir.join(name))))
+    assert found == files
+
+    sink = ArchiveSink(str(tmpdir), kind, prefix='pics')
+    add(sink, 'another.jpg', b'image')
+    sink.close()
+    assert members(str(tmpdir.join('pics-00004.{}'.format(kind)))) == {'another.jpg': b'image'}
@@ -0,0 +1,417 @@
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import unittest.mock as mock
+import zipfile
+
+import pytest
+import aiohttp
+from aiofiles.threadpool import AsyncBufferedReader
+from aiohttp import web
+
+from redditimagescraper.modules import async
+from redditimagescraper.modules import dedup
+from redditimagescraper.modules import filters
+from redditimagescraper.modules import manifest
+from redditimagescraper.modules import throttle
+from redditimagescraper.modules.archive import ArchiveSink
+from redditimagescraper.modules.asyncreddit import NETWORK_ERRORS
+from redditimagescraper.modules.concurrency import ConcurrencyController
+from redditimagescraper.modules.layout import Layout
+from redditimagescraper.modules.writer import DiskWriter
+
+
+# Runs download_worker over urls with fetch_image replaced by fake_fetch_image, the listing closed
+# once every url is scheduled.  Returns the scheduler.
+def run_workers(loop, urls, fake_fetch_image, per_host_limit=8, retries=0, workers=8, controller=None):
+    scheduler = async.DownloadScheduler(throttle.HostThrottle(), per_host_limit, 4, retries, loop, controller)
+    download_worker = async.download_worker
+
+    async def list_submissions():
+        for url in urls:
+            await scheduler.put([url, '20170101_000000'])
+        scheduler.close()
+
+    with mock.patch('redditimagescraper.modules.async.fetch_image', side_effect=fake_fetch_image), \
+            mock.patch('redditimagescraper.modules.async.backoff', return_value=0):
+        tasks = [download_worker(scheduler, None, False) for _ in range(workers)]
+        loop.run_until_complete(asyncio.gather(list_submissions(), *tasks, loop=loop))
+
+    return scheduler
+
+
+# Given more downloads than workers, every download should happen and no host should ever have
+# more than per_host_limit downloads running at once.
+@pytest.mark.parametrize('per_host_limit', [1, 3])
+def test_download_worker(per_host_limit):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    urls = ['https://i.redd.it/{}.jpg'.format(n) for n in range(10)] + \
+           ['https://i.imgur.com/{}.jpg'.format(n) for n in range(10)]
+
+    running = {'i.redd.it': 0, 'i.imgur.com': 0}
+    most_running = {'i.redd.it': 0, 'i.imgur.com': 0}
+    downloaded = list()
+
+    async def fake_fetch_image(session, url, date_created, verbose, store=None, manifest=None, content_filter=None,
+                               directory=None, layout=None, archive=None, writer=None):
+        host = url.split('/')[2]
+        running[host] += 1
+        most_running[host] = max(most_running[host], running[host])
+        await asyncio.sleep(0.001)
+        running[host] -= 1
+        downloaded.append(url)
+
+    run_workers(loop, urls, fake_fetch_image, per_host_limit)
+    loop.close()
+
+    assert sorted(downloaded) == sorted(urls)
+    assert max(most_running.values()) == per_host_limit
+
+
+# With a controller, no more downloads than its limit should run at once, and it should hear about
+# every one of them.
+def test_download_worker_controller():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    running = [0]
+    most_running = [0]
+    controller = ConcurrencyController(2, 2)
+
+    async def fake_fetch_image(session, url, date_created, verbose, store=None, manifest=None, content_filter=None,
+                               directory=None, layout=None, archive=None, writer=None):
+        running[0] += 1
+        most_running[0] = max(most_running[0], running[0])
+        await asyncio.sleep(0.001)
+        running[0] -= 1
+
+    urls = ['https://i.redd.it/{}.jpg'.format(n) for n in range(10)]
+    with mock.patch.object(controller, 'record', wraps=controller.record) as record:
+        run_workers(loop, urls, fake_fetch_image, controller=controller)
+    loop.close()
+
+    assert most_running[0] == 2
+    assert record.call_count == len(urls)
+
+
+# Connection errors, dropped connections and 5xx should be retried up to retries times; a 404 or a
+# full disk shouldn't be retried, and no failure should stop the other downloads.
+def test_download_worker_retries():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    attempts = {'flaky': 0, 'dropped': 0, 'down': 0, 'gone': 0, 'full': 0, 'fine': 0}
+
+    async def fake_fetch_image(session, url, date_created, verbose, store=None, manifest=None, content_filter=None,
+                               directory=None, layout=None, archive=None, writer=None):
+        name = url.split('/')[-1][:-len('.jpg')]
+        attempts[name] += 1
+
+        if name == 'flaky' and attempts[name] < 3:
+            raise aiohttp.ClientError()
+        if name == 'dropped' and attempts[name] < 2:
+            raise aiohttp.errors.ServerDisconnectedError()
+        if name == 'down':
+            raise throttle.TransientError(url, 'HTTP 503')
+        if name == 'gone':
+            raise throttle.DownloadError(url, 'HTTP 404')
+        if name == 'full':
+            raise OSError(28, 'No space left on device')
+
+    urls = ['https://i.redd.it/{}.jpg'.format(name) for name in attempts]
+    scheduler = run_workers(loop, urls, fake_fetch_image, retries=3, workers=2)
+    loop.close()
+
+    assert attempts == {'flaky': 3, 'dropped': 2, 'down': 4, 'gone': 1, 'full': 1, 'fine': 1}
+    assert scheduler.running == 0
+
+
+# A host with an open circuit breaker should have its downloads held back while other hosts carry on.
+def test_scheduler_skips_parked_host():
+    loop = asyncio.new_event_loop()
+    host_throttle = throttle.HostThrottle(threshold=1, cooldown=30)
+    host_throttle.failure('https://i.imgur.com/a.jpg')
+
+    scheduler = async.DownloadScheduler(host_throttle, 8, 4, 0, loop)
+    put = scheduler.put
+    loop.run_until_complete(put(['https://i.imgur.com/a.jpg', '20170101_000000']))
+    loop.run_until_complete(put(['https://i.redd.it/a.jpg', '20170101_000000']))
+
+    job, _ = scheduler.ready()
+    assert job.host == 'i.redd.it'
+
+    job, wait = scheduler.ready()
+    assert job is None and 29 < wait <= 30
+
+    loop.close()
+
+
+# praw and requests are only needed for --adaptive and -i, so importing the module shouldn't load them.
+def test_lazy_imports():
+    code = 'import sys; import redditimagescraper.modules.async; ' \
+           'print(sorted(name for name in ("requests", "praw") if name in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            universal_newlines=True).stdout
+
+    assert output.strip() == '[]'
+
+
+# Pool flags should have sane defaults and be overridable from the command line.
+def test_get_args_pool():
+    args = async.get_args(['hamsters', '1.1.2015', '1.1.2015'])
+    assert (args.max_concurrency, args.per_host_limit, args.keepalive) == (64, 8, 30)
+
+    args = async.get_args(['hamsters', '1.1.2015', '1.1.2015', '--max-concurrency', 16, '--per-host-limit', 2])
+    assert (args.max_concurrency, args.per_host_limit) == (16, 2)
+
+
+# Filter and processing options that make no sense should end the run with a message, not a traceback.
+def test_bad_options():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    for bad in (['--min-dimensions', '640'], ['--max-dimensions', 'widexhigh'], ['--thumbnails', '256']):
+        with pytest.raises(SystemExit) as error:
+            async.main(['hamsters', '1.1.2015', '1.1.2015'] + bad)
+        assert 'like 640x480' in str(error.value.code)
+
+    loop.close()
+
+
+# Reporting flags should be off unless asked for.
+def test_get_args_metrics():
+    args = async.get_args(['hamsters', '1.1.2015', '1.1.2015'])
+    assert (args.progress, args.metrics_json, args.metrics_prom) == (False, None, None)
+
+    args = async.get_args(['hamsters', '1.1.2015', '1.1.2015', '--progress', '--metrics-prom', 'scrape.prom'])
+    assert (args.progress, args.metrics_prom) == (True, 'scrape.prom')
+
+
+# Starts a local image server for image_content that honours Range headers.  Returns its url and a
+# coroutine function that shuts it down.
+async def serve_image(loop, image_content):
+    async def handler(request):
+        if 'Range' in request.headers:
+            offset = int(request.headers['Range'][len('bytes='):-1])
+            if offset >= len(image_content):
+                return web.Response(status=416, text='Requested Range Not Satisfiable', content_type='text/html')
+            return web.Response(status=206, body=image_content[offset:])
+        return web.Response(body=image_content)
+
+    app = web.Application(loop=loop)
+    app.router.add_get('/image.jpg', handler)
+    handler = app.make_handler()
+    server = await loop.create_server(handler, '127.0.0.1', 0)
+
+    async def shutdown():
+        server.close()
+        await server.wait_closed()
+        await handler.finish_connections()
+
+    return 'http://127.0.0.1:{}/image.jpg'.format(server.sockets[0].getsockname()[1]), shutdown
+
+
+# fetch_image should resume a .part left by an earlier run and skip files the manifest has as complete.
+def test_fetch_image_resume(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    image_content = bytes(range(256)) * 64
+    filename = '20170101_000000_image.jpg'
+
+    # async is a keyword inside coroutines, so grab what we need from the module out here.
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def fetch_twice():
+        url, shutdown = await serve_image(loop, image_content)
+        run_manifest = manifest.Manifest(os.getcwd())
+        run_manifest.start(url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content[:5000])
+
+        async with make_session(loop, 4, 30) as session:
+            with mock.patch.object(session, 'get', wraps=session.get) as get:
+                await fetch_image(session, url, '20170101_000000', False, manifest=run_manifest)
+                await fetch_image(session, url, '20170101_000000', False, manifest=run_manifest)
+
+                assert get.call_count == 1
+                assert get.call_args[1]['headers'] == {'Range': 'bytes=5000-'}
+
+        await shutdown()
+
+    with tmpdir.as_cwd(), mock.patch.object(DiskWriter, 'close', autospec=True, side_effect=DiskWriter.close) as close:
+        loop.run_until_complete(fetch_twice())
+        loop.close()
+
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+        assert not os.path.exists(manifest.part_name(filename))
+
+    # With no writer given, fetch_image's own should be closed without blocking the loop.
+    assert close.call_args_list == [mock.call(mock.ANY, wait=False)]
+
+
+# With an archive, the download should go into it under its laid out name and nowhere else.
+def test_fetch_image_archive(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    image_content = os.urandom(10000)
+    sink = ArchiveSink(str(tmpdir), 'zip', prefix='pics')
+
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def fetch():
+        url, shutdown = await serve_image(loop, image_content)
+        try:
+            async with make_session(loop, 4, 30) as session:
+                assert await fetch_image(session, url, '20170101_000000', False, directory=str(tmpdir),
+                                         layout=Layout('date'), archive=sink) is None
+        finally:
+            await shutdown()
+
+    loop.run_until_complete(fetch())
+    loop.close()
+    sink.close()
+
+    assert os.listdir(str(tmpdir)) == ['pics-00001.zip']
+    with zipfile.ZipFile(str(tmpdir.join('pics-00001.zip'))) as archive:
+        assert archive.namelist() == ['2017/01/20170101_000000_image.jpg']
+        assert archive.read(archive.namelist()[0]) == image_content
+
+
+# A resumed download should be hashed for --dedup from the .part, a buffer at a time, and the rest.
+def test_fetch_image_resume_dedup(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    image_content = bytes(range(256)) * 64
+    filename = '20170101_000000_image.jpg'
+
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def fetch():
+        url, shutdown = await serve_image(loop, image_content)
+        run_manifest = manifest.Manifest(os.getcwd())
+        run_manifest.start(url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content[:5000])
+
+        store = dedup.ContentStore(str(tmpdir.join('dedup.sqlite')))
+        try:
+            async with make_session(loop, 4, 30) as session:
+                with mock.patch.object(store, 'add', return_value=False) as add:
+                    await fetch_image(session, url, '20170101_000000', False, store, run_manifest)
+        finally:
+            store.close()
+            await shutdown()
+        return add.call_args[0][2]
+
+    read = AsyncBufferedReader.read
+    with tmpdir.as_cwd(), mock.patch('redditimagescraper.modules.async.BUFFER_SIZE', 1024), \
+            mock.patch.object(AsyncBufferedReader, 'read', autospec=True, side_effect=read) as reads:
+        digest = loop.run_until_complete(fetch())
+        loop.close()
+
+    assert digest == hashlib.sha256(image_content).hexdigest()
+    assert [call[0][1] for call in reads.call_args_list] == [1024] * 6
+
+
+# A download the filter turns down from its first bytes should raise Rejected and leave nothing behind.
+def test_fetch_image_rejected(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    image_content = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + (4000).to_bytes(4, 'big') * 2 + bytes(2 ** 20)
+    content_filter = filters.ContentFilter(max_dimensions=(1920, 1080))
+
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def fetch():
+        url, shutdown = await serve_image(loop, image_content)
+        try:
+            async with make_session(loop, 4, 30) as session:
+                with pytest.raises(filters.Rejected):
+                    await fetch_image(session, url, '20170101_000000', False, content_filter=content_filter)
+        finally:
+            await shutdown()
+
+    with tmpdir.as_cwd():
+        loop.run_until_complete(fetch())
+        loop.close()
+
+        assert os.listdir() == []
+
+
+# A .part that already had the whole file should be finished off from a 416, even with a filter that
+# would turn down the 416's own error page.
+def test_fetch_image_416(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    image_content = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + (400).to_bytes(4, 'big') * 2 + bytes(5000)
+    content_filter = filters.ContentFilter(min_bytes=1000)
+    filename = '20170101_000000_image.jpg'
+
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def fetch():
+        url, shutdown = await serve_image(loop, image_content)
+        run_manifest = manifest.Manifest(os.getcwd())
+        run_manifest.start(url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content)
+        try:
+            async with make_session(loop, 4, 30) as session:
+                await fetch_image(session, url, '20170101_000000', False, manifest=run_manifest,
+                                  content_filter=content_filter)
+        finally:
+            await shutdown()
+        return run_manifest
+
+    with tmpdir.as_cwd():
+        run_manifest = loop.run_until_complete(fetch())
+        loop.close()
+
+        assert run_manifest.complete(filename)
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+
+
+# A connection dropped part way through a body should raise an error worth retrying, and leave no .part
+# behind without a manifest to resume it from.
+def test_fetch_image_dropped(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    make_session, fetch_image = async.make_session, async.fetch_image
+
+    async def image(request):
+        response = web.StreamResponse(headers={'Content-Type': 'image/jpeg'})
+        response.content_length = 100000
+        await response.prepare(request)
+        response.write(bytes(1000))
+        await response.drain()
+        request.transport.close()
+        return response
+
+    async def fetch():
+        app = web.Application(loop=loop)
+        app.router.add_get('/image.jpg', image)
+        handler = app.make_handler()
+        server = await loop.create_server(handler, '127.0.0.1', 0)
+        url = 'http://127.0.0.1:{}/image.jpg'.format(server.sockets[0].getsockname()[1])
+        try:
+            async with make_session(loop, 4, 30) as session:
+                with pytest.raises(NETWORK_ERRORS):
+                    await fetch_image(session, url, '20170101_000000', False)
+        finally:
+            server.close()
+            await server.wait_closed()
+            await handler.finish_connections()
+
+    with tmpdir.as_cwd():
+        loop.run_until_complete(fetch())
+        loop.close()
+
+        assert os.listdir() == []
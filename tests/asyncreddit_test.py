@@ -0,0 +1,282 @@
+import asyncio
+import os
+import sys
+import unittest.mock as mock
+from datetime import datetime
+
+import pytest
+import aiohttp
+from aiohttp import web
+
+from redditimagescraper.modules import asyncreddit
+from redditimagescraper.modules.follow import Follower, HighWaterMarks
+from redditimagescraper.modules.index import SubmissionIndex
+from redditimagescraper.modules.metrics import metrics, reporting
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fakeservers import RedditServer
+
+EXTS = ('.jpg', '.png')
+JAN_1 = 1483228800
+DAY = 86400
+
+
+# Runs coroutine(client) with an AsyncReddit pointed at url, on a loop of its own.
+def with_client(url, coroutine, **kwargs):
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        async with aiohttp.ClientSession(loop=loop) as session:
+            client = asyncreddit.AsyncReddit(session, loop, urls=(url, url), **kwargs)
+            return await coroutine(client)
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+# Every day should be paged through in full, several at once, with the days handed over in order,
+# each newest first like Reddit lists them, and only one login for all of it.  A second run should
+# read the days back from the index.
+def test_subs_to_download(tmpdir):
+    index = SubmissionIndex(str(tmpdir.join('index.db')))
+
+    with RedditServer('http://images', 'hamsters', datetime(2017, 1, 1), datetime(2017, 1, 4), per_day=250) as reddit:
+        def list_days(client):
+            listed = list()
+
+            async def put(submission):
+                listed.append(submission)
+
+            date_list = [(JAN_1 + day * DAY, JAN_1 + (day + 1) * DAY - 1) for day in range(3)]
+
+            async def run():
+                await asyncreddit.subs_to_download(client, 'hamsters', date_list, EXTS, put, 3, index)
+                return listed
+
+            return run()
+
+        with reporting():
+            listed = with_client(reddit.url, list_days)
+            assert metrics.counter('submissions_listed') == reddit.matching(EXTS) == len(listed)
+
+        requests = reddit.requests
+        assert requests >= 3 * 3 and reddit.logins == 1
+        days = [(submission.created_utc - JAN_1) // DAY for submission in listed]
+        assert days == sorted(days)
+        assert [submission.created_utc for submission in listed] == \
+            sorted((submission.created_utc for submission in listed), key=lambda created: (created // DAY, -created))
+        assert all(submission.url.endswith(EXTS) for submission in listed)
+
+        assert with_client(reddit.url, list_days) == listed
+        assert reddit.requests == requests
+
+    index.close()
+
+
+# Starts a local Reddit that turns away the first token and the first search, and says its rate
+# limit is used up on the next.  Returns its url, what it was asked, and a shutdown coroutine function.
+async def serve_reddit(loop):
+    calls = list()
+
+    async def access_token(request):
+        calls.append('login')
+        return web.json_response({'access_token': 'token{}'.format(calls.count('login')), 'expires_in': 3600,
+                                  'scope': '*'})
+
+    async def search(request):
+        calls.append((request.headers['Authorization'], request.GET.get('after')))
+        if request.match_info['subreddit'] != 'hamsters':
+            return web.Response(status=302, headers={'Location': '/subreddits/search'})
+        if request.headers['Authorization'] == 'bearer token1':
+            return web.Response(status=401)
+        if len(calls) == 4:
+            return web.Response(status=429, headers={'Retry-After': '0'})
+
+        if request.GET.get('after') is None:
+            children = [{'data': {'id': 'b', 'name': 't3_b', 'url': 'http://i/b.jpg', 'created_utc': JAN_1 + 20,
+                                  'created': JAN_1 + 20 + 28800}}]
+            return web.json_response({'data': {'children': children, 'after': 't3_b'}},
+                                     headers={'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '0.2'})
+
+        children = [{'data': {'id': 'a', 'name': 't3_a', 'url': 'http://i/a.png', 'created_utc': JAN_1 + 10,
+                              'created': JAN_1 + 10 + 28800}}]
+        return web.json_response({'data': {'children': children, 'after': None}})
+
+    app = web.Application(loop=loop)
+    app.router.add_post('/api/v1/access_token', access_token)
+    app.router.add_get('/r/{subreddit}/search', search)
+    handler = app.make_handler()
+    server = await loop.create_server(handler, '127.0.0.1', 0)
+
+    async def shutdown():
+        server.close()
+        await server.wait_closed()
+        await handler.finish_connections()
+
+    return 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1]), calls, shutdown
+
+
+# A turned down token should be swapped for a new one, a 429 retried, and a used up rate limit
+# waited out before the next request.
+def test_get_retries_and_rate_limit():
+    loop = asyncio.new_event_loop()
+
+    async def search():
+        url, calls, shutdown = await serve_reddit(loop)
+        try:
+            async with aiohttp.ClientSession(loop=loop) as session:
+                client = asyncreddit.AsyncReddit(session, loop, api_rate=6000, urls=(url, url))
+                with mock.patch('redditimagescraper.modules.asyncreddit.backoff', return_value=0):
+                    submissions = await client.window('hamsters', (JAN_1, JAN_1 + DAY - 1))
+                    paused_at = client.paused_until
+            return submissions, calls, paused_at
+        finally:
+            await shutdown()
+
+    started = loop.time()
+    with reporting():
+        submissions, calls, paused_at = loop.run_until_complete(search())
+
+        # The first page is fetched twice, the second time to check nothing new has turned up.
+        assert (metrics.counter('listing_retries'), metrics.counter('listing_pauses')) == (1, 2)
+    took = loop.time() - started
+    loop.close()
+
+    assert [submission.id for submission in submissions] == ['b', 'a']
+    assert calls[:5] == ['login', ('bearer token1', None), 'login', ('bearer token2', None),
+                         ('bearer token2', None)]
+    assert calls[5] == ('bearer token2', 't3_b')
+    assert took >= 0.2 and paused_at > started
+
+
+# A subreddit that doesn't exist should be asked for again, and listed once it does.
+def test_subs_to_download_missing_subreddit():
+    loop = asyncio.new_event_loop()
+    listed = list()
+
+    async def put(submission):
+        listed.append(submission)
+
+    async def run():
+        url, calls, shutdown = await serve_reddit(loop)
+        try:
+            async with aiohttp.ClientSession(loop=loop) as session:
+                client = asyncreddit.AsyncReddit(session, loop, api_rate=6000, urls=(url, url))
+                client.access_token = 'token2'
+                await asyncreddit.subs_to_download(client, 'hamstars', [(JAN_1, JAN_1 + DAY - 1)], EXTS, put)
+        finally:
+            await shutdown()
+
+    with mock.patch('builtins.input', return_value='hamsters') as ask, \
+            mock.patch('redditimagescraper.modules.asyncreddit.backoff', return_value=0):
+        loop.run_until_complete(run())
+    loop.close()
+
+    assert ask.call_count == 1
+    assert [submission.url for submission in listed] == ['http://i/b.jpg', 'http://i/a.png']
+
+
+# A search that keeps failing should give up with a ListingError after retries attempts.
+def test_get_gives_up():
+    loop = asyncio.new_event_loop()
+    attempts = list()
+
+    async def search(request):
+        attempts.append(request)
+        return web.Response(status=503)
+
+    async def run():
+        app = web.Application(loop=loop)
+        app.router.add_get('/r/hamsters/search', search)
+        handler = app.make_handler()
+        server = await loop.create_server(handler, '127.0.0.1', 0)
+        url = 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+        try:
+            async with aiohttp.ClientSession(loop=loop) as session:
+                client = asyncreddit.AsyncReddit(session, loop, retries=2, urls=(url, url))
+                client.access_token = 'token'
+                with pytest.raises(asyncreddit.ListingError):
+                    await client.get('/r/hamsters/search', {})
+        finally:
+            server.close()
+            await server.wait_closed()
+            await handler.finish_connections()
+
+    with mock.patch('redditimagescraper.modules.asyncreddit.backoff', return_value=0):
+        loop.run_until_complete(run())
+    loop.close()
+
+    assert len(attempts) == 3
+
+
+# Following a subreddit should list all of it the first time, get a 304 while nothing is new, and
+# only page back as far as the mark once something is.
+def test_new_submissions(tmpdir):
+    marks = HighWaterMarks(str(tmpdir.join('marks.sqlite')))
+    follower = Follower(marks)
+
+    with RedditServer('http://images', 'hamsters', datetime(2017, 1, 1), datetime(2017, 1, 3), per_day=150) as reddit:
+        def new_submissions(client):
+            return client.new_submissions('hamsters', follower, EXTS)
+
+        with reporting():
+            listed = with_client(reddit.url, new_submissions)
+            follower.commit()
+            assert len(listed) == reddit.matching(EXTS) and reddit.requests == 3
+
+            assert with_client(reddit.url, new_submissions) == []
+            follower.commit()
+            assert reddit.requests == 4 and metrics.counter('listings_not_modified') == 1
+
+            reddit.post(8)
+            listed = with_client(reddit.url, new_submissions)
+            follower.commit()
+            assert [submission.url for submission in listed] == \
+                [submission['url'] for submission in reddit.submissions[:8] if submission['url'].endswith(EXTS)]
+            assert reddit.requests == 5
+
+    marks.close()
+
+
+# A connection dropped part way through the body should be retried like any other network error.
+def test_get_retries_dropped_connection():
+    loop = asyncio.new_event_loop()
+    attempts = list()
+
+    async def search(request):
+        attempts.append(request)
+        if len(attempts) == 1:
+            response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+            response.content_length = 1000
+            await response.prepare(request)
+            response.write(b'{"data": ')
+            await response.drain()
+            request.transport.close()
+            return response
+        return web.json_response({'data': {'children': [], 'after': None}})
+
+    async def run():
+        app = web.Application(loop=loop)
+        app.router.add_get('/r/hamsters/search', search)
+        handler = app.make_handler()
+        server = await loop.create_server(handler, '127.0.0.1', 0)
+        url = 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+        try:
+            async with aiohttp.ClientSession(loop=loop) as session:
+                client = asyncreddit.AsyncReddit(session, loop, urls=(url, url))
+                client.access_token = 'token'
+                return await client.get('/r/hamsters/search', {})
+        finally:
+            server.close()
+            await server.wait_closed()
+            await handler.finish_connections()
+
+    with reporting(), mock.patch('redditimagescraper.modules.asyncreddit.backoff', return_value=0):
+        found = loop.run_until_complete(run())
+        assert metrics.counter('listing_retries') == 1
+    loop.close()
+
+    assert found == {'data': {'children': [], 'after': None}} and len(attempts) == 2
@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+from datetime import datetime
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench
+import startup
+from fakeservers import ImageServer, RedditServer
+
+
+# The fake Reddit should page through a search like Reddit does, newest first, and the image
+# server should keep handing back the same bytes for the same name.
+def test_fake_servers():
+    with ImageServer(sizes=(100, 200)) as images, \
+            RedditServer(images.url, 'hamsters', datetime(2017, 1, 1), datetime(2017, 1, 2), per_day=150) as reddit:
+        query = 'timestamp:0..9999999999'
+        first = requests.get(reddit.url + '/r/hamsters/search', params={'q': query, 'limit': 100}).json()['data']
+        rest = requests.get(reddit.url + '/r/hamsters/search',
+                            params={'q': query, 'limit': 100, 'after': first['after']}).json()['data']
+
+        listed = [child['data'] for child in first['children'] + rest['children']]
+        assert len(listed) == 150 and rest['after'] is None
+        assert [s['created'] for s in listed] == sorted((s['created'] for s in listed), reverse=True)
+
+        url = listed[0]['url']
+        assert requests.get(url).content == requests.get(url).content == images.image(url.split('/')[-1])
+        assert len(images.latencies) == 2
+
+
+# A small end to end run should download every image the fake Reddit lists, even with some of the
+# image requests failing.
+def test_bench(tmpdir):
+    results = str(tmpdir.join('results.json'))
+    bench.main(['--modes', 'sync,async', '--days', '1', '--per-day', '12', '--sizes', '2048',
+                '--latency', '0', '--api-latency', '0', '--error-rate', '0.2', '--json', results])
+
+    with open(results) as f:
+        results = json.load(f)['results']
+
+    assert [result['mode'] for result in results] == ['sync', 'async']
+    assert all(result['images'] == 9 for result in results)
+    assert all(result['peak_rss_mb'] > 0 for result in results)
+    assert all(result['metrics']['counters']['files_downloaded'] == 9 for result in results)
+
+
+# The startup benchmark should time everything, and a run with a cached token shouldn't log in.
+def test_startup(tmpdir):
+    results = str(tmpdir.join('results.json'))
+    startup.main(['--repeat', '1', '--api-latency', '0', '--json', results])
+
+    with open(results) as f:
+        results = {result['name']: result for result in json.load(f)['results']}
+
+    assert 'help' in results and 'import redditimagescraper.modules.async' in results
+    assert results['cold_login']['logins'] == 1
+    assert results['cached_token']['logins'] == 0
@@ -0,0 +1,64 @@
+import pytest
+
+from redditimagescraper.modules import concurrency
+from redditimagescraper.modules.concurrency import ConcurrencyController
+
+FILE_SIZE = 1024 * 1024
+
+# Seconds a file takes however fast the link is: the round trips to ask for it.
+BASE_SECONDS = 0.5
+
+
+# Runs controller for rounds seconds over a link of bandwidth bytes a second shared between the
+# downloads in flight.  Returns the throughput of the last round.
+def simulate(controller, clock, received, bandwidth, rounds):
+    for _ in range(rounds):
+        running = controller.limit
+        seconds = max(BASE_SECONDS, running * FILE_SIZE / bandwidth)
+        files = max(concurrency.MIN_SAMPLES, int(running / seconds))
+
+        for _ in range(files - 1):
+            controller.record(seconds)
+        clock[0] += 1
+        received[0] += running * FILE_SIZE / seconds
+        controller.record(seconds)
+
+    return running * FILE_SIZE / seconds
+
+
+def make_controller(minimum=4, maximum=256):
+    clock = [0.0]
+    received = [0]
+    controller = ConcurrencyController(minimum, maximum, clock=lambda: clock[0], received=lambda: received[0])
+    return controller, clock, received
+
+
+# On a slow link the limit should settle just past the point the link fills, not at the maximum,
+# and on a fast one it should open all the way up.
+@pytest.mark.parametrize('megabits', [100, 1000, 10000])
+def test_converges(megabits):
+    bandwidth = megabits * 1000 * 1000 / 8
+    controller, clock, received = make_controller()
+
+    throughput = simulate(controller, clock, received, bandwidth, 60)
+
+    # Fewest downloads that keep the link full.
+    knee = bandwidth * BASE_SECONDS / FILE_SIZE
+    if knee >= controller.maximum:
+        assert controller.limit == controller.maximum
+    else:
+        assert knee <= controller.limit <= 2 * knee
+        assert throughput >= 0.9 * bandwidth
+
+
+# Failing downloads should halve the limit, but never below the minimum.
+def test_backs_off_on_errors():
+    controller, clock, received = make_controller(minimum=3)
+    controller.limit = 20
+
+    for expected in (10, 5, 3, 3):
+        for n in range(concurrency.MIN_SAMPLES):
+            if n == concurrency.MIN_SAMPLES - 1:
+                clock[0] += 1
+            controller.record(0.1, failed=True)
+        assert controller.limit == expected
@@ -0,0 +1,67 @@
+import glob
+import os
+
+import pytest
+import requests_mock
+
+from redditimagescraper import scrape
+from redditimagescraper.modules import dedup
+
+test_images = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images", "*")))
+
+
+# Given the same image under two urls, the second file should end up as a link to the first,
+# and the same url posted again should be linked without being fetched at all.
+@pytest.mark.parametrize('link', ['hard', 'sym'])
+def test_download_file_dedup(link, tmpdir):
+    with open(test_images[0], 'rb') as f:
+        image_content = f.read()
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        store = dedup.ContentStore('dedup.sqlite', link)
+        adapter.register_uri('GET', 'mock://testurl.com/first.jpg', content=image_content)
+        adapter.register_uri('GET', 'mock://testurl.com/repost.jpg', content=image_content)
+
+        scrape.download_file('mock://testurl.com/first.jpg', '20170101_000000', False, store)
+        scrape.download_file('mock://testurl.com/repost.jpg', '20170102_000000', False, store)
+        scrape.download_file('mock://testurl.com/first.jpg', '20170103_000000', False, store)
+
+        assert adapter.call_count == 2
+
+        for filename in ('20170102_000000_repost.jpg', '20170103_000000_first.jpg'):
+            assert os.path.samefile(filename, '20170101_000000_first.jpg')
+            assert os.path.islink(filename) == (link == 'sym')
+            with open(filename, 'rb') as f:
+                assert f.read() == image_content
+
+
+# Different images should all be kept as separate files.
+def test_download_file_distinct(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        store = dedup.ContentStore('dedup.sqlite')
+
+        for image in test_images:
+            with open(image, 'rb') as f:
+                adapter.register_uri('GET', 'mock://testurl.com/' + os.path.basename(image), content=f.read())
+            scrape.download_file('mock://testurl.com/' + os.path.basename(image), '20170101_000000', False, store)
+
+        stats = [os.stat(filename) for filename in glob.glob('*_*')]
+        assert len(stats) == len(test_images)
+        assert all(stat.st_nlink == 1 for stat in stats)
+
+
+# If the stored copy has been deleted, the next copy downloaded becomes the stored one.
+def test_deleted_blob(tmpdir):
+    with tmpdir.as_cwd():
+        store = dedup.ContentStore('dedup.sqlite')
+
+        for filename in ('a.jpg', 'b.jpg'):
+            with open(filename, 'wb') as f:
+                f.write(b'image')
+
+        assert not store.add('mock://a.jpg', 'a.jpg', 'digest')
+        os.remove('a.jpg')
+
+        assert not store.link_url('mock://a.jpg', 'c.jpg')
+        assert not store.add('mock://b.jpg', 'b.jpg', 'digest')
+        assert store.blob('digest') == os.path.abspath('b.jpg')
@@ -0,0 +1,94 @@
+import bz2
+import gzip
+import json
+import sys
+import unittest.mock as mock
+
+import pytest
+
+from redditimagescraper.modules import dumps
+from redditimagescraper.modules.metrics import metrics, reporting
+
+EXTS = ('.jpg', '.png')
+JAN_1 = 1483228800
+DAY = 86400
+
+
+# A line of dump for a submission n minutes into January 1st 2017.
+def line(n, subreddit='hamsters', ext='.jpg', **fields):
+    submission = {'id': 's{}'.format(n), 'subreddit': subreddit, 'created_utc': JAN_1 + n * 60,
+                  'url': 'http://i.example.com/{}{}'.format(n, ext), 'is_self': False}
+    submission.update(fields)
+    return json.dumps(submission).encode('utf-8') + b'\n'
+
+
+# Lines for other subreddits, self posts, other extensions, bad JSON and ones out of range should all
+# be passed over, whatever the case of the subreddit or the spacing of the JSON.
+def test_parse_chunk():
+    chunk = b''.join([
+        line(0),
+        line(1, subreddit='gerbils'),
+        line(2, subreddit='Hamsters'),
+        line(3, ext='.gif'),
+        line(4, is_self=True),
+        b'{"subreddit": "hamsters", "url": \n',
+        line(5, created_utc=str(JAN_1 + 5 * 60)),
+        line(6, created_utc=JAN_1 + DAY),
+        line(7, title='"subreddit":"hamsters"'),
+        json.dumps({'subreddit': 'hamsters', 'created_utc': JAN_1 + 8 * 60,
+                    'url': 'http://i.example.com/8.png'}, indent=None, separators=(', ', ' : ')).encode('utf-8'),
+    ])
+
+    found = dumps.parse_chunk(chunk, 'hamsters', JAN_1, JAN_1 + DAY - 1, EXTS)
+
+    assert found == [('http://i.example.com/0.jpg', JAN_1), ('http://i.example.com/2.jpg', JAN_1 + 120),
+                     ('http://i.example.com/5.jpg', JAN_1 + 300), ('http://i.example.com/7.jpg', JAN_1 + 420)]
+
+
+# Every chunk should end on a whole line, however the reads fall.
+def test_chunks(tmpdir):
+    path = str(tmpdir.join('RS_2017-01.gz'))
+    with gzip.open(path, 'wb') as f:
+        for n in range(1000):
+            f.write(line(n))
+
+    with mock.patch('redditimagescraper.modules.dumps.CHUNK_SIZE', 1000), dumps.open_dump(path) as dump:
+        found = list(dumps.chunks(dump))
+
+    assert len(found) > 1 and all(chunk.endswith(b'\n') for chunk in found)
+    assert b''.join(found) == b''.join(line(n) for n in range(1000))
+
+
+# Directories should be expanded, and monthly dumps outside the range left out.
+def test_dump_files(tmpdir):
+    for name in ('RS_2016-12.bz2', 'RS_2017-01.bz2', 'RS_2017-02.zst', 'RS_2017-03.bz2', 'extra.ndjson'):
+        tmpdir.join(name).write('')
+
+    with mock.patch.dict(sys.modules, {'zstandard': None}):
+        assert dumps.dump_files([str(tmpdir)], JAN_1, JAN_1 + 20 * DAY) == \
+            [str(tmpdir.join('RS_2017-01.bz2')), str(tmpdir.join('extra.ndjson'))]
+
+        with pytest.raises(ValueError, match='zstandard'):
+            dumps.dump_files([str(tmpdir)], JAN_1, JAN_1 + 40 * DAY)
+
+    with pytest.raises(ValueError):
+        dumps.dump_files([str(tmpdir.join('missing.bz2'))], JAN_1, JAN_1 + DAY)
+
+
+# Parsing across processes should give the same submissions, in the same order, as the dumps have them.
+def test_dump_submissions(tmpdir):
+    paths = [str(tmpdir.join('RS_2017-01.bz2')), str(tmpdir.join('more.ndjson'))]
+    with bz2.open(paths[0], 'wb') as f:
+        for n in range(3000):
+            f.write(line(n, subreddit='hamsters' if n % 3 else 'gerbils'))
+    with open(paths[1], 'wb') as f:
+        f.write(line(3000))
+
+    with reporting(), mock.patch('redditimagescraper.modules.dumps.CHUNK_SIZE', 10000):
+        found = list(dumps.dump_submissions(paths, 'hamsters', JAN_1, JAN_1 + 10 * DAY, EXTS, workers=3))
+        assert metrics.counter('submissions_listed') == 2001
+        assert metrics.counter('dump_bytes_read') > 0
+
+    assert [submission.url for submission in found] == \
+        ['http://i.example.com/{}.jpg'.format(n) for n in range(3000) if n % 3] + ['http://i.example.com/3000.jpg']
+    assert found[0].date_created == '20170101_000100'
@@ -0,0 +1,91 @@
+import glob
+import os
+import struct
+
+import pytest
+
+from redditimagescraper.modules import filters
+
+test_images = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_images')
+
+
+def png(width, height):
+    return b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', width, height) + bytes(100)
+
+
+# Every kind of image should have its format and dimensions read from its first bytes.
+@pytest.mark.parametrize('head, expected', [
+    (png(640, 480), ('png', (640, 480))),
+    (b'GIF89a' + struct.pack('<HH', 320, 200) + bytes(30), ('gif', (320, 200))),
+    (b'BM' + bytes(16) + struct.pack('<ii', 100, -50) + bytes(30), ('bmp', (100, 50))),
+    (b'RIFF\x00\x00\x00\x00WEBPVP8X' + bytes(8) + (799).to_bytes(3, 'little') + (599).to_bytes(3, 'little'),
+     ('webp', (800, 600))),
+    (b'RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00\x2f' + struct.pack('<I', 99 | (49 << 14)),
+     ('webp', (100, 50))),
+    (b'\xff\xd8\xff\xe0\x00\x04\x00\x00\xff\xc0\x00\x11\x08' + struct.pack('>HH', 768, 1024) + bytes(20),
+     ('jpeg', (1024, 768))),
+    (b'\xff\xd8\xff\xe0\x00\x04', ('jpeg', None)),
+    (b'<!DOCTYPE html><html><body>Not found</body></html>', (None, None)),
+])
+def test_image_info(head, expected):
+    assert filters.image_info(head) == expected
+
+
+@pytest.mark.parametrize('file', glob.glob(os.path.join(test_images, '*')))
+def test_image_info_files(file):
+    with open(file, 'rb') as f:
+        found, dimensions = filters.image_info(f.read(filters.HEAD_SIZE))
+
+    assert found == ('png' if file.endswith('.png') else 'jpeg')
+    assert dimensions == (256, 256)
+
+
+# Headers that say the file is too big, or isn't an image at all, should be enough to turn it down.
+def test_check_headers():
+    content_filter = filters.ContentFilter(min_bytes=100, max_bytes=1000)
+
+    content_filter.check_headers('url', {'Content-Type': 'image/jpeg', 'Content-Length': '500'}, 200)
+    content_filter.check_headers('url', {'Content-Range': 'bytes 900-999/1000'}, 206)
+    content_filter.check_headers('url', {}, 200)
+
+    for headers, status in [({'Content-Type': 'text/html; charset=utf-8'}, 200), ({'Content-Length': '5000'}, 200),
+                            ({'Content-Length': '50'}, 200), ({'Content-Range': 'bytes 0-99/5000'}, 206)]:
+        with pytest.raises(filters.Rejected):
+            content_filter.check_headers('url', headers, status)
+
+
+# Nothing should be handed back to write until the start of the file has passed, and a file should
+# be cut off as soon as it goes over max_bytes.
+def test_stream_check():
+    content_filter = filters.ContentFilter(max_bytes=10000, min_dimensions=(100, 100), formats=['png'])
+    image = png(200, 200) + bytes(5000)
+
+    check = content_filter.stream('url')
+    assert check.feed(image[:10]) == b''
+    written = check.feed(image[10:100]) + check.feed(image[100:]) + check.finish()
+    assert written == image
+
+    for rejected in [png(50, 500), b'GIF89a' + bytes(40), b'<html>' + bytes(100), png(200, 200) + bytes(20000)]:
+        check = content_filter.stream('url')
+        with pytest.raises(filters.Rejected):
+            for start in range(0, len(rejected), 1000):
+                check.feed(rejected[start:start + 1000])
+            check.finish()
+
+    # A resumed download was checked when it started, so only its size is.
+    check = content_filter.stream('url', offset=9000)
+    assert check.feed(bytes(500)) == bytes(500)
+    with pytest.raises(filters.Rejected):
+        check.feed(bytes(1000))
+
+
+def test_make_filter():
+    assert filters.make_filter() is None
+
+    content_filter = filters.make_filter(min_dimensions='640x480', formats='JPG, png')
+    assert content_filter.min_dimensions == (640, 480)
+    assert content_filter.formats == ('jpeg', 'png')
+
+    for bad in [{'min_dimensions': '640'}, {'max_dimensions': 'axb'}, {'formats': 'tiff'}]:
+        with pytest.raises(ValueError):
+            filters.make_filter(**bad)
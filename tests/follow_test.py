@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+from redditimagescraper.modules import follow
+from redditimagescraper.modules.follow import Follower, HighWaterMarks, Mark
+
+Listed = namedtuple('Listed', ['id', 'created_utc'])
+
+
+# A new listing of count submissions, newest first, one a minute apart.
+def listing(count):
+    return [Listed('s{}'.format(n), 1483228800 + n * 60) for n in reversed(range(count))]
+
+
+# Marks should survive being reopened, keyed by subreddit whatever its case.
+def test_high_water_marks(tmpdir):
+    path = str(tmpdir.join('marks.sqlite'))
+    marks = HighWaterMarks(path)
+    assert marks.get('hamsters') is None
+
+    marks.set('Hamsters', Mark('s9', 1483229340.0, '"abc"'))
+    marks.close()
+
+    marks = HighWaterMarks(path)
+    assert marks.get('hamsters') == Mark('s9', 1483229340.0, '"abc"')
+    marks.close()
+
+
+# Only what is newer than the mark should come through, and the mark should only move once committed.
+def test_follower_newer(tmpdir):
+    marks = HighWaterMarks(str(tmpdir.join('marks.sqlite')))
+    follower = Follower(marks)
+
+    assert [s.id for s in follower.newer('hamsters', listing(5))] == ['s4', 's3', 's2', 's1', 's0']
+    assert marks.get('hamsters') is None
+    follower.commit()
+    assert marks.get('hamsters').id == 's4'
+
+    assert list(follower.newer('hamsters', listing(5))) == []
+    assert [s.id for s in follower.newer('hamsters', listing(8), '"new"')] == ['s7', 's6', 's5']
+    follower.commit()
+    assert marks.get('hamsters') == Mark('s7', listing(8)[0].created_utc, '"new"')
+
+    # With the mark itself deleted, its time should still stop the listing.
+    deleted = [submission for submission in listing(10) if submission.id != 's7']
+    assert [s.id for s in follower.newer('hamsters', deleted)] == ['s9', 's8']
+    marks.close()
+
+
+# The first run for a subreddit should go no further back than the floor.
+def test_follower_floor(tmpdir):
+    marks = HighWaterMarks(str(tmpdir.join('marks.sqlite')))
+    follower = Follower(marks, floor=1483228800 + 3 * 60)
+
+    assert [s.id for s in follower.newer('hamsters', listing(6))] == ['s5', 's4', 's3']
+    marks.close()
+
+
+def test_subreddits():
+    assert follow.subreddits('hamsters, /r/gerbils,r/mice/,hamsters,,') == ['hamsters', 'gerbils', 'mice']
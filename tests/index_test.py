@@ -0,0 +1,51 @@
+import time
+import unittest.mock as mock
+
+from redditimagescraper.modules import index
+
+DAY = 86400
+
+
+def submission(id, created_utc):
+    return mock.Mock(id=id, url='https://i.redd.it/{}.jpg'.format(id), created_utc=created_utc)
+
+
+# Days added one at a time should merge into one window covering all of them, but not the gap after.
+def test_covers(tmpdir):
+    submission_index = index.SubmissionIndex(str(tmpdir.join('index.sqlite')))
+
+    for day in range(3):
+        submission_index.add('Hamsters', [day * DAY, (day + 1) * DAY - 0.000001], [])
+    submission_index.add('hamsters', [5 * DAY, 6 * DAY - 0.000001], [])
+
+    assert submission_index.covers('hamsters', [0, 3 * DAY - 1])
+    assert submission_index.covers('HAMSTERS', [DAY, 2 * DAY])
+    assert not submission_index.covers('hamsters', [0, 4 * DAY])
+    assert not submission_index.covers('gerbils', [0, DAY - 1])
+
+    assert submission_index.segments('hamsters', 0, 7 * DAY - 1) == [
+        [0, 3 * DAY - 0.000001, True],
+        [3 * DAY, 5 * DAY - 1, False],
+        [5 * DAY, 6 * DAY - 0.000001, True],
+        [6 * DAY, 7 * DAY - 1, False]]
+
+
+# Submissions should come back newest first and only from the window asked for.
+def test_submissions(tmpdir):
+    submission_index = index.SubmissionIndex(str(tmpdir.join('index.sqlite')))
+    submission_index.add('hamsters', [0, DAY - 1], [submission('a', 10), submission('b', 500), submission('c', 90)])
+    submission_index.add('hamsters', [DAY, 2 * DAY - 1], [submission('d', DAY + 10)])
+
+    assert [s.id for s in submission_index.submissions('hamsters', [0, DAY - 1])] == ['b', 'c', 'a']
+    assert submission_index.submissions('hamsters', [DAY, 2 * DAY])[0] == \
+        index.IndexedSubmission('d', 'https://i.redd.it/d.jpg', DAY + 10)
+
+
+# A window that hasn't finished yet keeps its submissions but isn't marked as covered.
+def test_recent_window(tmpdir):
+    submission_index = index.SubmissionIndex(str(tmpdir.join('index.sqlite')))
+    now = time.time()
+    submission_index.add('hamsters', [now - DAY, now + DAY], [submission('a', now - 10)])
+
+    assert not submission_index.covers('hamsters', [now - DAY, now])
+    assert len(submission_index.submissions('hamsters', [now - DAY, now])) == 1
@@ -0,0 +1,48 @@
+import json
+import sys
+import unittest.mock as mock
+
+import pytest
+
+from redditimagescraper.modules.jobs import Job, load_jobs
+
+
+# Jobs can be a bare list or under 'jobs', and output defaults to the subreddit's name.
+def test_load_jobs(tmpdir):
+    jobs = [{'subreddit': 'hamsters', 'begin': '1.1.2017', 'end': '1.31.2017', 'output': 'pics/hamsters/'},
+            {'subreddit': 'gerbils', 'begin': '2.1.2017', 'end': '2.2.2017'}]
+    expected = [Job('hamsters', '1.1.2017', '1.31.2017', 'pics/hamsters'), Job('gerbils', '2.1.2017', '2.2.2017', 'gerbils')]
+
+    path = tmpdir.join('jobs.json')
+    path.write(json.dumps(jobs))
+    assert load_jobs(str(path)) == expected
+
+    path.write(json.dumps({'jobs': jobs}))
+    assert load_jobs(str(path)) == expected
+
+
+@pytest.mark.parametrize('jobs', [
+    [],
+    {'subreddits': []},
+    [{'subreddit': 'hamsters', 'begin': '1.1.2017'}],
+    [{'subreddit': 'hamsters', 'begin': '2017-01-01', 'end': '1.31.2017'}],
+    ['hamsters'],
+])
+def test_load_jobs_invalid(jobs, tmpdir):
+    path = tmpdir.join('jobs.json')
+    path.write(json.dumps(jobs))
+
+    with pytest.raises(ValueError):
+        load_jobs(str(path))
+
+
+# A YAML job file without PyYAML installed should say what's missing rather than blow up.
+def test_load_jobs_yaml_missing(tmpdir):
+    path = tmpdir.join('jobs.yaml')
+    path.write('- {subreddit: hamsters, begin: 1.1.2017, end: 1.31.2017}\n')
+
+    with mock.patch.dict(sys.modules, {'yaml': None}):
+        with pytest.raises(ValueError) as error:
+            load_jobs(str(path))
+
+    assert 'PyYAML' in str(error.value)
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from redditimagescraper.modules.layout import Layout, FLAT
+
+
+# Each layout should keep the usual file name, in the directories it picks.
+def test_name():
+    url = 'https://i.redd.it/abc.jpg'
+
+    assert FLAT.name('20170304_050607', url) == '20170304_050607_abc.jpg'
+    assert Layout('date').name('20170304_050607', url) == os.path.join('2017', '03', '20170304_050607_abc.jpg')
+    assert Layout('subreddit', 'pics').name('20170304_050607', url) == \
+        os.path.join('pics', '2017', '03', '20170304_050607_abc.jpg')
+
+    hashed = Layout('hash').name('20170304_050607', url)
+    first, second, name = hashed.split(os.sep)
+    assert len(first) == len(second) == 2 and name == '20170304_050607_abc.jpg'
+    assert Layout('hash').name('20170304_050607', url) == hashed
+
+    for bad in [('nested',), ('subreddit',)]:
+        with pytest.raises(ValueError):
+            Layout(*bad)
+
+
+# Directories should be made the first time a file needs them.
+def test_prepare(tmpdir):
+    layout = Layout('date')
+    filename = str(tmpdir.join(layout.name('20170304_050607', 'mock://testurl.com/abc.jpg')))
+
+    layout.prepare(filename)
+    assert os.path.isdir(os.path.dirname(filename))
+    layout.prepare(filename)
+    FLAT.prepare('abc.jpg')
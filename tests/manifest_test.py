@@ -0,0 +1,207 @@
+import glob
+import io
+import os
+import socket
+import threading
+import time
+import unittest.mock as mock
+
+import pytest
+import requests_mock
+from requests.packages import urllib3
+
+from redditimagescraper import scrape
+from redditimagescraper.modules import filters
+from redditimagescraper.modules import manifest
+from redditimagescraper.modules import throttle
+
+test_image = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images", "*")))[0]
+image_url = 'mock://testurl.com/image.jpg'
+filename = '20170101_000000_image.jpg'
+
+with open(test_image, 'rb') as f:
+    image_content = f.read()
+
+
+# Serves image_content, honouring a Range header the way an image host would.
+def serve_image(request, context):
+    if 'Range' in request.headers:
+        offset = int(request.headers['Range'][len('bytes='):-1])
+        if offset >= len(image_content):
+            context.status_code = 416
+            context.headers['Content-Type'] = 'text/html'
+            return b'Requested Range Not Satisfiable'
+        context.status_code = 206
+        return image_content[offset:]
+
+    return image_content
+
+
+# A finished download should be skipped on the next run without touching the network.
+def test_skip_complete(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        run_manifest = manifest.Manifest(os.getcwd())
+        adapter.register_uri('GET', image_url, content=serve_image)
+
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest)
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest)
+
+        assert adapter.call_count == 1
+        assert sorted(os.listdir('.')) == sorted([manifest.MANIFEST_NAME, filename])
+        assert run_manifest.complete(filename)
+
+
+# A .part left by a killed run should be finished off with a Range request for the rest of the file.
+def test_resume_partial(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        run_manifest = manifest.Manifest(os.getcwd())
+        adapter.register_uri('GET', image_url, content=serve_image)
+
+        run_manifest.start(image_url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content[:1000])
+
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest)
+
+        assert adapter.last_request.headers['Range'] == 'bytes=1000-'
+        assert not os.path.exists(manifest.part_name(filename))
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+
+
+# A .part that already had the whole file should be finished off from a 416, even with a filter that
+# would turn down the 416's own error page.
+def test_resume_complete_part(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        run_manifest = manifest.Manifest(os.getcwd())
+        adapter.register_uri('GET', image_url, content=serve_image)
+
+        run_manifest.start(image_url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content)
+
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest,
+                             content_filter=filters.ContentFilter(min_bytes=100))
+
+        assert adapter.last_request.headers['Range'] == 'bytes={}-'.format(len(image_content))
+        assert run_manifest.complete(filename)
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+
+
+# If the server ignores the Range header we should start again rather than append the whole file.
+def test_resume_ignored(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        run_manifest = manifest.Manifest(os.getcwd())
+        adapter.register_uri('GET', image_url, content=image_content)
+
+        run_manifest.start(image_url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content[:1000])
+
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest)
+
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+
+
+# A .part from a different url under the same name should not be resumed.
+def test_start_other_url(tmpdir):
+    run_manifest = manifest.Manifest(str(tmpdir))
+    run_manifest.start('mock://testurl.com/other/image.jpg', filename)
+    tmpdir.join(manifest.part_name(filename)).write_binary(image_content[:1000])
+
+    assert run_manifest.start(image_url, filename) == 0
+    assert run_manifest.start(image_url, filename) == 1000
+
+
+# A download that dies part way should never leave a file under its real name.
+def test_interrupted(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        adapter.register_uri('GET', image_url, exc=ConnectionError)
+
+        try:
+            scrape.download_file(image_url, '20170101_000000', False)
+        except ConnectionError:
+            pass
+
+        assert not os.path.exists(filename)
+
+
+# A connection closed before the whole body arrived should be retried rather than kept as the file,
+# from where the .part left off when resuming.
+def test_short_body(tmpdir):
+    short = {'content': image_content[:1000], 'headers': {'Content-Length': str(len(image_content))}}
+    short_rest = {'status_code': 206, 'content': image_content[2000:3000],
+                  'headers': {'Content-Range': 'bytes 2000-{}/{}'.format(len(image_content) - 1, len(image_content))}}
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.scrape.backoff', return_value=0):
+        adapter.register_uri('GET', image_url, [short, {'content': image_content}])
+        scrape.download_file(image_url, '20170101_000000', False, retries=1)
+
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+        assert adapter.call_count == 2
+
+        os.remove(filename)
+        run_manifest = manifest.Manifest(os.getcwd())
+        run_manifest.start(image_url, filename)
+        with open(manifest.part_name(filename), 'wb') as part:
+            part.write(image_content[:2000])
+        adapter.register_uri('GET', image_url, [short_rest, {'content': serve_image}])
+
+        scrape.download_file(image_url, '20170101_000000', False, manifest=run_manifest, retries=1)
+
+        with open(filename, 'rb') as f:
+            assert f.read() == image_content
+
+
+# A body that keeps getting cut off, short or with an error part way through, should fail once the
+# retries run out, leaving nothing behind.
+def test_short_body_gives_up(tmpdir):
+    def broken_body():
+        body = urllib3.response.HTTPResponse(io.BytesIO(), preload_content=False)
+        body.read = mock.Mock(side_effect=urllib3.exceptions.ProtocolError('Connection broken'))
+        return body
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.scrape.backoff', return_value=0):
+        adapter.register_uri('GET', image_url, [{'raw': broken_body()},
+                                                {'content': image_content[:10], 'headers': {'Content-Length': '20'}}])
+
+        with pytest.raises(throttle.TransientError):
+            scrape.download_file(image_url, '20170101_000000', False, retries=1)
+
+        assert adapter.call_count == 2
+        assert os.listdir('.') == []
+
+
+# A host that sends the start of an image and then goes quiet should be given up on once the session's
+# timeout passes, rather than holding the download forever.
+def test_stalled_host(tmpdir):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    done = threading.Event()
+
+    def stall():
+        connection, _ = server.accept()
+        connection.recv(65536)
+        connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n' + image_content[:10])
+        done.wait(10)
+        connection.close()
+
+    thread = threading.Thread(target=stall)
+    thread.start()
+    url = 'http://127.0.0.1:{}/image.jpg'.format(server.getsockname()[1])
+
+    started = time.monotonic()
+    try:
+        with tmpdir.as_cwd(), pytest.raises(throttle.TransientError):
+            scrape.download_file(url, '20170101_000000', False, session=scrape.make_session(1, timeout=0.2))
+        assert time.monotonic() - started < 5
+    finally:
+        done.set()
+        thread.join()
+        server.close()
@@ -0,0 +1,107 @@
+import io
+import json
+import time
+
+import pytest
+
+from redditimagescraper.modules import metrics as metrics_module
+from redditimagescraper.modules.metrics import Histogram, Metrics, Progress, reporting, timed
+
+
+# Quantiles should come back as the upper bound of the bucket they fall in, never past the largest value.
+def test_histogram():
+    histogram = Histogram()
+    for value in [0.001] * 50 + [0.3] * 49 + [7]:
+        histogram.observe(value)
+
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['p50'] == 0.005
+    assert summary['p99'] == 0.5
+    assert summary['max'] == 7
+    assert histogram.quantile(1) == 7
+    assert Histogram().quantile(0.5) == 0
+
+
+# The summary should have everything recorded plus the overall rates.
+def test_summary():
+    metrics = Metrics()
+    metrics.count('files_downloaded', 3)
+    metrics.count('bytes_downloaded', 300)
+    metrics.gauge('queue_depth', 7)
+    metrics.observe('file_seconds', 0.2)
+
+    summary = metrics.summary()
+    assert summary['counters'] == {'files_downloaded': 3, 'bytes_downloaded': 300}
+    assert summary['gauges'] == {'queue_depth': 7}
+    assert summary['histograms']['file_seconds']['count'] == 1
+    assert summary['files_per_sec'] > 0 and summary['bytes_per_sec'] == pytest.approx(100 * summary['files_per_sec'], rel=0.01)
+
+    metrics.reset()
+    assert metrics.summary()['counters'] == {}
+
+
+# Counters get _total, and histogram buckets are cumulative and end with +Inf.
+def test_prometheus():
+    metrics = Metrics()
+    metrics.count('retries', 2)
+    metrics.observe('file_seconds', 0.02)
+    metrics.observe('file_seconds', 200)
+
+    lines = metrics.prometheus().splitlines()
+    assert '# TYPE redditimagescraper_retries_total counter' in lines
+    assert 'redditimagescraper_retries_total 2' in lines
+    assert 'redditimagescraper_file_seconds_bucket{le="0.025"} 1' in lines
+    assert 'redditimagescraper_file_seconds_bucket{le="120"} 1' in lines
+    assert 'redditimagescraper_file_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'redditimagescraper_file_seconds_count 2' in lines
+
+
+# Only the time spent waiting on the iterable should count, not the time spent by whoever consumes it.
+def test_timed():
+    def slow():
+        for n in range(3):
+            time.sleep(0.01)
+            yield n
+
+    metrics_module.metrics.reset()
+    for _ in timed('listing_window_seconds', slow()):
+        time.sleep(0.05)
+
+    histogram = metrics_module.metrics.summary()['histograms']['listing_window_seconds']
+    assert histogram['count'] == 1
+    assert 0.03 <= histogram['sum'] < 0.1
+
+
+# The progress line should be redrawn in place and finished off with a newline.
+def test_progress():
+    metrics = Metrics()
+    metrics.count('files_downloaded', 4)
+    metrics.gauge('queue_depth', 2)
+    stream = io.StringIO()
+
+    progress = Progress(metrics, interval=0.01, stream=stream).start()
+    time.sleep(0.05)
+    progress.stop()
+
+    output = stream.getvalue()
+    assert output.startswith('\r') and output.endswith('\n')
+    assert output.count('\r') >= 2
+    assert 'downloaded 4' in output and 'queued 2' in output
+
+
+# Both files should be written even if the run blows up.
+def test_reporting(tmpdir):
+    json_path = str(tmpdir.join('metrics.json'))
+    prometheus_path = str(tmpdir.join('metrics.prom'))
+
+    with pytest.raises(KeyboardInterrupt):
+        with reporting(json_path=json_path, prometheus_path=prometheus_path) as metrics:
+            metrics.count('files_downloaded')
+            raise KeyboardInterrupt()
+
+    with open(json_path) as f:
+        assert json.load(f)['counters'] == {'files_downloaded': 1}
+    with open(prometheus_path) as f:
+        assert 'redditimagescraper_files_downloaded_total 1\n' in f.read()
+    assert sorted(tmpdir.listdir()) == sorted([tmpdir.join('metrics.json'), tmpdir.join('metrics.prom')])
@@ -0,0 +1,169 @@
+import asyncio
+import queue
+import time
+
+import pytest
+
+from redditimagescraper.modules import pipeline
+from redditimagescraper.modules.metrics import reporting
+from redditimagescraper.modules.records import Submission
+
+
+# Given a listing, stream should hand back every submission in order.
+def test_stream():
+    submissions = [['mock://testurl.com/{}.jpg'.format(n), '20170101_000000'] for n in range(100)]
+
+    assert list(pipeline.stream(iter(submissions), 4)) == submissions
+
+
+# The listing should never get more than queue_size submissions ahead of the consumer.
+def test_stream_backpressure():
+    listed = list()
+
+    def listing():
+        for n in range(50):
+            listed.append(n)
+            yield n
+
+    streamed = pipeline.stream(listing(), 5)
+    next(streamed)
+
+    # Give the listing thread time to run as far ahead as it can.
+    time.sleep(0.2)
+
+    # One handed out, five waiting in the queue and one blocked trying to get in.
+    assert len(listed) <= 7
+    assert list(streamed) == list(range(1, 50))
+
+
+# With spill, the listing should run to the end without waiting, everything past queue_size should
+# wait on disk, and it should all come back in order, spilling again once the disk has been drained.
+def test_stream_spill():
+    submissions = [Submission('mock://testurl.com/{}.jpg'.format(n), 1483228800 + n) for n in range(3000)] + \
+        [['mock://testurl.com/last.jpg', '20170101_000000']]
+    listed = list()
+
+    def listing(batch):
+        for submission in batch:
+            listed.append(submission)
+            yield submission
+
+    with reporting() as run_metrics:
+        streamed = pipeline.stream(listing(submissions[:2000]), 5, spill=True)
+        assert next(streamed) == submissions[0]
+        time.sleep(0.2)
+        assert len(listed) == 2000
+        assert list(streamed) == submissions[1:2000]
+
+        assert list(pipeline.stream(listing(submissions[2000:]), 5, spill=True)) == submissions[2000:]
+
+    assert run_metrics.counter('submissions_spilled') >= 2000 - 6
+    assert isinstance(submissions[1500], Submission)
+
+
+def test_spill_queue():
+    spill_queue = pipeline.SpillQueue(2)
+    for n in range(5):
+        spill_queue.put(Submission('mock://testurl.com/{}.jpg'.format(n), n))
+    assert spill_queue.qsize() == 5
+
+    assert [spill_queue.get().url for _ in range(3)] == ['mock://testurl.com/{}.jpg'.format(n) for n in range(3)]
+    spill_queue.put(pipeline.DONE)
+    assert [spill_queue.get().created_utc for _ in range(2)] == [3, 4]
+    assert spill_queue.get() is pipeline.DONE
+
+    with pytest.raises(queue.Empty):
+        spill_queue.get_nowait()
+    spill_queue.close()
+
+
+# An exception in the listing should reach whoever is downloading.
+def test_stream_error():
+    def listing():
+        yield 1
+        raise ValueError('listing failed')
+
+    with pytest.raises(ValueError):
+        list(pipeline.stream(listing(), 5))
+
+
+# produce should hand every submission to put, in order.
+def test_produce():
+    loop = asyncio.new_event_loop()
+    items = list()
+
+    async def put(submission):
+        items.append(submission)
+
+    loop.run_until_complete(pipeline.produce(range(10), put, loop))
+    loop.close()
+
+    assert items == list(range(10))
+
+
+# An async listing given spill should run to the end without waiting on a slow put, with everything
+# still handed over in order, and its errors raised once the rest is.
+def test_spill():
+    loop = asyncio.new_event_loop()
+    items = list()
+
+    async def listing(put):
+        for n in range(50):
+            await put(Submission('mock://testurl.com/{}.jpg'.format(n), 1483228800))
+        listed.append(len(items))
+        raise ValueError('listing broke')
+
+    async def slow_put(submission):
+        await asyncio.sleep(0.001, loop=loop)
+        items.append(submission)
+
+    listed = list()
+    with reporting():
+        with pytest.raises(ValueError):
+            loop.run_until_complete(pipeline.spill(listing, slow_put, 5, loop))
+    loop.close()
+
+    assert listed[0] < 50
+    assert [item.url for item in items] == ['mock://testurl.com/{}.jpg'.format(n) for n in range(50)]
+
+
+# Jobs should take turns, so a short job listed after a long one isn't stuck waiting behind it,
+# and only parallel jobs should be listed at once.
+def test_interleave():
+    started = list()
+
+    def listing(job, count):
+        started.append(job)
+        for n in range(count):
+            yield '{}{}'.format(job, n)
+
+    listings = ((job, listing(job, count)) for job, count in [('a', 20), ('b', 2), ('c', 2)])
+    interleaved = list(pipeline.interleave(listings, 2, 5))
+
+    assert sorted(interleaved) == sorted([('a', 'a{}'.format(n)) for n in range(20)] +
+                                         [('b', 'b0'), ('b', 'b1'), ('c', 'c0'), ('c', 'c1')])
+    for job in 'abc':
+        submissions = [submission for found, submission in interleaved if found == job]
+        assert submissions == sorted(submissions, key=lambda submission: int(submission[1:]))
+
+    # b and c are done long before a is.
+    assert max(interleaved.index(('b', 'b1')), interleaved.index(('c', 'c1'))) < interleaved.index(('a', 'a19'))
+    assert started == ['a', 'b', 'c']
+
+
+# A job whose listing fails goes to failed and the others carry on; without failed it is raised at the end.
+def test_interleave_error():
+    def listing(fail):
+        yield 1
+        if fail:
+            raise ValueError('listing failed')
+        yield 2
+
+    failed = list()
+    interleaved = list(pipeline.interleave([('a', listing(True)), ('b', listing(False))], 2, 5,
+                                           lambda job, error: failed.append(job)))
+    assert sorted(interleaved) == [('a', 1), ('b', 1), ('b', 2)]
+    assert failed == ['a']
+
+    with pytest.raises(ValueError):
+        list(pipeline.interleave([('a', listing(True)), ('b', listing(False))], 2, 5))
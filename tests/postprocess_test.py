@@ -0,0 +1,141 @@
+import asyncio
+import glob
+import os
+import shutil
+import struct
+import zlib
+
+import pytest
+
+from redditimagescraper.modules import postprocess
+from redditimagescraper.modules.manifest import Manifest
+from redditimagescraper.modules.metrics import reporting
+
+test_images = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_images')
+
+
+def read(name):
+    with open(os.path.join(test_images, name), 'rb') as f:
+        return f.read()
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+# Stripping should drop the metadata and leave every byte of the image itself as it was.
+def test_strip_metadata():
+    jpeg = read('PIA10116.jpg')
+    exif = b'\xff\xe1' + struct.pack('>H', 2 + 14) + b'Exif\x00\x00' + bytes(8)
+    comment = b'\xff\xfe' + struct.pack('>H', 2 + 5) + b'hello'
+    assert postprocess.strip_jpeg(jpeg[:2] + exif + comment + jpeg[2:]) == jpeg
+
+    png = read('Coriolis_effect10.png')
+    ihdr_end = 8 + 12 + 13
+    text = png_chunk(b'tEXt', b'Author\x00someone')
+    stripped = postprocess.strip_png(png[:ihdr_end] + text + png[ihdr_end:])
+
+    # The test image has a modification time, which goes as well.
+    time_chunk = png.index(b'tIME') - 4
+    time_end = time_chunk + 12 + struct.unpack('>I', png[time_chunk:time_chunk + 4])[0]
+    assert stripped == png[:time_chunk] + png[time_end:]
+
+
+# Each image should get a thumbnail, and re-encoding should swap it for the new format in place.
+def test_process_file(tmpdir):
+    pytest.importorskip('PIL')
+    from PIL import Image
+
+    for name in os.listdir(test_images):
+        shutil.copy(os.path.join(test_images, name), str(tmpdir))
+
+    png = str(tmpdir.join('Coriolis_effect10.png'))
+    assert postprocess.process_file(png, thumbnails=(64, 64), reencode='jpeg') == \
+        (str(tmpdir.join('Coriolis_effect10.jpg')), None)
+    assert not os.path.exists(png)
+
+    with Image.open(str(tmpdir.join('thumbnails', 'Coriolis_effect10.png'))) as thumbnail:
+        assert thumbnail.size == (64, 64)
+    with Image.open(str(tmpdir.join('Coriolis_effect10.jpg'))) as reencoded:
+        assert reencoded.format == 'JPEG' and reencoded.size == (256, 256)
+
+
+# Files handed to the pool should all be processed by the time it closes, and one that can't be
+# should be counted and left alone.
+def test_post_processor(tmpdir):
+    pytest.importorskip('PIL')
+
+    for name in os.listdir(test_images):
+        shutil.copy(os.path.join(test_images, name), str(tmpdir))
+    tmpdir.join('broken.jpg').write('<html>not an image</html>')
+
+    options = postprocess.processing_options('32x32', 'thumbs', True)
+    with reporting() as run_metrics:
+        processor = postprocess.PostProcessor(options, workers=2, limit=1)
+        for path in sorted(glob.glob(str(tmpdir.join('*')))):
+            processor.process(path)
+        processor.close()
+
+    assert sorted(os.listdir(str(tmpdir.join('thumbs')))) == sorted(os.listdir(test_images))
+    assert run_metrics.counter('files_processed') == len(os.listdir(test_images))
+    assert run_metrics.counter('files_process_failed') == 1
+    assert tmpdir.join('broken.jpg').read() == '<html>not an image</html>'
+
+
+# An image re-encoded under another extension should still count as downloaded to the manifest it
+# was handed over with, so --resume doesn't fetch it again.
+def test_post_processor_manifest(tmpdir):
+    pytest.importorskip('PIL')
+
+    name = os.path.join('2017', 'Coriolis_effect10.png')
+    tmpdir.mkdir('2017')
+    shutil.copy(os.path.join(test_images, 'Coriolis_effect10.png'), str(tmpdir.join(name)))
+    run_manifest = Manifest(str(tmpdir))
+    run_manifest.start('http://i.example.com/Coriolis_effect10.png', name)
+    run_manifest.finish(name)
+
+    processor = postprocess.PostProcessor(postprocess.processing_options(reencode='jpeg'), workers=1)
+    processor.process(str(tmpdir.join(name)), run_manifest)
+    processor.close()
+
+    assert not tmpdir.join(name).exists()
+    assert run_manifest.complete(name)
+
+    tmpdir.join('2017', 'Coriolis_effect10.jpg').remove()
+    assert not run_manifest.complete(name)
+
+
+# From a coroutine, waiting for room in the pool shouldn't hold up the loop.
+def test_process_async(tmpdir):
+    loop = asyncio.new_event_loop()
+    for name in os.listdir(test_images):
+        shutil.copy(os.path.join(test_images, name), str(tmpdir))
+
+    processor = postprocess.PostProcessor(postprocess.processing_options(strip_metadata=True), workers=1, limit=1)
+    ticks = list()
+
+    async def tick():
+        for _ in range(3):
+            ticks.append(1)
+            await asyncio.sleep(0, loop=loop)
+
+    async def process_all():
+        for path in sorted(glob.glob(str(tmpdir.join('*')))):
+            await processor.process_async(path, loop)
+
+    with reporting() as run_metrics:
+        loop.run_until_complete(asyncio.gather(process_all(), tick(), loop=loop))
+        processor.close()
+    loop.close()
+
+    assert len(ticks) == 3
+    assert run_metrics.counter('files_processed') == len(os.listdir(test_images))
+
+
+def test_processing_options():
+    assert postprocess.processing_options() is None
+    assert postprocess.processing_options(strip_metadata=True)['thumbnails'] is None
+
+    for bad in [{'thumbnails': '256'}, {'reencode': 'tiff'}]:
+        with pytest.raises(ValueError):
+            postprocess.processing_options(**bad)
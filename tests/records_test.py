@@ -0,0 +1,29 @@
+from redditimagescraper.modules import records
+from redditimagescraper.modules.records import Submission
+
+
+# A Submission should stand in for the [url, date_string] list it replaces.
+def test_submission():
+    submission = Submission('mock://testurl.com/a.jpg', 1483272245.0)
+
+    url, date_created = submission
+    assert (url, date_created) == ('mock://testurl.com/a.jpg', '20170101_120405')
+    assert submission[0] == url and submission[1] == date_created and len(submission) == 2
+    assert submission == [url, date_created] and [url, date_created] == submission
+    assert submission != [url, '20170101_000000']
+    assert sorted([Submission('mock://testurl.com/b.jpg', 0), submission]) == [submission, ['mock://testurl.com/b.jpg',
+                                                                                          '19700101_000000']]
+    assert not hasattr(submission, '__dict__')
+
+    assert records.with_url(submission, 'mock://testurl.com/c.jpg') == \
+        Submission('mock://testurl.com/c.jpg', 1483272245.0)
+    assert records.with_url([url, date_created], 'mock://testurl.com/c.jpg') == ['mock://testurl.com/c.jpg',
+                                                                                date_created]
+
+
+def test_encode():
+    for submission in [Submission('mock://testurl.com/a b.jpg', 1483272245.5), ['mock://testurl.com/a.jpg', '2017']]:
+        line = records.encode(submission)
+        assert line.endswith('\n') and line.count('\n') == 1
+        decoded = records.decode(line)
+        assert decoded == submission and type(decoded) == type(submission)
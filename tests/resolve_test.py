@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+
+import requests_mock
+
+from redditimagescraper.modules import resolve
+from redditimagescraper.modules.metrics import metrics
+
+EXTS = ('.jpg', '.jpeg', '.png')
+IMGUR_API = 'mock://imgur/3'
+REDDIT = 'mock://reddit'
+
+
+def make_resolver(cache=None, imgur_client_id='abc'):
+    resolver = resolve.Resolver(EXTS, cache, 2, False, imgur_client_id, IMGUR_API, REDDIT)
+    adapter = requests_mock.Adapter()
+    resolver.session.mount('mock', adapter)
+    return resolver, adapter
+
+
+# Direct links and imgur pages need no lookup, and links that aren't images resolve to nothing.
+def test_resolve_without_lookup():
+    resolver, adapter = make_resolver()
+
+    assert resolver.resolve('https://i.redd.it/abc.png') == ['https://i.redd.it/abc.png']
+    assert resolver.resolve('https://imgur.com/AbC12') == ['https://i.imgur.com/AbC12.jpg']
+    assert resolver.resolve('http://m.imgur.com/AbC12?r') == ['https://i.imgur.com/AbC12.jpg']
+    assert resolver.resolve('https://www.reddit.com/r/hamsters/comments/abc/a_hamster/') == []
+    assert resolver.resolve('https://i.redd.it/abc.gif') == []
+    assert adapter.call_count == 0
+
+
+# Albums and galleries are looked up with the client id, and anything that isn't in EXTS is dropped.
+def test_resolve_imgur():
+    resolver, adapter = make_resolver()
+    adapter.register_uri('GET', IMGUR_API + '/album/alb/images',
+                         json={'data': [{'link': 'https://i.imgur.com/1.jpg'}, {'link': 'https://i.imgur.com/2.gif'},
+                                        {'link': 'https://i.imgur.com/3.png'}]})
+    adapter.register_uri('GET', IMGUR_API + '/gallery/gal',
+                         json={'data': {'is_album': True, 'images': [{'link': 'https://i.imgur.com/4.jpg'}]}})
+    adapter.register_uri('GET', IMGUR_API + '/gallery/one',
+                         json={'data': {'is_album': False, 'link': 'https://i.imgur.com/5.png'}})
+    adapter.register_uri('GET', IMGUR_API + '/album/gone/images', status_code=404)
+
+    assert resolver.resolve('https://imgur.com/a/alb') == ['https://i.imgur.com/1.jpg', 'https://i.imgur.com/3.png']
+    assert resolver.resolve('https://imgur.com/gallery/gal') == ['https://i.imgur.com/4.jpg']
+    assert resolver.resolve('https://imgur.com/gallery/one') == ['https://i.imgur.com/5.png']
+    assert resolver.resolve('https://imgur.com/a/gone') == []
+    assert all(request.headers['Authorization'] == 'Client-ID abc' for request in adapter.request_history)
+
+    # Without a client id albums can't be looked up at all.
+    resolver, adapter = make_resolver(imgur_client_id=None)
+    assert resolver.resolve('https://imgur.com/a/alb') == []
+    assert adapter.call_count == 0
+
+
+# A reddit gallery resolves to its images on i.redd.it, in gallery order, skipping failed uploads.
+def test_resolve_reddit_gallery():
+    resolver, adapter = make_resolver()
+    post = {'gallery_data': {'items': [{'media_id': 'zz'}, {'media_id': 'aa'}, {'media_id': 'bad'}]},
+            'media_metadata': {'aa': {'status': 'valid', 'm': 'image/png'},
+                               'zz': {'status': 'valid', 'm': 'image/jpg'},
+                               'bad': {'status': 'failed'}}}
+    adapter.register_uri('GET', REDDIT + '/comments/xyz.json', json=[{'data': {'children': [{'data': post}]}}])
+
+    assert resolver.resolve('https://www.reddit.com/gallery/xyz') == ['https://i.redd.it/zz.jpg',
+                                                                      'https://i.redd.it/aa.png']
+
+
+# A cached link should never be looked up again, even from a new cache on the same file, and the
+# link used longest ago should be the one dropped once the cache is full.
+def test_link_cache(tmpdir):
+    path = str(tmpdir.join('links.sqlite'))
+    resolver, adapter = make_resolver(resolve.LinkCache(path))
+    for album in ['one', 'two', 'three']:
+        adapter.register_uri('GET', '{}/album/{}/images'.format(IMGUR_API, album),
+                             json={'data': [{'link': 'https://i.imgur.com/{}.jpg'.format(album)}]})
+
+    metrics.reset()
+    assert resolver.resolve('https://imgur.com/a/one') == ['https://i.imgur.com/one.jpg']
+    resolver.cache.close()
+
+    resolver, adapter = make_resolver(resolve.LinkCache(path, capacity=2))
+    assert resolver.resolve('https://imgur.com/a/one') == ['https://i.imgur.com/one.jpg']
+    assert adapter.call_count == 0
+    assert metrics.counter('links_cached') == 1
+
+    cache = resolver.cache
+    cache.put('https://imgur.com/a/two', ['https://i.imgur.com/two.jpg'])
+    cache.get('https://imgur.com/a/one')
+    cache.put('https://imgur.com/a/three', ['https://i.imgur.com/three.jpg'])
+    assert cache.get('https://imgur.com/a/two') is None
+    assert cache.get('https://imgur.com/a/one') == ['https://i.imgur.com/one.jpg']
+
+
+# A lookup that fails shouldn't be cached, so it's tried again next time.
+def test_failed_lookup(tmpdir):
+    resolver, adapter = make_resolver(resolve.LinkCache(str(tmpdir.join('links.sqlite'))))
+    adapter.register_uri('GET', IMGUR_API + '/album/alb/images',
+                         [{'status_code': 503}, {'json': {'data': [{'link': 'https://i.imgur.com/1.jpg'}]}}])
+
+    metrics.reset()
+    assert resolver.resolve('https://imgur.com/a/alb') == []
+    assert metrics.counter('links_failed') == 1
+    assert resolver.resolve('https://imgur.com/a/alb') == ['https://i.imgur.com/1.jpg']
+
+
+# Lookups should overlap, while what comes out keeps the order the submissions went in.
+def test_resolve_all():
+    running = [0]
+    most_running = [0]
+    lock = threading.Lock()
+
+    class SlowResolver:
+        def resolve(self, url):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.01 if int(url) % 2 else 0.03)
+            with lock:
+                running[0] -= 1
+            return [url + 'a', url + 'b'] if int(url) % 3 else []
+
+    submissions = [[str(n), 'date{}'.format(n)] for n in range(20)]
+    resolved = list(resolve.resolve_all(iter(submissions), SlowResolver(), 4))
+
+    assert resolved == [[url + suffix, date] for url, date in submissions if int(url) % 3 for suffix in 'ab']
+    assert most_running[0] == 4
+
+
+# resolving should do the same for a listing run on the loop.
+def test_resolving():
+    loop = asyncio.new_event_loop()
+    resolved = list()
+
+    class Resolver:
+        def resolve(self, url):
+            time.sleep(0.01 if int(url) % 2 else 0.03)
+            return [url + 'a', url + 'b'] if int(url) % 3 else []
+
+    submissions = [[str(n), 'date{}'.format(n)] for n in range(20)]
+
+    async def listing(put):
+        for submission in submissions:
+            await put(submission)
+
+    async def put(submission):
+        resolved.append(submission)
+
+    loop.run_until_complete(resolve.resolving(listing, put, Resolver(), 4, loop))
+    loop.close()
+
+    assert resolved == [[url + suffix, date] for url, date in submissions if int(url) % 3 for suffix in 'ab']
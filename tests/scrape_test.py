@@ -1,8 +1,15 @@
 import glob
+import gzip
+import io
+import json
 from datetime import datetime
 import pytz
+import requests
 import requests_mock
 import os
+import subprocess
+import sys
+import tarfile
 
 from hypothesis import given, event
 from hypothesis.strategies import integers, text
@@ -10,6 +17,10 @@ import unittest.mock as mock
 import pytest
 
 from redditimagescraper import scrape
+from redditimagescraper.modules import dedup
+from redditimagescraper.modules import filters
+from redditimagescraper.modules import throttle
+from redditimagescraper.modules.metrics import reporting
 
 
 @given(integers(), text(), integers(2005, datetime.now().year))
@@ -173,6 +184,31 @@ def test_parse_args(args, expected_args):
         assert arg == expected_arg
 
 
+# The options handed to async should be the ones async's own command line would give it for the same run.
+def test_async_args():
+    from redditimagescraper.modules import async
+
+    parser = scrape.parse_args(['-as', '-v', '--retries', '2', '--layout', 'date', '--dumps', 'a.bz2', 'b.bz2',
+                                '--reencode', 'webp'])
+    args = scrape.async_args(parser, 'hamsters', '1.1.2015', '1.2.2015')
+    expected = async.get_args(['hamsters', '1.1.2015', '1.2.2015', '-v', '--retries', 2, '--layout', 'date',
+                               '--dumps', 'a.bz2', 'b.bz2', '--reencode', 'webp'])
+
+    assert {name: getattr(args, name) for name in vars(expected)} == vars(expected)
+    assert parser.subreddit is None
+
+
+# Starting up shouldn't import the network libraries, only the code paths that use them should.
+def test_lazy_imports():
+    code = 'import sys; import redditimagescraper.scrape; ' \
+           'print(sorted(name for name in ("requests", "praw", "aiohttp", "pytz", "asyncio") if name in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            universal_newlines=True).stdout
+
+    assert output.strip() == '[]'
+
+
 # Given arguments:
 # need at least one -v
 # need at least one -sr -bd -ed
@@ -246,3 +282,295 @@ def test_main(args, start, end, capsys):
                 assert output in actual_output
 
 #        assert actual_user_vars == test_user_vars
+
+
+# Given a pool of workers sharing a session, every image should be downloaded, and a big file should
+# be streamed in chunks rather than read whole.
+@pytest.mark.parametrize('workers', [1, 4])
+def test_download_in_parallel(workers, tmpdir):
+    files = [image for image in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       "test_images", "*"))]
+    big_content = os.urandom(5 * scrape.chunk_size + 1)
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        submissions = list()
+        for file in files:
+            with open(file, "br") as f:
+                adapter.register_uri('GET', 'mock://testurl.com/' + os.path.basename(file), content=f.read())
+            submissions.append(['mock://testurl.com/' + os.path.basename(file), '20170101_000000'])
+
+        adapter.register_uri('GET', 'mock://testurl.com/big.gif', content=big_content)
+        submissions.append(['mock://testurl.com/big.gif', '20170101_000000'])
+
+        session = scrape.make_session(workers)
+        with mock.patch('requests.models.Response.iter_content',
+                        side_effect=requests.models.Response.iter_content, autospec=True) as iter_content:
+            scrape.download_in_parallel(iter(submissions), workers, False, None, None, session, throttle.HostThrottle(), 0)
+
+        assert all(call[1] == {} and call[0][1] == scrape.chunk_size for call in iter_content.call_args_list)
+        assert sorted(glob.glob("*")) == sorted('20170101_000000_' + url.split('/')[-1] for url, _ in submissions)
+        with open('20170101_000000_big.gif', 'rb') as f:
+            assert f.read() == big_content
+
+
+# Downloads should go under the directory given, in the subdirectories the layout picks, or into
+# archives there instead of files of their own.
+def test_download_layout(tmpdir):
+    submissions = [['mock://testurl.com/{}.jpg'.format(n), '2017{:02d}01_000000'.format(n)] for n in (1, 2, 12)]
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        adapter.register_uri('GET', requests_mock.ANY, content=b'image')
+
+        scrape.download_in_parallel(iter(submissions), 2, False, None, None, scrape.make_session(2),
+                                    throttle.HostThrottle(), 0, directory='out', layout=scrape.Layout('date'))
+        assert sorted(glob.glob(os.path.join('out', '*', '*', '*'))) == [
+            os.path.join('out', '2017', month, '2017{}01_000000_{}.jpg'.format(month, int(month)))
+            for month in ('01', '02', '12')]
+
+        sink = scrape.ArchiveSink('archived', 'tar', prefix='pics')
+        scrape.download_in_parallel(iter(submissions), 2, False, None, None, scrape.make_session(2),
+                                    throttle.HostThrottle(), 0, directory='archived',
+                                    layout=scrape.Layout('subreddit', 'pics'), archive=sink)
+        sink.close()
+        assert os.listdir('archived') == ['pics-00001.tar']
+        with tarfile.open(os.path.join('archived', 'pics-00001.tar')) as archive:
+            assert sorted(archive.getnames()) == ['pics/2017/01/20170101_000000_1.jpg',
+                                                  'pics/2017/02/20170201_000000_2.jpg',
+                                                  'pics/2017/12/20171201_000000_12.jpg']
+
+
+# A response body that counts how much of it has been read.
+class CountingIO(io.BytesIO):
+    served = 0
+
+    def read(self, *args):
+        data = super().read(*args)
+        self.served += len(data)
+        return data
+
+
+# Downloads the filter doesn't want should be cut off as soon as it can tell, leaving nothing behind,
+# while everything else is downloaded as usual.
+def test_download_filtered(tmpdir):
+    files = [image for image in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       "test_images", "*"))]
+    huge = CountingIO(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + (4000).to_bytes(4, 'big') * 2 +
+                      bytes(20 * scrape.chunk_size))
+    content_filter = filters.make_filter(min_dimensions='200x200', max_dimensions='2000x2000', formats='jpeg,png')
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        submissions = list()
+        for file in files:
+            with open(file, "br") as f:
+                adapter.register_uri('GET', 'mock://testurl.com/' + os.path.basename(file), content=f.read())
+            submissions.append(['mock://testurl.com/' + os.path.basename(file), '20170101_000000'])
+
+        adapter.register_uri('GET', 'mock://testurl.com/huge.png', body=huge)
+        adapter.register_uri('GET', 'mock://testurl.com/removed.jpg', text='<html>Not here</html>',
+                             headers={'Content-Type': 'text/html'})
+        adapter.register_uri('GET', 'mock://testurl.com/page.jpg', text='<html>Not an image</html>')
+
+        with reporting() as run_metrics:
+            scrape.download_in_parallel(iter(submissions + [['mock://testurl.com/huge.png', '20170101_000000'],
+                                                            ['mock://testurl.com/removed.jpg', '20170101_000000'],
+                                                            ['mock://testurl.com/page.jpg', '20170101_000000']]),
+                                        2, False, None, None, scrape.make_session(2), throttle.HostThrottle(), 0,
+                                        content_filter)
+
+        assert sorted(glob.glob("*")) == sorted('20170101_000000_' + url.split('/')[-1] for url, _ in submissions)
+        assert huge.served <= 2 * scrape.chunk_size
+        assert run_metrics.counter('files_rejected') == 3
+
+
+# Downloaded files should be handed to the post processor, and a duplicate linked to one of them shouldn't.
+def test_download_processed(tmpdir):
+    image = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images", "PIA10116.jpg")
+    with open(image, 'rb') as f:
+        content = f.read()
+    processor = mock.Mock()
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter:
+        adapter.register_uri('GET', 'mock://testurl.com/first.jpg', content=content)
+        adapter.register_uri('GET', 'mock://testurl.com/again.jpg', content=content)
+
+        store = dedup.ContentStore('dedup.sqlite')
+        scrape.download_in_parallel(iter([['mock://testurl.com/first.jpg', '20170101_000000'],
+                                          ['mock://testurl.com/again.jpg', '20170101_000000']]),
+                                    1, False, store, None, scrape.make_session(1), throttle.HostThrottle(), 0,
+                                    processor=processor)
+
+    processor.process.assert_called_once_with('20170101_000000_first.jpg', None)
+
+
+# A download that keeps failing on a worker thread should be retried, then skipped without saving
+# anything or stopping the other downloads.
+def test_download_in_parallel_error(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.scrape.backoff', return_value=0):
+        adapter.register_uri('GET', 'mock://testurl.com/broken.jpg', exc=requests.exceptions.ConnectionError)
+        adapter.register_uri('GET', 'mock://testurl.com/fine.jpg', content=b'fine')
+
+        scrape.download_in_parallel(iter([['mock://testurl.com/broken.jpg', '20170101_000000'],
+                                          ['mock://testurl.com/fine.jpg', '20170101_000000']]), 2,
+                                    False, None, None, scrape.make_session(2), throttle.HostThrottle(), 2)
+
+        assert len([r for r in adapter.request_history if r.url.endswith('broken.jpg')]) == 3
+        assert glob.glob("*") == ['20170101_000000_fine.jpg']
+
+
+# Any other requests error, like a redirect loop, should fail just its own download, straight away,
+# and leave the rest of the listing to finish.
+def test_download_in_parallel_request_error(tmpdir):
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, reporting() as run_metrics:
+        adapter.register_uri('GET', 'mock://testurl.com/loop.jpg', exc=requests.exceptions.TooManyRedirects)
+        for name in ('first', 'second', 'third'):
+            adapter.register_uri('GET', 'mock://testurl.com/{}.jpg'.format(name), content=name.encode())
+
+        scrape.download_in_parallel(iter([['mock://testurl.com/first.jpg', '20170101_000000'],
+                                          ['mock://testurl.com/loop.jpg', '20170101_000000'],
+                                          ['mock://testurl.com/second.jpg', '20170101_000000'],
+                                          ['mock://testurl.com/third.jpg', '20170101_000000']]), 1,
+                                    False, None, None, scrape.make_session(1), throttle.HostThrottle(), 2)
+
+        assert len([r for r in adapter.request_history if r.url.endswith('loop.jpg')]) == 1
+        assert sorted(glob.glob("*")) == ['20170101_000000_first.jpg', '20170101_000000_second.jpg',
+                                          '20170101_000000_third.jpg']
+        assert run_metrics.counter('files_failed') == 1
+
+
+# A 503 should be retried after the Retry-After the host asked for, and a 404 shouldn't be retried.
+def test_get_with_retries():
+    host_throttle = throttle.HostThrottle()
+    clock = [1000.0]
+    slept = list()
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+
+    with requests_mock.Mocker() as adapter, mock.patch('redditimagescraper.scrape.backoff', return_value=0), \
+            mock.patch('time.sleep', side_effect=sleep), mock.patch('time.monotonic', side_effect=lambda: clock[0]):
+        adapter.register_uri('GET', 'mock://testurl.com/busy.jpg',
+                             [{'status_code': 503, 'headers': {'Retry-After': '2'}}, {'content': b'image'}])
+        adapter.register_uri('GET', 'mock://testurl.com/gone.jpg', status_code=404)
+
+        response = scrape.get_with_retries(requests, 'mock://testurl.com/busy.jpg', {}, host_throttle, 3)
+        assert response.content == b'image'
+        assert sum(slept) == 2
+
+        with pytest.raises(throttle.DownloadError) as error:
+            scrape.get_with_retries(requests, 'mock://testurl.com/gone.jpg', {}, host_throttle, 3)
+        assert not isinstance(error.value, throttle.TransientError)
+        assert len([r for r in adapter.request_history if r.url.endswith('gone.jpg')]) == 1
+
+
+# Every job's images should land in its own directory, with one login shared by all of them, and a
+# job whose listing fails shouldn't stop the others.
+def test_run_jobs(tmpdir):
+    listed = {'hamsters': [['mock://testurl.com/h{}.jpg'.format(n), '20170101_000000'] for n in range(5)],
+              'gerbils': [['mock://testurl.com/g{}.jpg'.format(n), '20170201_000000'] for n in range(3)]}
+
+    def fake_subs_to_download(subreddit_name, *args):
+        if subreddit_name not in listed:
+            raise ValueError('no such subreddit')
+        yield from listed[subreddit_name]
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.modules.accessreddit.login') as login, \
+            mock.patch('redditimagescraper.modules.accessreddit.subs_to_download', side_effect=fake_subs_to_download):
+        adapter.register_uri('GET', requests_mock.ANY, content=b'image')
+        tmpdir.join('jobs.json').write(json.dumps([
+            {'subreddit': 'hamsters', 'begin': '1.1.2017', 'end': '1.1.2017', 'output': 'out/hamsters'},
+            {'subreddit': 'nothere', 'begin': '1.1.2017', 'end': '1.1.2017'},
+            {'subreddit': 'gerbils', 'begin': '2.1.2017', 'end': '2.1.2017', 'output': 'out/gerbils'}]))
+
+        scrape.main(['--jobs', 'jobs.json', '-w', '3', '--resume', '--parallel-jobs', '2'])
+
+        assert login.call_count == 1
+        for subreddit, submissions in listed.items():
+            directory = os.path.join('out', subreddit)
+            assert sorted(os.listdir(directory)) == sorted(['redditimagescraper-manifest.sqlite'] + [
+                '{}_{}'.format(date_created, url.split('/')[-1]) for url, date_created in submissions])
+
+
+# --follow should download everything on each subreddit's first run, and only what is new after that,
+# into each subreddit's own directory with --layout subreddit.
+def test_follow(tmpdir):
+    posted = {'hamsters': list(), 'gerbils': list()}
+
+    def post(subreddit, count):
+        for n in range(len(posted[subreddit]), len(posted[subreddit]) + count):
+            posted[subreddit].insert(0, mock.Mock(id='{}{}'.format(subreddit, n), created_utc=1483228800 + n,
+                                                  url='mock://testurl.com/{}{}.jpg'.format(subreddit, n)))
+
+    def subreddit(name):
+        return mock.Mock(new=lambda limit: iter(list(posted[name])))
+
+    def downloaded():
+        return sorted(os.path.basename(path) for path in glob.glob(os.path.join('out', '*', '*', '*', '*')))
+
+    post('hamsters', 3)
+    post('gerbils', 2)
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.modules.accessreddit.login') as login:
+        adapter.register_uri('GET', requests_mock.ANY, content=b'image')
+        login.return_value.subreddit.side_effect = subreddit
+        args = ['--follow', 'marks.sqlite', '-sr', 'hamsters,gerbils', '-w', '2', '--output-dir', 'out',
+                '--layout', 'subreddit']
+
+        scrape.main(args)
+        assert len(downloaded()) == 5 and adapter.call_count == 5
+
+        post('hamsters', 2)
+        scrape.main(args)
+        assert len(downloaded()) == 7 and adapter.call_count == 7
+        assert sorted(os.listdir('out')) == ['gerbils', 'hamsters']
+        assert len(os.listdir(os.path.join('out', 'hamsters', '2017', '01'))) == 5
+
+
+# --dumps should download what the dumps hold for the subreddit and range, without logging into Reddit.
+def test_dumps(tmpdir):
+    with gzip.open(str(tmpdir.join('RS_2017-01.gz')), 'wb') as f:
+        for n, subreddit in enumerate(('hamsters', 'gerbils', 'hamsters', 'Hamsters')):
+            f.write(json.dumps({'subreddit': subreddit, 'created_utc': 1483228800 + n * 86400,
+                                'url': 'mock://testurl.com/{}.jpg'.format(n)}).encode('utf-8') + b'\n')
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.modules.accessreddit.login') as login:
+        adapter.register_uri('GET', requests_mock.ANY, content=b'image')
+        scrape.main(['--dumps', str(tmpdir), '-sr', 'hamsters', '-bd', '1.1.2017', '-ed', '1.3.2017',
+                     '--dump-workers', '2', '--output-dir', 'out'])
+
+        assert sorted(os.listdir('out')) == ['20170101_000000_0.jpg', '20170103_000000_2.jpg']
+        assert not login.called
+
+
+# A coordinated range should be listed a window at a time from the queue and every image downloaded,
+# with a listing that fails once retried and a 404 failed for good.
+def test_coordinate_and_work(tmpdir):
+    date_list = scrape.convert_dates(2017, 1, 1, 2017, 1, 3)
+    listing_failed = list()
+
+    def fake_window_submissions(subreddit, window, exts, verbose, index=None):
+        if window == date_list[1] and not listing_failed:
+            listing_failed.append(window)
+            raise ValueError('listing went wrong')
+        day = datetime.utcfromtimestamp(window[0]).strftime('%Y%m%d')
+        return [['mock://testurl.com/{}_{}.jpg'.format(day, n), day + '_000000'] for n in range(3)]
+
+    with tmpdir.as_cwd(), requests_mock.Mocker() as adapter, \
+            mock.patch('redditimagescraper.modules.accessreddit.login') as login, \
+            mock.patch('redditimagescraper.modules.accessreddit.window_submissions',
+                       side_effect=fake_window_submissions):
+        adapter.register_uri('GET', requests_mock.ANY, content=b'image')
+        adapter.register_uri('GET', 'mock://testurl.com/20170102_1.jpg', status_code=404)
+
+        assert scrape.coordinate('queue.sqlite', 'hamsters', date_list, 60)['pending'] == 3
+        assert scrape.coordinate('queue.sqlite', 'hamsters', date_list, 60)['pending'] == 3
+
+        counts = scrape.work_from_queue('queue.sqlite', scrape.parse_args(['--work', 'queue.sqlite', '-w', '3']),
+                                        poll=0.01)
+
+        assert counts == {'pending': 0, 'leased': 0, 'done': 11, 'failed': 1}
+        assert login.call_count == 1
+        assert len(glob.glob('2017*.jpg')) == 8
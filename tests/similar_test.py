@@ -0,0 +1,144 @@
+import glob
+import os
+import shutil
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+from PIL import Image
+
+from redditimagescraper.modules import postprocess, similar
+from redditimagescraper.modules.manifest import Manifest
+from redditimagescraper.modules.metrics import reporting
+
+test_images = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_images')
+
+
+# Copies the test images into directory, along with a shrunk and re-compressed copy of one of them
+# named so it sorts after the original.  Returns the copy's path.
+def images_with_copy(directory):
+    for name in os.listdir(test_images):
+        shutil.copy(os.path.join(test_images, name), directory)
+
+    copy = os.path.join(directory, 'PIA10116_small.jpg')
+    with Image.open(os.path.join(test_images, 'PIA10116.jpg')) as image:
+        image.resize((image.width // 2, image.height // 2)).save(copy, quality=40)
+    return copy
+
+
+def bits_apart(a, b):
+    return bin(a ^ b).count('1')
+
+
+# A resized, re-compressed copy should hash close to the original, and different images far apart.
+def test_dhash(tmpdir):
+    copy = images_with_copy(str(tmpdir))
+    hashes = {name: similar.dhash(os.path.join(test_images, name)) for name in os.listdir(test_images)}
+
+    assert bits_apart(similar.dhash(copy), hashes['PIA10116.jpg']) <= 6
+    assert all(bits_apart(a, b) > 12 for a in hashes.values() for b in hashes.values() if a != b)
+    assert all(0 <= image_hash < 1 << 64 for image_hash in hashes.values())
+
+
+# Searching through the chunk index should find the same matches as comparing against everything.
+def test_find():
+    random = numpy.random.RandomState(0)
+    hashes = [int(h) for h in random.randint(0, 1 << 62, size=similar.BRUTE_FORCE_BELOW + 1000, dtype=numpy.int64)]
+    hashes = [h | (1 << 63) if i % 2 else h for i, h in enumerate(hashes)]
+
+    index = similar.SimilarIndex()
+    for i, image_hash in enumerate(hashes):
+        index.add(str(i), image_hash)
+    assert len(index) == len(hashes)
+
+    for i in range(0, len(hashes), 97):
+        flipped = hashes[i]
+        for bit in random.choice(64, size=i % 8, replace=False):
+            flipped ^= 1 << int(bit)
+
+        assert index.find(flipped, 7) == (str(i), i % 8)
+        assert index.find(flipped, 2) == ((str(i), i % 8) if i % 8 <= 2 else None)
+        assert index.find(flipped, 20) == (str(i), i % 8)
+
+
+# Hashes and near duplicates should be kept in the file given, and loaded back from it.
+def test_index_file(tmpdir):
+    path = str(tmpdir.join('similar.db'))
+    index = similar.SimilarIndex(path)
+    index.add('/a.jpg', (1 << 64) - 1)
+    index.add('/b.jpg', 0)
+    index.flag('/c.jpg', '/b.jpg', 1)
+    index.close()
+
+    index = similar.SimilarIndex(path)
+    assert len(index) == 2
+    assert index.find((1 << 64) - 2, 1) == ('/a.jpg', 1)
+    assert index.seen() == {'/a.jpg', '/b.jpg', '/c.jpg'}
+    index.close()
+
+
+# Images hashed as they're processed should have their near duplicates caught, and deleted if asked.
+def test_near_duplicates_processed(tmpdir):
+    copy = images_with_copy(str(tmpdir))
+    index = similar.SimilarIndex(str(tmpdir.join('similar.db')))
+    processor = postprocess.PostProcessor(postprocess.processing_options(image_hash=True), workers=1, limit=1,
+                                          near_duplicates=similar.NearDuplicates(index, 6, 'delete'))
+
+    with reporting() as run_metrics:
+        for path in sorted(glob.glob(str(tmpdir.join('*.*g')))):
+            processor.process(path)
+        processor.close()
+
+    assert run_metrics.counter('near_duplicates') == 1
+    assert run_metrics.counter('files_processed') == len(os.listdir(test_images)) + 1
+    assert not os.path.exists(copy)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(os.listdir(test_images) + ['similar.db'])
+
+
+# A near duplicate deleted on its way in should count as done to the manifest it came with, so --resume
+# doesn't download it again, while a file deleted by hand still isn't.
+def test_near_duplicates_manifest(tmpdir):
+    copy = images_with_copy(str(tmpdir))
+    run_manifest = Manifest(str(tmpdir))
+    paths = sorted(glob.glob(str(tmpdir.join('*.*g'))))
+    for path in paths:
+        run_manifest.start('http://i.example.com/' + os.path.basename(path), os.path.basename(path))
+        run_manifest.finish(os.path.basename(path))
+
+    index = similar.SimilarIndex(str(tmpdir.join('similar.db')))
+    processor = postprocess.PostProcessor(postprocess.processing_options(image_hash=True), workers=1, limit=1,
+                                          near_duplicates=similar.NearDuplicates(index, 6, 'delete'))
+    for path in paths:
+        processor.process(path, run_manifest)
+    processor.close()
+
+    assert not os.path.exists(copy)
+    assert all(run_manifest.complete(os.path.basename(path)) for path in paths)
+
+    tmpdir.join('PIA10116.jpg').remove()
+    assert not run_manifest.complete('PIA10116.jpg')
+
+
+# The standalone command should list near duplicates of an existing directory, and only delete them
+# when asked.
+def test_main(tmpdir, capsys):
+    images = tmpdir.mkdir('images')
+    copy = images_with_copy(str(images))
+    images.join('notes.txt').write('not an image')
+    index = str(tmpdir.join('similar.db'))
+
+    similar.main([str(images), '--index', index, '--workers', '1'])
+    assert capsys.readouterr()[0] == '{}\t{}\t'.format(copy, str(images.join('PIA10116.jpg'))) + \
+        str(bits_apart(similar.dhash(copy), similar.dhash(str(images.join('PIA10116.jpg'))))) + '\n'
+    assert os.path.exists(copy)
+
+    # Everything is in the index now, so there's nothing new to look at.
+    similar.main([str(images), '--index', index, '--delete'])
+    assert capsys.readouterr()[0] == ''
+    assert os.path.exists(copy)
+
+    similar.main([str(images), '--delete'])
+    assert capsys.readouterr()[0].startswith(copy)
+    assert not os.path.exists(copy)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import unittest.mock as mock
+
+from redditimagescraper.modules.throttle import TokenBucket, CircuitBreaker, HostThrottle, backoff, retry_after
+
+
+# A full bucket should hand out its capacity straight away and then tell us how long to wait.
+def test_try_take():
+    bucket = TokenBucket(rate=10, capacity=3)
+
+    assert [bucket.try_take() for _ in range(3)] == [0, 0, 0]
+    assert 0 < bucket.try_take() <= 0.1
+
+
+# Threads sharing a bucket should together get no more than capacity + rate * seconds tokens.
+def test_take_shared():
+    bucket = TokenBucket(rate=50, capacity=5)
+    taken = list()
+
+    def take_five():
+        for _ in range(5):
+            bucket.take()
+            taken.append(time.monotonic())
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=take_five) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 20 tokens, 5 up front and 15 refilled at 50 per second.
+    assert len(taken) == 20
+    assert max(taken) - start >= 15 / 50 * 0.9
+
+
+# Retry-After comes either as seconds or as an HTTP date; anything else is ignored.
+def test_retry_after():
+    assert retry_after('120') == 120
+    assert retry_after(None) is None
+    assert retry_after('soon') is None
+
+    with mock.patch('time.time', return_value=784111767):
+        assert retry_after('Sun, 06 Nov 1994 08:49:37 GMT') == 10
+
+
+# Backoff should be jittered below an exponentially growing ceiling that stops at cap.
+def test_backoff():
+    assert all(0 <= backoff(attempt) <= 0.5 * 2 ** attempt for attempt in range(6))
+    assert all(backoff(50, cap=60) <= 60 for _ in range(100))
+
+
+# threshold failures in a row should park a breaker for cooldown seconds, or for the Retry-After
+# if that's longer, and a success should reset the count.
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.wait() == 0
+
+    breaker.failure()
+    assert 29 < breaker.wait() <= 30
+
+    breaker.success()
+    for _ in range(2):
+        breaker.failure(retry_after=90)
+    assert 89 < breaker.wait() <= 90
+
+
+# Once a parked host has served its cooldown only one probe should go through, the rest waiting on it.
+# A failed probe should park the host again, a lost one be given up on, and a good one let everything go.
+def test_circuit_breaker_half_open():
+    clock = [1000.0]
+    throttle = HostThrottle(threshold=2, cooldown=30)
+
+    with mock.patch('time.monotonic', side_effect=lambda: clock[0]):
+        for _ in range(2):
+            throttle.failure('https://i.imgur.com/a.jpg')
+        clock[0] += 30
+
+        assert throttle.wait('https://i.imgur.com/a.jpg') == 0
+        assert 0 < throttle.wait('https://i.imgur.com/b.jpg') <= 1
+
+        throttle.failure('https://i.imgur.com/a.jpg')
+        assert throttle.wait('https://i.imgur.com/b.jpg') == 30
+
+        clock[0] += 30
+        assert throttle.wait('https://i.imgur.com/b.jpg') == 0
+        clock[0] += 29
+        assert throttle.wait('https://i.imgur.com/c.jpg') == 1
+        clock[0] += 1
+        assert throttle.wait('https://i.imgur.com/c.jpg') == 0
+
+        throttle.success('https://i.imgur.com/c.jpg')
+        assert throttle.wait('https://i.imgur.com/d.jpg') == 0
+        assert throttle.wait('https://i.imgur.com/e.jpg') == 0
+
+
+# Each host should get its own bucket and breaker, so one failing host doesn't hold up another.
+def test_host_throttle():
+    throttle = HostThrottle(rate=1, threshold=1, cooldown=30)
+
+    assert throttle.wait('https://i.redd.it/a.jpg') == 0
+    assert throttle.wait('https://i.redd.it/b.jpg') > 0
+    assert throttle.wait('https://i.imgur.com/a.jpg') == 0
+
+    throttle.failure('https://i.imgur.com/a.jpg')
+    assert throttle.wait('https://i.imgur.com/b.jpg') > 1
+    assert HostThrottle().wait('https://i.imgur.com/a.jpg') == 0
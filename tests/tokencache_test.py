@@ -0,0 +1,36 @@
+import os
+import stat
+import time
+
+from redditimagescraper.modules.tokencache import TokenCache
+
+
+# A saved token should come back until it is about to expire, and only to whoever saved it.
+def test_token_cache(tmpdir):
+    path = str(tmpdir.join('tokens', 'token.json'))
+    cache = TokenCache(path)
+    assert cache.load('app:user') is None
+
+    cache.save('app:user', 'token', time.time() + 3600, {'read', 'identity'})
+    cache.save('app:other', 'stale', time.time() + 30, {'read'})
+
+    token = TokenCache(path).load('app:user')
+    assert token['access_token'] == 'token' and token['scopes'] == ['identity', 'read']
+    assert cache.load('app:other') is None
+    assert cache.load('app:other', margin=0)['access_token'] == 'stale'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    cache.forget('app:user')
+    assert cache.load('app:user') is None
+    assert cache.load('app:other', margin=0) is not None
+
+
+# A cache file that is missing or mangled is the same as an empty one.
+def test_token_cache_bad_file(tmpdir):
+    path = tmpdir.join('token.json')
+    path.write('not json')
+    cache = TokenCache(str(path))
+
+    assert cache.load('app:user') is None
+    cache.save('app:user', 'token', time.time() + 3600, ['read'])
+    assert cache.load('app:user')['access_token'] == 'token'
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from redditimagescraper.modules.workqueue import WorkQueue, WINDOW, DOWNLOAD
+
+
+# Adding the same work twice should only queue it once, and downloads should be claimed before windows.
+def test_add_and_claim(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.add(WINDOW, [{'subreddit': 'hamsters', 'window': [0, 1]}, {'subreddit': 'hamsters', 'window': [2, 3]}])
+    queue.add(WINDOW, [{'window': [0, 1], 'subreddit': 'hamsters'}])
+    queue.add(DOWNLOAD, [{'url': 'mock://a.jpg', 'date': '20170101_000000'}])
+
+    items = queue.claim('a', 10)
+    assert [item.kind for item in items] == [DOWNLOAD, WINDOW, WINDOW]
+    assert items[1].payload == {'subreddit': 'hamsters', 'window': [0, 1]}
+    assert all(item.attempts == 1 for item in items)
+
+    assert queue.claim('b', 10) == []
+    assert queue.counts() == {'pending': 0, 'leased': 3, 'done': 0, 'failed': 0}
+
+
+# Finishing an item should add what it led to in the same go, and only the item's owner can finish it.
+def test_finish(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.add(WINDOW, [{'subreddit': 'hamsters', 'window': [0, 1]}])
+    item = queue.claim('a')[0]
+
+    assert not queue.finish('b', item.id, DOWNLOAD, [{'url': 'mock://a.jpg'}])
+    assert queue.finish('a', item.id, DOWNLOAD, [{'url': 'mock://a.jpg'}, {'url': 'mock://b.jpg'}])
+    assert queue.counts() == {'pending': 2, 'leased': 0, 'done': 1, 'failed': 0}
+    assert not queue.finished()
+
+
+# A lease that runs out should let another worker take the item over, unless it's kept alive by heartbeats.
+def test_lease_expiry(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')), lease=0.2)
+    queue.add(DOWNLOAD, [{'url': 'mock://a.jpg'}, {'url': 'mock://b.jpg'}])
+    first, second = queue.claim('a', 2)
+
+    time.sleep(0.12)
+    assert queue.heartbeat('a', [second.id]) == [second.id]
+    time.sleep(0.12)
+
+    taken = queue.claim('b', 2)
+    assert [item.id for item in taken] == [first.id]
+    assert taken[0].attempts == 2
+    assert not queue.finish('a', first.id)
+    assert queue.heartbeat('a', [first.id, second.id]) == [second.id]
+    assert queue.finish('b', first.id)
+
+
+# Failed items go back on the queue until they run out of attempts, or straight to failed without retry.
+def test_fail(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')), max_attempts=2)
+    queue.add(DOWNLOAD, [{'url': 'mock://a.jpg'}, {'url': 'mock://b.jpg'}])
+
+    a, b = queue.claim('a', 2)
+    queue.fail('a', a.id)
+    queue.fail('a', b.id, retry=False)
+    assert queue.counts() == {'pending': 1, 'leased': 0, 'done': 0, 'failed': 1}
+
+    queue.fail('a', queue.claim('a')[0].id)
+    assert queue.claim('a') == []
+    assert queue.counts()['failed'] == 2
+    assert queue.finished()
+
+
+# Workers with their own connections to the queue should never get the same item.
+def test_claim_concurrently(tmpdir):
+    path = str(tmpdir.join('queue.sqlite'))
+    WorkQueue(path).add(DOWNLOAD, [{'n': n} for n in range(200)])
+    claimed = list()
+
+    def worker(owner):
+        queue = WorkQueue(path)
+        while True:
+            items = queue.claim(owner, 3)
+            if not items:
+                break
+            for item in items:
+                claimed.append(item.payload['n'])
+                queue.finish(owner, item.id)
+        queue.close()
+
+    workers = [threading.Thread(target=worker, args=(str(n),)) for n in range(4)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    assert sorted(claimed) == list(range(200))
+    assert WorkQueue(path).counts()['done'] == 200
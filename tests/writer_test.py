@@ -0,0 +1,100 @@
+import asyncio
+import os
+import unittest.mock as mock
+
+import pytest
+
+from redditimagescraper.modules.writer import DiskWriter
+
+
+# Runs coroutine(disk_writer) on a loop of its own, then closes the writer.
+def with_writer(coroutine, **kwargs):
+    loop = asyncio.new_event_loop()
+    disk_writer = DiskWriter(loop, **kwargs)
+    try:
+        return loop.run_until_complete(coroutine(disk_writer))
+    finally:
+        disk_writer.close()
+        loop.close()
+
+
+# Chunks of every size, across any number of buffers, should come out as written, with a write to
+# disk per buffer rather than per chunk, and the buffers kept for the next file.
+def test_write(tmpdir):
+    path = str(tmpdir.join('image.jpg.part'))
+    sizes = [1, 1023, 4096, 30000, 64 * 1024 - 5120, 65536]
+    content = os.urandom(sum(sizes))
+
+    written = list()
+    os_write = os.write
+
+    def spy(fd, data):
+        written.append(len(data))
+        return os_write(fd, data)
+
+    async def write(disk_writer):
+        with mock.patch('os.write', spy):
+            async with disk_writer.open(path) as file:
+                position = 0
+                for size in sizes:
+                    await file.write(content[position:position + size])
+                    position += size
+        return len(disk_writer.spare)
+
+    assert with_writer(write, buffer_size=32 * 1024) == 2
+
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert written == [32 * 1024] * 4 + [len(content) - 4 * 32 * 1024]
+
+
+# A file that fits in its buffer should only be opened once it is closed, in one go, and appending
+# should add to what is there.
+def test_append_and_small_files(tmpdir):
+    path = str(tmpdir.join('image.jpg.part'))
+    with open(path, 'wb') as f:
+        f.write(b'first ')
+
+    async def write(disk_writer):
+        async with disk_writer.open(path, append=True) as file:
+            await file.write(b'second')
+            assert file.fd is None and os.path.getsize(path) == 6
+
+    with_writer(write)
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'first second'
+
+
+# Space set aside for more than arrives should be given back, and an fsync made with the file policy.
+def test_preallocate_and_fsync(tmpdir):
+    path = str(tmpdir.join('image.jpg.part'))
+
+    async def write(disk_writer):
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            async with disk_writer.open(path, size=50000) as file:
+                await file.write(b'x' * 20000)
+            await disk_writer.replace(path, str(tmpdir.join('image.jpg')))
+        return fsync.call_count
+
+    assert with_writer(write, buffer_size=8192, fsync='file') == 1
+    assert os.path.getsize(str(tmpdir.join('image.jpg'))) == 20000
+
+    with pytest.raises(ValueError):
+        DiskWriter(None, fsync='sometimes')
+
+
+# Leaving the block with an error should close the file without writing out what is still buffered.
+def test_error(tmpdir):
+    path = str(tmpdir.join('image.jpg.part'))
+
+    async def write(disk_writer):
+        with pytest.raises(RuntimeError):
+            async with disk_writer.open(path) as file:
+                await file.write(b'x' * 5000)
+                await file.write(b'y' * 100)
+                raise RuntimeError('download went wrong')
+
+    with_writer(write, buffer_size=4096)
+
+    assert os.path.getsize(path) == 4096